@@ -0,0 +1,313 @@
+import os
+import json
+import signal
+import socket
+import asyncio
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+###
+#   ASGI runtime of the API server
+#
+#   The parent process loads the stores, embeddings, label index and autocomplete vocabularies,
+#   binds the socket and forks the workers, which share them copy-on-write (or through the page
+#   cache for the memory-mapped ones) and accept the connections of the same socket. In a worker,
+#   the event loop handles the connections and awaits the downloads of the pages given by URL,
+#   while the CPU-bound work (preprocessing, scoring, text extraction, autocompletion) runs in a
+#   bounded thread pool. A worker answers 503 while `--max-pending` jobs are queued or running in
+#   its pool, and 504 to the requests that take longer than `--request-timeout` seconds.
+#   The Flask server (server.py) remains available, with the Swagger documentation at /doc.
+###
+
+parser = argparse.ArgumentParser(description='ZeSTE ASGI server')
+parser.add_argument('--host', help='Address to bind', default='0.0.0.0')
+parser.add_argument('--port', type=int, help='Port to bind', default=5000)
+parser.add_argument('--workers', type=int, help='Number of worker processes', default=os.cpu_count())
+parser.add_argument('--threads', type=int, help='Number of threads scoring the requests in each worker', default=4)
+parser.add_argument('--max-pending', type=int, help='Maximum number of jobs queued or running in the threads of a worker before requests are rejected', default=64)
+parser.add_argument('--request-timeout', type=float, help='Maximum time to answer a request, in seconds', default=30.)
+parser.add_argument('--disallowed-rels', help='List of semicolon-separated relations that are disallowed', default='')
+parser.add_argument('--label-cache-size', type=int, help='Maximum total number of nodes of the label neighborhoods kept in memory', default=None)
+parser.add_argument('--preprocess-workers', type=int, help='Number of processes preprocessing the documents of a batch request', default=1)
+parser.add_argument('--fetch-timeout', type=float, help='Timeout of the download of a page given by URL, in seconds', default=10.)
+parser.add_argument('--fetch-connections-per-host', type=int, help='Maximum number of concurrent connections to a same host', default=4)
+parser.add_argument('--fetch-cache-ttl', type=float, help='Number of seconds the text extracted from a URL is cached', default=3600.)
+parser.add_argument('-v', '--verbose', help='increase output verbosity', action='store_true')
+args = parser.parse_args()
+logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+
+# loaded once by the parent process, before the workers are forked
+from zeste import predict, predict_batch, label_cache, label_set_cache, start_preprocess_pool
+from fetcher import Fetcher
+from vocabulary import load_autocompletes
+
+if args.label_cache_size is not None:
+    label_cache.resize(args.label_cache_size)
+autocompletes = load_autocompletes()
+
+
+class Offloader:
+    # bounded thread pool of a worker, counting the jobs it holds to reject the requests beyond `max_pending`
+
+    def __init__(self, threads, max_pending):
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix='scoring')
+        self.max_pending = max_pending
+        self.pending = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.lock = threading.Lock()
+
+    def overloaded(self):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            return True
+        return False
+
+    def run(self, function, *args):
+        # the job is counted until it ends, even if the request gave up on it
+        def job():
+            try:
+                return function(*args)
+            finally:
+                with self.lock:
+                    self.pending -= 1
+        with self.lock:
+            self.pending += 1
+        return asyncio.wrap_future(self.executor.submit(job))
+
+    def stats(self):
+        return {'pending': self.pending, 'max_pending': self.max_pending, 'rejected': self.rejected, 'timed_out': self.timed_out}
+
+
+offloader = None
+fetcher = None
+
+
+async def start_worker():
+    # the threads of the pools and of the fetcher do not survive a fork, they are started in each worker
+    global offloader, fetcher
+    start_preprocess_pool(args.preprocess_workers)
+    offloader = Offloader(args.threads, args.max_pending)
+    fetcher = Fetcher(max_connections_per_host=args.fetch_connections_per_host, timeout=args.fetch_timeout, cache_ttl=args.fetch_cache_ttl)
+
+
+async def stop_worker():
+    fetcher.close()
+    offloader.executor.shutdown(wait=False)
+
+
+def error(message, status_code):
+    return JSONResponse({'error': message}, status_code=status_code)
+
+
+def overloaded():
+    return JSONResponse({'error': 'Server overloaded'}, status_code=503, headers={'Retry-After': '1'})
+
+
+def timed_out():
+    offloader.timed_out += 1
+    return error('Request timed out', 504)
+
+
+def remaining(deadline):
+    return max(deadline - asyncio.get_event_loop().time(), 0)
+
+
+def request_options(content):
+    language = content['language']
+    show_explanations = 'explain' in content and content['explain']
+    show_highlights = 'highlights' in content and content['highlights']
+    disallowed_rels = content['disallowed_rels'] if 'disallowed_rels' in content else args.disallowed_rels.split(';')
+    return language, disallowed_rels, show_explanations, show_highlights
+
+
+async def fetch_texts(documents, deadline):
+    # the pages of all the documents given by URL are downloaded concurrently
+    uris = [document['uri'] for document in documents if 'uri' in document]
+    fetched = iter(await asyncio.wait_for(fetcher.fetch_texts_async(uris, offloader.executor), remaining(deadline)))
+    return [next(fetched) if 'uri' in document else document.get('text') for document in documents]
+
+
+async def status_route(request):
+    return JSONResponse('OK')
+
+
+async def cache_stats_route(request):
+    return JSONResponse(dict(label_cache.stats(), label_sets=label_set_cache.stats(), executor=offloader.stats(), pid=os.getpid()))
+
+
+async def autocomplete_route(request):
+    if offloader.overloaded():
+        return overloaded()
+    q = request.query_params.get('q')
+    hl = request.query_params.get('hl')
+    autocomplete = autocompletes['en' if hl == 'en' else 'fr']
+    if autocomplete is None:
+        return JSONResponse([])
+    try:
+        suggestions = await asyncio.wait_for(offloader.run(autocomplete.search, q, 3, 7), args.request_timeout)
+    except asyncio.TimeoutError:
+        return timed_out()
+    return JSONResponse(suggestions)
+
+
+# the responses are serialized in the threads too, as the highlights of long documents make large JSON documents
+
+def predict_response(text, labels, language, disallowed_rels, show_explanations, show_highlights):
+    response = predict(text, labels, language, disallowed_rels, show_explanations, show_highlights)
+    return JSONResponse({
+        "text": text,
+        "labels": labels,
+        "results": response
+    })
+
+
+async def predict_route(request):
+    if offloader.overloaded():
+        return overloaded()
+    deadline = asyncio.get_event_loop().time() + args.request_timeout
+    content = await request.json()
+    logging.debug(content)
+    language, disallowed_rels, show_explanations, show_highlights = request_options(content)
+    labels = content['labels']
+
+    try:
+        if 'uri' in content:
+            text = (await fetch_texts([content], deadline))[0]
+            if text is None:
+                return JSONResponse({"error": "Could not fetch URL"})
+        elif 'text' in content:
+            text = content['text']
+        else:
+            return error('Missing text or uri', 400)
+        return await asyncio.wait_for(offloader.run(predict_response, text, labels, language, disallowed_rels, show_explanations,
+                                                    show_highlights), remaining(deadline))
+    except asyncio.TimeoutError:
+        return timed_out()
+
+
+def batch_result(index, text, response):
+    # results are in the order of the documents, with an error for the documents without a text
+    if text is None:
+        return {"index": index, "error": "Could not fetch URL or missing text"}
+    return {"index": index, "text": text, "results": response}
+
+
+def batch_line(index, text, responses):
+    return json.dumps(batch_result(index, text, next(responses))) + '\n'
+
+
+def batch_response(texts, labels, responses):
+    return JSONResponse({
+        "labels": labels,
+        "results": [batch_result(index, text, response) for index, (text, response) in enumerate(zip(texts, responses))]
+    })
+
+
+async def predict_batch_route(request):
+    if offloader.overloaded():
+        return overloaded()
+    deadline = asyncio.get_event_loop().time() + args.request_timeout
+    content = await request.json()
+    logging.debug(content)
+    language, disallowed_rels, show_explanations, show_highlights = request_options(content)
+    labels = content['labels']
+
+    try:
+        texts = await fetch_texts(content['documents'], deadline)
+        # loads the label neighborhoods, the documents are scored as the results are consumed
+        responses = await asyncio.wait_for(offloader.run(predict_batch, texts, labels, language, disallowed_rels, show_explanations,
+                                                         show_highlights, args.preprocess_workers), remaining(deadline))
+        if not content.get('stream', False):
+            return await asyncio.wait_for(offloader.run(batch_response, texts, labels, responses), remaining(deadline))
+    except asyncio.TimeoutError:
+        return timed_out()
+
+    async def lines():
+        for index, text in enumerate(texts):
+            try:
+                yield await asyncio.wait_for(offloader.run(batch_line, index, text, responses), remaining(deadline))
+            except asyncio.TimeoutError:
+                offloader.timed_out += 1
+                yield json.dumps({"index": index, "error": "Request timed out"}) + '\n'
+                return
+    return StreamingResponse(lines(), media_type='application/x-ndjson')
+
+
+async def default_error_handler(request, exc):
+    return error(str(exc), getattr(exc, 'status_code', 500))
+
+
+app = Starlette(routes=[
+    Route('/api/status', status_route),
+    Route('/api/cache_stats', cache_stats_route),
+    Route('/api/autocomplete', autocomplete_route),
+    Route('/api/predict', predict_route, methods=['POST']),
+    Route('/api/predict_batch', predict_batch_route, methods=['POST']),
+], middleware=[Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])],
+    exception_handlers={Exception: default_error_handler}, on_startup=[start_worker], on_shutdown=[stop_worker])
+
+
+def serve(sock):
+    # uvicorn logs through the root logger
+    config = uvicorn.Config(app, proxy_headers=True, forwarded_allow_ips='*', log_config=None, log_level='debug' if args.verbose else 'info')
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+def run_workers(sock):
+    # forks the workers, restarts the ones that die, and stops them on SIGINT or SIGTERM
+    workers = set()
+    stopping = False
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            try:
+                serve(sock)
+            finally:
+                os._exit(0)
+        workers.add(pid)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    for _ in range(args.workers):
+        spawn()
+    logging.info(f'Started {args.workers} workers on {args.host}:{args.port}')
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        workers.discard(pid)
+        if not stopping:
+            logging.warning(f'Worker {pid} exited with status {status}, restarting it')
+            spawn()
+
+
+if __name__ == '__main__':
+    sock = socket.socket(socket.AF_INET6 if ':' in args.host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((args.host, args.port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    if args.workers > 1:
+        run_workers(sock)
+    else:
+        serve(sock)
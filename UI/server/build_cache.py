@@ -0,0 +1,75 @@
+import os
+import time
+import argparse
+import multiprocessing as mp
+from tqdm import tqdm
+
+###
+#   Offline build of the label neighborhoods of the server cache
+#
+#   Builds the neighborhoods of a vocabulary of labels, for each language and variant of the
+#   disallowed relations, across forked processes sharing the memory-mapped stores and embeddings,
+#   and then updates the label index, so that the server never builds them while a request waits.
+#   The labels already in the cache are skipped, so an interrupted build can be run again.
+###
+
+
+def read_labels(path):
+    # one label per line, or the format of the `labels_mapping` files (dataset label, a tab, and
+    # the ZeSTE label whose words are separated by semicolons)
+    labels = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                labels.append(line.split('\t')[-1].replace(';', '-'))
+    return labels
+
+
+def build(task):
+    label, language, disallowed_rels = task
+    try:
+        return task, len(zeste.build_label_neighborhood(label, language, disallowed_rels)), None
+    except Exception as e:
+        return task, 0, repr(e)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build the label neighborhoods of the server cache')
+    parser.add_argument('-l', '--labels', nargs='+', help='Files of labels (one per line, e.g. vocab.txt, or labels_mapping files)', required=True)
+    parser.add_argument('-lg', '--languages', nargs='+', choices=['en', 'fr'], help='Languages of the labels', default=['en'])
+    parser.add_argument('-dr', '--disallowed-rels', nargs='+', help='Variants of the disallowed relations, each one as given to the --disallowed-rels of the server ("" for none)', default=[''])
+    parser.add_argument('-w', '--workers', type=int, help='Number of processes building the neighborhoods', default=os.cpu_count())
+    args = parser.parse_args()
+
+    # loads the stores and embeddings of the server, which the workers inherit
+    import zeste
+
+    labels = list(dict.fromkeys(label for path in args.labels for label in read_labels(path)))
+    # parsed as the --disallowed-rels of the server, so that the names of the cached neighborhoods match
+    variants = [variant.split(';') for variant in args.disallowed_rels]
+    tasks = [(label, language, variant) for language in args.languages for variant in variants for label in labels]
+    missing = [task for task in tasks if not os.path.exists(zeste.label_path(*task))]
+    print(f'{len(tasks) - len(missing):,} of {len(tasks):,} label neighborhoods are already cached, building {len(missing):,} with {args.workers} processes')
+
+    started = time.time()
+    built = nodes = 0
+    failures = []
+    with mp.get_context('fork').Pool(processes=args.workers) as pool, tqdm(total=len(missing), unit=' labels') as progress:
+        for task, size, error in pool.imap_unordered(build, missing):
+            if error is None:
+                built += 1
+                nodes += size
+            else:
+                failures.append((task, error))
+            progress.update()
+            progress.set_postfix(nodes_per_s=f'{nodes / max(time.time() - started, 1e-9):,.0f}')
+    elapsed = max(time.time() - started, 1e-9)
+
+    for (label, language, variant), error in failures:
+        print(f'Could not build "{label}" ({language}, disallowed: {";".join(variant)}): {error}')
+    print(f'Built {built:,} label neighborhoods ({nodes:,} nodes) in {elapsed:.1f}s: {built / elapsed:.2f} labels/s, {nodes / elapsed:,.0f} nodes/s, {len(failures):,} failed')
+
+    started = time.time()
+    zeste.label_index.update()
+    print(f'Updated the label index in {time.time() - started:.1f}s')
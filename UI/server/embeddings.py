@@ -0,0 +1 @@
+../../embeddings.py
\ No newline at end of file
@@ -0,0 +1,163 @@
+import time
+import asyncio
+import argparse
+import logging
+import threading
+from collections import OrderedDict
+
+import aiohttp
+import trafilatura
+
+###
+#   Asynchronous fetching of the documents given by URL
+#
+#   The pages are downloaded by a pooled keep-alive aiohttp session running on an event loop in a
+#   background thread. Concurrency is capped globally and per host, downloads are bounded in time
+#   and size, and the extracted texts are kept in a TTL cache keyed by URL. fetch_text(s) block the
+#   calling thread until the downloads end (the Flask handlers of server.py wait on them), while
+#   fetch_texts_async lets an event loop await them without holding a thread (asgi.py).
+###
+
+USER_AGENT = 'Mozilla/5.0 (compatible; ZeSTE; +https://github.com/D2KLab/ZeSTE)'
+
+
+class TextCache:
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, url):
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry is None:
+                return None
+            expires, text = entry
+            if expires < time.monotonic():
+                del self.entries[url]
+                return None
+            self.entries.move_to_end(url)
+            return text
+
+    def put(self, url, text):
+        with self.lock:
+            self.entries[url] = (time.monotonic() + self.ttl, text)
+            self.entries.move_to_end(url)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+class Fetcher:
+
+    def __init__(self, max_connections=100, max_connections_per_host=4, timeout=10., max_bytes=5 * 2**20,
+                 cache_ttl=3600., cache_size=10000):
+        self.max_connections = max_connections
+        self.max_connections_per_host = max_connections_per_host
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.cache = TextCache(cache_ttl, cache_size)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='fetcher', daemon=True)
+        self.thread.start()
+        # the session must be created from within its event loop
+        self.session = asyncio.run_coroutine_threadsafe(self.create_session(), self.loop).result()
+
+    async def create_session(self):
+        connector = aiohttp.TCPConnector(limit=self.max_connections, limit_per_host=self.max_connections_per_host,
+                                         keepalive_timeout=30)
+        return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout),
+                                     headers={'User-Agent': USER_AGENT})
+
+    async def download(self, url):
+        # returns the decoded page, or None if it could not be fetched within the limits
+        try:
+            async with self.session.get(url) as response:
+                if response.status != 200:
+                    logging.info('Could not fetch %s: HTTP %d', url, response.status)
+                    return None
+                if response.content_length is not None and response.content_length > self.max_bytes:
+                    logging.info('Could not fetch %s: %d bytes', url, response.content_length)
+                    return None
+                body = bytearray()
+                async for chunk in response.content.iter_chunked(65536):
+                    body.extend(chunk)
+                    if len(body) > self.max_bytes:
+                        logging.info('Could not fetch %s: more than %d bytes', url, self.max_bytes)
+                        return None
+                charset = response.charset or 'utf-8'
+                try:
+                    return body.decode(charset, errors='replace')
+                except LookupError:
+                    logging.info('Unknown charset %r of %s, decoded as utf-8', charset, url)
+                    return body.decode('utf-8', errors='replace')
+        except (aiohttp.ClientError, asyncio.TimeoutError, UnicodeError, ValueError) as e:
+            logging.info('Could not fetch %s: %r', url, e)
+            return None
+
+    async def download_all(self, urls):
+        # a download failing in an unexpected way only loses its own page
+        pages = await asyncio.gather(*(self.download(url) for url in urls), return_exceptions=True)
+        for url, page in zip(urls, pages):
+            if isinstance(page, Exception):
+                logging.warning('Could not fetch %s: %r', url, page)
+        return [None if isinstance(page, Exception) else page for page in pages]
+
+    def cached_texts(self, urls):
+        # texts of `urls` found in the cache (None for the others), and the distinct missing URLs
+        texts = [self.cache.get(url) for url in urls]
+        return texts, list(OrderedDict.fromkeys(url for url, text in zip(urls, texts) if text is None))
+
+    def extract_all(self, urls, texts, missing, pages):
+        fetched = {}
+        for url, page in zip(missing, pages):
+            text = trafilatura.extract(page) if page is not None else None
+            if text is not None:
+                self.cache.put(url, text)
+            fetched[url] = text
+        return [fetched[url] if text is None else text for url, text in zip(urls, texts)]
+
+    def fetch_texts(self, urls):
+        # extracted texts in the order of `urls` (None for the pages that could not be fetched),
+        # the pages missing from the cache are downloaded concurrently
+        texts, missing = self.cached_texts(urls)
+        if not missing:
+            return texts
+        pages = asyncio.run_coroutine_threadsafe(self.download_all(missing), self.loop).result()
+        return self.extract_all(urls, texts, missing, pages)
+
+    async def fetch_texts_async(self, urls, executor=None):
+        # fetch_texts awaited from another event loop, which is not blocked by the downloads, the
+        # texts are extracted from the pages in `executor` (the default executor of the loop if None)
+        texts, missing = self.cached_texts(urls)
+        if not missing:
+            return texts
+        pages = await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(self.download_all(missing), self.loop))
+        return await asyncio.get_event_loop().run_in_executor(executor, self.extract_all, urls, texts, missing, pages)
+
+    def fetch_text(self, url):
+        return self.fetch_texts([url])[0]
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.session.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Fetch and extract the text of web pages')
+    parser.add_argument('urls', nargs='+', help='URLs of the pages (e.g. served locally with `python -m http.server`)')
+    parser.add_argument('-t', '--timeout', type=float, help='Timeout of a download, in seconds', default=10.)
+    parser.add_argument('-r', '--repeat', type=int, help='Number of times the URLs are fetched (to check the cache)', default=1)
+    args = parser.parse_args()
+
+    fetcher = Fetcher(timeout=args.timeout)
+    for _ in range(args.repeat):
+        started = time.perf_counter()
+        texts = fetcher.fetch_texts(args.urls)
+        elapsed = time.perf_counter() - started
+        for url, text in zip(args.urls, texts):
+            print(url, 'failed' if text is None else f'{len(text)} characters')
+        print(f'{len(args.urls)} pages in {elapsed:.3f}s')
+    fetcher.close()
@@ -0,0 +1,89 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+###
+#   In-process cache of label neighborhoods
+#
+#   A bounded LRU whose size is the total number of nodes of the cached neighborhoods. Concurrent
+#   requests for a label that is not cached yet wait for a single build instead of each starting one.
+###
+
+
+class LabelCache:
+
+    def __init__(self, max_size, sizeof=len):
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.entries = OrderedDict()
+        self.size = 0
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.deduplicated = self.evictions = 0
+
+    def get(self, key, build):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+            self.misses += 1
+            flight = self.pending.get(key)
+            owner = flight is None
+            if owner:
+                flight = self.pending[key] = Future()
+            else:
+                self.deduplicated += 1
+
+        if not owner:
+            return flight.result()
+
+        try:
+            value = build()
+        except BaseException as e:
+            with self.lock:
+                del self.pending[key]
+            flight.set_exception(e)
+            raise
+
+        with self.lock:
+            self.put(key, value)
+            del self.pending[key]
+        flight.set_result(value)
+        return value
+
+    def put(self, key, value):
+        # must be called with the lock held
+        size = self.sizeof(value)
+        if key in self.entries:
+            self.size -= self.entries.pop(key)[1]
+        if size > self.max_size:
+            return
+        while self.size + size > self.max_size:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+            self.evictions += 1
+        self.entries[key] = (value, size)
+        self.size += size
+
+    def discard(self, predicate):
+        # removes the entries whose key matches `predicate`, returns their number
+        with self.lock:
+            keys = [key for key in self.entries if predicate(key)]
+            for key in keys:
+                self.size -= self.entries.pop(key)[1]
+            return len(keys)
+
+    def resize(self, max_size):
+        with self.lock:
+            self.max_size = max_size
+            while self.size > self.max_size:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'size': self.size, 'max_size': self.max_size,
+                    'hits': self.hits, 'misses': self.misses, 'deduplicated': self.deduplicated,
+                    'evictions': self.evictions, 'building': len(self.pending)}
@@ -0,0 +1,320 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import pickle
+import shutil
+import logging
+import argparse
+import tempfile
+import threading
+import numpy as np
+
+from store import StringTable, save_string_table
+
+###
+#   Inverted index of the cached label neighborhoods
+#
+#   Maps every word of the label neighborhoods of the demo cache to the labels whose neighborhood
+#   it belongs to, with its similarity to them, so that a document is scored against any set of
+#   cached labels in a single pass over its tokens, without loading their neighborhoods. A
+#   generation of the index is a folder of memory-mapped arrays:
+#     labels.json                     cache entries of the labels (pickle name and modification time)
+#     words.bin, words_offsets.npy    sorted string table of the words
+#     indptr.npy                      the postings of word i are [indptr[i], indptr[i + 1])
+#     label_ids.npy, sims.npy         label (position in labels.json) and similarity of each posting
+#   <index_path>/CURRENT names the generation in use. An update writes a new generation, reusing the
+#   postings of the labels whose pickle did not change, and then replaces CURRENT, which the server
+#   processes check to reload the index.
+###
+
+
+class LabelSetIndex:
+    # token -> [(position of the label, similarity)] over the neighborhoods of a set of labels, so
+    # that a document is scored against all of them in a single pass over its tokens
+
+    def __init__(self, lns):
+        self.labels = list(lns)
+        self.index = {}
+        for k, label in enumerate(self.labels):
+            for token, node in lns[label].items():
+                self.index.setdefault(token, []).append((k, node['sim']))
+        self.size = sum(len(entries) for entries in self.index.values())
+
+    def __len__(self):
+        return self.size
+
+    def lookup(self, tokens):
+        return {token: self.index.get(token, ()) for token in tokens}
+
+    def score(self, tokens, show_highlights):
+        # scores of the labels, their related words (with their similarity, in the order of the
+        # tokens) and, if requested, the highlights of the tokens for each label
+        n = len(self.labels)
+        scores = [0] * n
+        related_words = [[] for _ in range(n)]
+        highlights = [[] for _ in range(n)] if show_highlights else None
+        token_entries = self.lookup(set(tokens))
+        token_highlights = {}
+        for token in tokens:
+            entries = token_entries[token]
+            for k, similarity in entries:
+                if similarity > 0:
+                    related_words[k].append((token, similarity))
+                    scores[k] += similarity
+            if show_highlights:
+                if token not in token_highlights:
+                    sims = ['-1'] * n
+                    for k, similarity in entries:
+                        sims[k] = str(similarity)
+                    token_highlights[token] = sims
+                for k, similarity in enumerate(token_highlights[token]):
+                    highlights[k].append([token, similarity])
+        return scores, related_words, highlights
+
+
+class IndexedLabelSet(LabelSetIndex):
+    # labels of a request scored from the postings of an index generation, masked by label id
+
+    def __init__(self, generation, labels, label_ids):
+        self.labels = labels
+        self.generation = generation
+        # the requested label ids, sorted, and the position of each one in `labels`
+        self.order = np.argsort(label_ids)
+        self.label_ids = np.asarray(label_ids, dtype=np.int64)[self.order]
+
+    def __len__(self):
+        return len(self.labels)
+
+    def lookup(self, tokens):
+        generation = self.generation
+        token_entries = {}
+        for token in tokens:
+            i = generation.words.index(token) if len(self.label_ids) else -1
+            if i < 0:
+                token_entries[token] = ()
+                continue
+            postings = slice(generation.indptr[i], generation.indptr[i + 1])
+            posting_labels = generation.label_ids[postings]
+            k = np.minimum(np.searchsorted(self.label_ids, posting_labels), len(self.label_ids) - 1)
+            found = self.label_ids[k] == posting_labels
+            token_entries[token] = list(zip(self.order[k[found]].tolist(), generation.sims[postings][found]))
+        return token_entries
+
+
+class LabelIndexGeneration:
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        with open(os.path.join(path, 'labels.json')) as f:
+            meta = json.load(f)
+        self.names = meta['labels']
+        self.entries = dict(zip(self.names, meta['mtimes']))
+        self.name_ids = {name: i for i, name in enumerate(self.names)}
+        self.words = StringTable(path, 'words')
+        self.indptr = np.load(os.path.join(path, 'indptr.npy'), mmap_mode='r')
+        self.label_ids = np.load(os.path.join(path, 'label_ids.npy'), mmap_mode='r')
+        self.sims = np.load(os.path.join(path, 'sims.npy'), mmap_mode='r')
+
+    def label_set(self, labels, names):
+        # the `labels` of a request, whose cache entries are `names`, or None if any is not indexed
+        label_ids = [self.name_ids.get(name) for name in names]
+        if None in label_ids:
+            return None
+        return IndexedLabelSet(self, labels, label_ids)
+
+
+def read_current(index_path):
+    try:
+        with open(os.path.join(index_path, 'CURRENT')) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def cached_entries(cache_path):
+    # {pickle name: modification time} of the label neighborhoods of the cache
+    if not os.path.isdir(cache_path):
+        return {}
+    return {f[:-len('.pickle')]: os.path.getmtime(os.path.join(cache_path, f))
+            for f in sorted(os.listdir(cache_path)) if f.endswith('.pickle')}
+
+
+def update_label_index(cache_path, index_path):
+    # brings the index up to date with the label neighborhoods of `cache_path`, returns the number
+    # of labels that were (re)indexed, or None if the index was already up to date
+    os.makedirs(index_path, exist_ok=True)
+    with open(os.path.join(index_path, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        current_name = read_current(index_path)
+        current = LabelIndexGeneration(os.path.join(index_path, current_name)) if current_name else None
+        entries = cached_entries(cache_path)
+        if current is not None and current.entries == entries:
+            return None
+
+        # postings of the new (or rebuilt) labels, converted to arrays as they are loaded, with
+        # provisional word ids in the order the words are met
+        kept = {name for name in entries if current is not None and current.entries.get(name) == entries[name]}
+        word_ids_of = {}
+        def provisional_ids(words):
+            return np.array([word_ids_of.setdefault(w, len(word_ids_of)) for w in words], dtype=np.int64)
+
+        added = []
+        for name in sorted(entries):
+            if name in kept:
+                continue
+            try:
+                with open(os.path.join(cache_path, name + '.pickle'), 'rb') as f:
+                    neighborhood = pickle.load(f)
+            except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+                # removed, or being written, since the cache was listed (indexed by the next update)
+                continue
+            added.append((name, provisional_ids(neighborhood), np.array([node['sim'] for node in neighborhood.values()], dtype=np.float32)))
+            del neighborhood
+        names = sorted(kept.union(name for name, _, _ in added))
+        name_ids = {name: i for i, name in enumerate(names)}
+
+        word_ids, label_ids, sims = [], [], []
+        # postings of the unchanged labels, with their label ids remapped
+        if kept:
+            old_to_new = np.full(len(current.names), -1, dtype=np.int64)
+            old_to_new[[current.name_ids[name] for name in kept]] = [name_ids[name] for name in kept]
+            posting_labels = old_to_new[current.label_ids]
+            found = posting_labels >= 0
+            posting_words = np.repeat(np.arange(len(current.words)), np.diff(current.indptr))[found]
+            old_words, inverse = np.unique(posting_words, return_inverse=True)
+            word_ids.append(provisional_ids(current.words[i] for i in old_words)[inverse])
+            label_ids.append(posting_labels[found])
+            sims.append(np.asarray(current.sims)[found])
+        for name, ids, label_sims in added:
+            word_ids.append(ids)
+            label_ids.append(np.full(len(ids), name_ids[name], dtype=np.int64))
+            sims.append(label_sims)
+
+        # the words are numbered in the order of the sorted vocabulary
+        vocabulary = sorted(word_ids_of)
+        final_ids = np.empty(len(vocabulary), dtype=np.int64)
+        final_ids[[word_ids_of[w] for w in vocabulary]] = np.arange(len(vocabulary))
+        word_ids = final_ids[np.concatenate(word_ids)] if word_ids else np.zeros(0, dtype=np.int64)
+        label_ids = np.concatenate(label_ids) if label_ids else np.zeros(0, dtype=np.int64)
+        sims = np.concatenate(sims) if sims else np.zeros(0, dtype=np.float32)
+        order = np.lexsort((label_ids, word_ids))
+        indptr = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(word_ids, minlength=len(vocabulary)), out=indptr[1:])
+
+        name = time.strftime('%Y%m%d-%H%M%S-') + uuid.uuid4().hex[:8]
+        tmp_path = os.path.join(index_path, '.tmp-' + name)
+        os.makedirs(tmp_path)
+        save_string_table(tmp_path, 'words', vocabulary)
+        np.save(os.path.join(tmp_path, 'indptr.npy'), indptr)
+        np.save(os.path.join(tmp_path, 'label_ids.npy'), label_ids[order].astype(np.int32))
+        np.save(os.path.join(tmp_path, 'sims.npy'), sims[order].astype(np.float32))
+        with open(os.path.join(tmp_path, 'labels.json'), 'w') as f:
+            json.dump({'labels': names, 'mtimes': [entries[name] for name in names]}, f)
+        os.rename(tmp_path, os.path.join(index_path, name))
+
+        fd, tmp_current = tempfile.mkstemp(prefix='.tmp-', dir=index_path)
+        with os.fdopen(fd, 'w') as f:
+            f.write(name)
+        os.replace(tmp_current, os.path.join(index_path, 'CURRENT'))
+
+        # the previous generation is kept for the processes that have not reloaded yet
+        for f in os.listdir(index_path):
+            if f not in (name, current_name, 'CURRENT', '.lock') and os.path.isdir(os.path.join(index_path, f)):
+                shutil.rmtree(os.path.join(index_path, f))
+        return len(added)
+
+
+class LabelIndex:
+    # current generation of the index at `index_path`, reloaded when CURRENT changes (checked at
+    # most every `check_interval` seconds), and updated in a background thread `update_delay`
+    # seconds after labels are added to the cache, to batch the labels cached in the meantime.
+    # The cache folder is checked as well: when its entries change (e.g. removed by update_cache.py
+    # or rebuilt by another process), the names of the removed or rewritten ones are passed to
+    # `on_change` and the index is updated
+
+    def __init__(self, index_path, cache_path, check_interval=1., update_delay=10., on_change=None):
+        self.index_path = index_path
+        self.cache_path = cache_path
+        self.check_interval = check_interval
+        self.update_delay = update_delay
+        self.on_change = on_change
+        self.generation = None
+        self.checked = 0.
+        self.cache_mtime = None
+        self.entries = None
+        self.lock = threading.Lock()
+        self.pending = threading.Event()
+        self.updater = None
+
+    def reload(self):
+        name = read_current(self.index_path)
+        with self.lock:
+            self.checked = time.monotonic()
+            if name is not None and (self.generation is None or self.generation.name != name):
+                logging.info('Loading the label index ' + name)
+                self.generation = LabelIndexGeneration(os.path.join(self.index_path, name))
+
+    def check_cache(self):
+        # the entries of the cache are only listed when its folder was modified, which is the case
+        # whenever a pickle is added, replaced or removed
+        try:
+            mtime = os.stat(self.cache_path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        with self.lock:
+            if self.entries is not None and mtime == self.cache_mtime:
+                return
+            self.cache_mtime = mtime
+            previous, self.entries = self.entries, cached_entries(self.cache_path)
+        if previous is None:
+            return
+        changed = [name for name, mtime in previous.items() if self.entries.get(name) != mtime]
+        if changed and self.on_change is not None:
+            self.on_change(changed)
+        self.schedule_update()
+
+    def current(self):
+        if time.monotonic() - self.checked > self.check_interval:
+            self.check_cache()
+            self.reload()
+        return self.generation
+
+    def update(self):
+        indexed = update_label_index(self.cache_path, self.index_path)
+        if indexed is not None:
+            logging.info(f'Indexed {indexed} label neighborhoods')
+        self.reload()
+
+    def schedule_update(self):
+        with self.lock:
+            if self.updater is None:
+                self.updater = threading.Thread(target=self.run_updates, name='label-index', daemon=True)
+                self.updater.start()
+        self.pending.set()
+
+    def run_updates(self):
+        while True:
+            self.pending.wait()
+            time.sleep(self.update_delay)
+            self.pending.clear()
+            try:
+                self.update()
+            except Exception:
+                logging.exception('Could not update the label index')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build or update the inverted index of the cached label neighborhoods')
+    parser.add_argument('-c', '--cache_path', type=str, help='Path to the cached label neighborhoods', default='/data/zeste_cache/demo_cache/v2/')
+    parser.add_argument('-i', '--index_path', type=str, help='Path to the label index', default='/data/zeste_cache/demo_cache/v2_index/')
+    args = parser.parse_args()
+
+    started = time.time()
+    indexed = update_label_index(args.cache_path, args.index_path)
+    if indexed is None:
+        print('The label index is up to date')
+    else:
+        print(f'Indexed {indexed} label neighborhoods in {time.time() - started:.1f}s')
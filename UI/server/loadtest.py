@@ -0,0 +1,81 @@
+import time
+import json
+import asyncio
+import argparse
+from collections import Counter
+
+import aiohttp
+import numpy as np
+
+###
+#   Load test of the API server
+#
+#   Sends /api/predict requests from `--concurrency` concurrent clients, for `--requests` requests
+#   or `--duration` seconds, and reports the throughput, the latency percentiles of the successful
+#   requests and the number of requests per status (e.g. 503 when the server sheds load, 504 when
+#   it times out).
+###
+
+DEFAULT_TEXT = ('The spacecraft entered the orbit of Mars after a seven month journey, and the agency '
+                'released the first images taken by its camera of the surface of the planet.')
+
+
+async def client(session, url, payload, schedule, latencies, statuses):
+    while schedule():
+        started = time.perf_counter()
+        try:
+            async with session.post(url, json=payload) as response:
+                await response.read()
+                status = response.status
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            status = type(e).__name__
+        if status == 200:
+            latencies.append(time.perf_counter() - started)
+        statuses[status] += 1
+
+
+async def run(args, payload):
+    latencies, statuses = [], Counter()
+    sent = 0
+
+    def schedule():
+        # whether a client sends another request
+        nonlocal sent
+        if args.duration is not None:
+            return time.perf_counter() < started + args.duration
+        sent += 1
+        return sent <= args.requests
+
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=args.timeout)) as session:
+        # the label neighborhoods are loaded by a first request, which is not measured
+        async with session.post(args.url, json=payload) as response:
+            print(f'Warm-up request: HTTP {response.status}')
+            await response.read()
+        started = time.perf_counter()
+        await asyncio.gather(*(client(session, args.url, payload, schedule, latencies, statuses) for _ in range(args.concurrency)))
+    return latencies, statuses, time.perf_counter() - started
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load test of the ZeSTE API server')
+    parser.add_argument('url', nargs='?', help='URL of the predict endpoint', default='http://localhost:5000/api/predict')
+    parser.add_argument('-c', '--concurrency', type=int, help='Number of concurrent clients', default=32)
+    parser.add_argument('-n', '--requests', type=int, help='Number of requests to send', default=1000)
+    parser.add_argument('-d', '--duration', type=float, help='Number of seconds to send requests for (instead of --requests)', default=None)
+    parser.add_argument('-l', '--labels', nargs='+', help='Labels of the requests', default=['space', 'sport', 'politics', 'music', 'medicine'])
+    parser.add_argument('-lg', '--language', choices=['en', 'fr'], default='en')
+    parser.add_argument('-t', '--text', type=str, help='Text of the requests', default=DEFAULT_TEXT)
+    parser.add_argument('--timeout', type=float, help='Client timeout of a request, in seconds', default=60.)
+    args = parser.parse_args()
+
+    payload = {'text': args.text, 'labels': args.labels, 'language': args.language, 'explain': False, 'highlights': True}
+    latencies, statuses, elapsed = asyncio.get_event_loop().run_until_complete(run(args, payload))
+
+    total = sum(statuses.values())
+    print(f'{total:,} requests in {elapsed:.2f}s with {args.concurrency} clients: {total / elapsed:,.1f} requests/s, '
+          f'{len(latencies) / elapsed:,.1f} successful requests/s')
+    if latencies:
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99]) * 1000
+        print(f'Latency: p50 {p50:.1f}ms, p90 {p90:.1f}ms, p99 {p99:.1f}ms, max {max(latencies) * 1000:.1f}ms')
+    print('Statuses:', json.dumps({str(status): count for status, count in sorted(statuses.items(), key=lambda item: str(item[0]))}))
@@ -1,11 +1,12 @@
-from fast_autocomplete import AutoComplete
-from flask import Flask, jsonify, request, Blueprint
+from flask import Flask, Response, jsonify, request, Blueprint
 from flask_cors import CORS, cross_origin
-from zeste import predict
+from zeste import predict, predict_batch, label_cache, label_set_cache, start_preprocess_pool
+from fetcher import Fetcher
+from vocabulary import load_autocompletes
 import argparse
 import os
+import json
 import logging
-import trafilatura
 
 import werkzeug
 werkzeug.cached_property = werkzeug.utils.cached_property
@@ -15,30 +16,24 @@ from werkzeug.middleware.proxy_fix import ProxyFix
 
 parser = argparse.ArgumentParser(description='ZeSTE server')
 parser.add_argument('--disallowed-rels', help='List of semicolon-separated relations that are disallowed', default='')
+parser.add_argument('--label-cache-size', type=int, help='Maximum total number of nodes of the label neighborhoods kept in memory', default=None)
+parser.add_argument('--preprocess-workers', type=int, help='Number of processes preprocessing the documents of a batch request', default=1)
+parser.add_argument('--fetch-timeout', type=float, help='Timeout of the download of a page given by URL, in seconds', default=10.)
+parser.add_argument('--fetch-connections-per-host', type=int, help='Maximum number of concurrent connections to a same host', default=4)
+parser.add_argument('--fetch-cache-ttl', type=float, help='Number of seconds the text extracted from a URL is cached', default=3600.)
 parser.add_argument('-v', '--verbose', help='increase output verbosity', action='store_true')
 args = parser.parse_args()
 if args.verbose:
     logging.basicConfig(level=logging.DEBUG)
 logging.debug('Args:', args)
+if args.label_cache_size is not None:
+    label_cache.resize(args.label_cache_size)
 
-logging.info('Loading autocomplete vocabulary...')
-words_en = {}
-vocab_filepath = '/data/zeste_cache/vocab.txt'
-if os.path.exists(vocab_filepath):
-    vocab_file = open(vocab_filepath, 'r')
-    lines = vocab_file.readlines()
-    for line in lines:
-        words_en[line.strip()] = {}
-autocomplete_en = AutoComplete(words=words_en)
-
-words_fr = {}
-vocab_filepath = '/data/zeste_cache/vocab_fr.txt'
-if os.path.exists(vocab_filepath):
-    vocab_file = open(vocab_filepath, 'r')
-    lines = vocab_file.readlines()
-    for line in lines:
-        words_fr[line.strip()] = {}
-autocomplete_fr = AutoComplete(words=words_fr)
+# before the fetcher starts its thread
+start_preprocess_pool(args.preprocess_workers)
+fetcher = Fetcher(max_connections_per_host=args.fetch_connections_per_host, timeout=args.fetch_timeout, cache_ttl=args.fetch_cache_ttl)
+
+autocompletes = load_autocompletes()
 
 logging.info('Starting web server...')
 app = Flask(__name__)
@@ -53,6 +48,12 @@ class status_route(Resource):
         return 'OK'
 
 
+@ns.route('/cache_stats')
+class cache_stats_route(Resource):
+    def get(self):
+        return jsonify(dict(label_cache.stats(), label_sets=label_set_cache.stats()))
+
+
 @ns.route('/autocomplete', methods=['GET'])
 @api.doc(params={'q': 'Search keywords', 'hl': 'Language'})
 class autocomplete_route(Resource):
@@ -60,11 +61,8 @@ class autocomplete_route(Resource):
     def get(self):
         q = request.args.get('q')
         hl = request.args.get('hl')
-        if hl == 'en':
-            autocomplete = autocomplete_en
-        else:
-            autocomplete = autocomplete_fr
-        suggestions = autocomplete.search(word=q, max_cost=3, size=7)
+        autocomplete = autocompletes['en' if hl == 'en' else 'fr']
+        suggestions = autocomplete.search(word=q, max_cost=3, size=7) if autocomplete is not None else []
         return jsonify(suggestions)
 
 resource_fields = api.model('Resource', {
@@ -90,11 +88,11 @@ class predict_route(Resource):
         show_highlights = 'highlights' in content and content['highlights']
         disallowed_rels = content['disallowed_rels'] if 'disallowed_rels' in content else args.disallowed_rels.split(';')
 
+        # the request thread waits for the download, at most --fetch-timeout seconds (asgi.py awaits it instead)
         if 'uri' in content:
-            downloaded = trafilatura.fetch_url(content['uri'])
-            if downloaded is None:
+            text = fetcher.fetch_text(content['uri'])
+            if text is None:
                 return jsonify({ "error": "Could not fetch URL" })
-            text = trafilatura.extract(downloaded)
         elif 'text' in content:
             text = content['text']
 
@@ -135,6 +133,60 @@ class predict_route(Resource):
         })
 
 
+document_fields = api.model('Document', {
+    'uri': fields.String(description='The URL to a page to extract text and return predictions for (if specified, `text` will be ignored)'),
+    'text': fields.String(description='The text to extract (if `uri` is specified, this will be ignored)'),
+})
+
+batch_fields = api.model('Batch', {
+    'documents': fields.List(fields.Nested(document_fields), description='list of documents to classify', required=True),
+    'language': fields.String(description='language of the documents (en, fr)', required=True),
+    'labels': fields.List(fields.String, description='list of labels shared by all the documents', required=True),
+    'disallowed_rels': fields.List(fields.String, description='list of relations to ignore', default=[]),
+    'explain': fields.Boolean(description='return explanations for each prediction', default=False),
+    'highlights': fields.Boolean(description='return highlights for each prediction', default=False),
+    'stream': fields.Boolean(description='stream the results as newline-delimited JSON, one line per document', default=False)
+})
+
+def fetch_texts(documents):
+    # the pages of all the documents given by URL are downloaded concurrently, while the request thread waits
+    uris = [document['uri'] for document in documents if 'uri' in document]
+    fetched = iter(fetcher.fetch_texts(uris))
+    return [next(fetched) if 'uri' in document else document.get('text') for document in documents]
+
+@ns.route('/predict_batch', methods=['POST'])
+@api.doc(body=batch_fields)
+class predict_batch_route(Resource):
+    @ns.doc('predict_batch_route')
+    def post(self):
+        content = request.json
+        logging.debug(content)
+
+        language = content['language']
+        show_explanations = 'explain' in content and content['explain']
+        show_highlights = 'highlights' in content and content['highlights']
+        disallowed_rels = content['disallowed_rels'] if 'disallowed_rels' in content else args.disallowed_rels.split(';')
+        labels = content['labels']
+
+        texts = fetch_texts(content['documents'])
+        responses = predict_batch(texts, labels, language, disallowed_rels, show_explanations, show_highlights, args.preprocess_workers)
+
+        # results are in the order of the documents, with an error for the documents without a text
+        def results():
+            for index, (text, response) in enumerate(zip(texts, responses)):
+                if text is None:
+                    yield {"index": index, "error": "Could not fetch URL or missing text"}
+                else:
+                    yield {"index": index, "text": text, "results": response}
+
+        if content.get('stream', False):
+            return Response((json.dumps(result) + '\n' for result in results()), mimetype='application/x-ndjson')
+        return jsonify({
+            "labels": labels,
+            "results": list(results())
+        })
+
+
 @api.errorhandler
 def default_error_handler(error):
     return {'error': str(error)}, getattr(error, 'code', 500)
@@ -0,0 +1 @@
+../../store.py
\ No newline at end of file
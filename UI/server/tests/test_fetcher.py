@@ -0,0 +1,92 @@
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip('aiohttp')
+pytest.importorskip('trafilatura')
+from fetcher import Fetcher
+
+###
+#   The fetcher against a local stand-in of the sites: the pages that cannot be fetched within the
+#   limits are None, without failing the other pages of the batch
+###
+
+TIMEOUT = 0.5
+MAX_BYTES = 4096
+ARTICLE = ('<html><head><title>Orbit</title></head><body><article><h1>Orbit</h1>'
+           + '<p>The spacecraft entered the orbit of Mars after a seven month journey, and the agency released '
+             'the first images taken by its camera of the surface of the planet.</p>' * 3
+           + '</article></body></html>')
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path == '/slow':
+            time.sleep(3 * TIMEOUT)
+        if self.path == '/missing':
+            self.send_error(404)
+            return
+        body, content_type = ARTICLE.encode('utf-8'), 'text/html; charset=utf-8'
+        if self.path == '/bad-charset':
+            content_type = 'text/html; charset=foo'
+        elif self.path in ('/large', '/large-chunked'):
+            body = ARTICLE.encode('utf-8') * (MAX_BYTES // len(ARTICLE) + 1)
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        if self.path != '/large-chunked':
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except ConnectionError:
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope='module')
+def site():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def fetcher():
+    fetcher = Fetcher(timeout=TIMEOUT, max_bytes=MAX_BYTES)
+    yield fetcher
+    fetcher.close()
+
+
+def test_page(site, fetcher):
+    text = fetcher.fetch_text(site + '/page')
+    assert 'orbit of Mars' in text
+
+
+@pytest.mark.parametrize('path', ['/slow', '/missing', '/large', '/large-chunked'])
+def test_page_out_of_limits(site, fetcher, path):
+    assert fetcher.fetch_text(site + path) is None
+
+
+def test_unknown_charset(site, fetcher):
+    assert 'orbit of Mars' in fetcher.fetch_text(site + '/bad-charset')
+
+
+def test_batch(site, fetcher):
+    paths = ['/page', '/slow', '/bad-charset', '/missing', '/large', '/page']
+    texts = fetcher.fetch_texts([site + path for path in paths])
+    assert [text is not None for text in texts] == [True, False, True, False, False, True]
+
+
+def test_cache(site, fetcher):
+    fetcher.fetch_text(site + '/page')
+    fetcher.max_bytes = 0
+    assert 'orbit of Mars' in fetcher.fetch_text(site + '/page')
@@ -0,0 +1 @@
+../../tokenization.py
\ No newline at end of file
@@ -0,0 +1,200 @@
+import os
+import json
+import time
+import shutil
+import logging
+import argparse
+import itertools
+import tempfile
+import numpy as np
+import Levenshtein
+
+from store import StringTable, open_store, save_string_table, save_meta
+
+###
+#   Prefix index of the label autocompletion
+#
+#   Built offline from the vocabulary of a language (one word per line, e.g. the ConceptNet
+#   vocab.txt) and its neighborhood store, as a folder of memory-mapped arrays:
+#     words.bin, words_offsets.npy          sorted string table of the words
+#     ranks.npy                             degree of each word in the store (0 if it is not a node)
+#     prefixes.bin, prefixes_offsets.npy    sorted string table of the prefixes of more than LARGE_PREFIX words
+#     top.npy                               the TOP_SIZE best ranked words of each of these prefixes (-1 padded)
+#     meta.json                             format version and counts, written last
+#   The words starting with a query are a range of the sorted table, found by binary search, and
+#   are ranked by degree (the best ones of the large ranges are precomputed). When there are fewer
+#   than requested, they are followed by the words whose beginning is within `max_cost` edits of
+#   the query, among the words sharing a shorter prefix with it.
+###
+
+AUTOCOMPLETE_VERSION = 1
+TOP_SIZE = 32
+LARGE_PREFIX = 1024
+MAX_FUZZY_CANDIDATES = 20000
+
+CACHE_PATH = '/data/zeste_cache'
+VOCABULARIES = {'en': 'vocab.txt', 'fr': 'vocab_fr.txt'}
+
+
+def ranked(ranks, lo, hi, size):
+    # positions of the `size` best ranked words of [lo, hi), ties in the order of the words
+    return lo + np.argsort(-np.asarray(ranks[lo:hi]), kind='stable')[:size]
+
+
+def build_autocomplete_index(vocab_filepath, store_path, index_path):
+    with open(vocab_filepath, encoding='utf-8') as f:
+        words = sorted({line.strip() for line in f if line.strip()})
+
+    ranks = np.zeros(len(words), dtype=np.int32)
+    if os.path.exists(os.path.join(store_path, 'meta.json')):
+        store = open_store(store_path)
+        degrees = np.diff(store.indptr)
+        for i, word in enumerate(words):
+            node_id = store.node_id(word)
+            if node_id < 0:
+                node_id = store.node_id(word.replace(' ', '_'))
+            if node_id >= 0:
+                ranks[i] = degrees[node_id]
+    else:
+        logging.warning(f'No neighborhood store at {store_path}, the words are ranked alphabetically')
+
+    # prefixes of more than LARGE_PREFIX words, one character longer at every level (the words
+    # sharing a prefix are contiguous in the sorted vocabulary)
+    large = []
+    level = [(0, len(words))]
+    for n in itertools.count(1):
+        if not level:
+            break
+        next_level = []
+        for lo, hi in level:
+            start = lo
+            for prefix, group in itertools.groupby(words[lo:hi], key=lambda w: w[:n]):
+                end = start + sum(1 for _ in group)
+                if end - start > LARGE_PREFIX and len(prefix) == n:
+                    large.append((prefix, start, end))
+                    next_level.append((start, end))
+                start = end
+        level = next_level
+    large.sort()
+    top = np.full((len(large), TOP_SIZE), -1, dtype=np.int32)
+    for i, (_, lo, hi) in enumerate(large):
+        best = ranked(ranks, lo, hi, TOP_SIZE)
+        top[i, :len(best)] = best
+
+    os.makedirs(os.path.dirname(index_path.rstrip('/')) or '.', exist_ok=True)
+    tmp_path = tempfile.mkdtemp(prefix='.tmp-', dir=os.path.dirname(index_path.rstrip('/')) or '.')
+    save_string_table(tmp_path, 'words', words)
+    save_string_table(tmp_path, 'prefixes', [prefix for prefix, _, _ in large])
+    np.save(os.path.join(tmp_path, 'ranks.npy'), ranks)
+    np.save(os.path.join(tmp_path, 'top.npy'), top)
+    save_meta(tmp_path, {'version': AUTOCOMPLETE_VERSION, 'words': len(words), 'ranked': int(np.count_nonzero(ranks)),
+                         'prefixes': len(large), 'top_size': TOP_SIZE, 'large_prefix': LARGE_PREFIX})
+    # the processes still using the previous index keep their mappings of the removed files
+    if os.path.exists(index_path):
+        shutil.rmtree(index_path)
+    os.rename(tmp_path, index_path)
+    return len(words)
+
+
+class AutocompleteIndex:
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta.get('version') != AUTOCOMPLETE_VERSION:
+            raise ValueError(f'Unsupported autocomplete index version in {path}: {self.meta.get("version")}')
+        self.words = StringTable(path, 'words')
+        self.ranks = np.load(os.path.join(path, 'ranks.npy'), mmap_mode='r')
+        self.prefixes = StringTable(path, 'prefixes')
+        self.top = np.load(os.path.join(path, 'top.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.words)
+
+    def prefix_matches(self, prefix, size):
+        # positions of the `size` best ranked words starting with `prefix`
+        if size <= TOP_SIZE:
+            i = self.prefixes.index(prefix)
+            if i >= 0:
+                best = self.top[i, :size]
+                return best[best >= 0].tolist()
+        lo, hi = self.words.prefix_range(prefix)
+        return ranked(self.ranks, lo, hi, size).tolist()
+
+    def fuzzy_matches(self, query, size, max_cost, exclude=()):
+        # positions of the `size` words whose beginning is the closest to `query` (by number of
+        # edits, then rank), among the words sharing the longest prefixes with it
+        n = len(query)
+        candidates = []
+        visited = None
+        for k in range(n - 1, 0, -1):
+            lo, hi = self.words.prefix_range(query[:k])
+            if hi - lo > MAX_FUZZY_CANDIDATES:
+                break
+            # the range of a prefix contains the ranges of its extensions
+            positions = range(lo, hi) if visited is None else itertools.chain(range(lo, visited[0]), range(visited[1], hi))
+            for i in positions:
+                if i in exclude:
+                    continue
+                word = self.words[i]
+                cost = min(Levenshtein.distance(query, word[:m]) for m in (n - 1, n, n + 1))
+                if cost <= max_cost:
+                    candidates.append((cost, -int(self.ranks[i]), i))
+            visited = (lo, hi)
+            if len(candidates) >= size:
+                break
+        return [i for _, _, i in sorted(candidates)[:size]]
+
+    def search(self, word, max_cost=3, size=7):
+        # suggestions in the format of fast_autocomplete, a list of [word]
+        query = (word or '').strip().lower()
+        if not query:
+            return []
+        positions = self.prefix_matches(query, size)
+        if len(positions) < size and max_cost > 0:
+            positions += self.fuzzy_matches(query, size - len(positions), max_cost, set(positions))
+        return [[self.words[i]] for i in positions]
+
+
+def autocomplete_path(language, cache_path=CACHE_PATH):
+    return os.path.join(cache_path, 'autocomplete_' + language)
+
+
+def load_autocomplete(language, cache_path=CACHE_PATH):
+    # index of the vocabulary of `language`, built on the first start if it was not built offline,
+    # or None if there is no vocabulary
+    path = autocomplete_path(language, cache_path)
+    if not os.path.exists(os.path.join(path, 'meta.json')):
+        vocab_filepath = os.path.join(cache_path, VOCABULARIES[language])
+        if not os.path.exists(vocab_filepath):
+            return None
+        logging.warning(f'Building the autocomplete index of {vocab_filepath}, build it beforehand with vocabulary.py')
+        build_autocomplete_index(vocab_filepath, os.path.join(cache_path, 'neighborhoods_' + language), path)
+    return AutocompleteIndex(path)
+
+
+def load_autocompletes():
+    logging.info('Loading autocomplete vocabulary...')
+    return {language: load_autocomplete(language) for language in VOCABULARIES}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build the prefix indexes of the label autocompletion')
+    parser.add_argument('-c', '--cache_path', type=str, help='Path to the cache holding the vocabularies and neighborhood stores', default=CACHE_PATH)
+    parser.add_argument('-lg', '--languages', nargs='+', choices=list(VOCABULARIES), help='Languages of the vocabularies', default=list(VOCABULARIES))
+    parser.add_argument('-q', '--queries', nargs='+', help='Queries to try on the indexes once built', default=[])
+    args = parser.parse_args()
+
+    for language in args.languages:
+        started = time.time()
+        n = build_autocomplete_index(os.path.join(args.cache_path, VOCABULARIES[language]),
+                                     os.path.join(args.cache_path, 'neighborhoods_' + language), autocomplete_path(language, args.cache_path))
+        print(f'Indexed {n:,} words ({language}) in {time.time() - started:.1f}s')
+
+        autocomplete = AutocompleteIndex(autocomplete_path(language, args.cache_path))
+        for query in args.queries:
+            started = time.perf_counter()
+            suggestions = autocomplete.search(query)
+            elapsed = time.perf_counter() - started
+            print(f'{query!r}: {", ".join(s[0] for s in suggestions)} ({elapsed * 1e6:,.0f}µs)')
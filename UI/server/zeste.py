@@ -2,17 +2,26 @@ import os
 import json
 import pickle
 import logging
-from flask import jsonify
-from nltk.corpus import stopwords
-from nltk.stem import WordNetLemmatizer
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
 import nltk
 
+from store import open_store, save_dependencies
+from embeddings import load_embeddings
+from tokenization import preprocess
+from label_cache import LabelCache
+from label_index import LabelIndex, LabelSetIndex
 
 nltk.download('stopwords')
 nltk.download('wordnet')
 
-numberbatch_en = pickle.load(open("/data/zeste_cache/numberbatch-en-19.08.pickle", 'rb'))
-numberbatch_fr = pickle.load(open("/data/zeste_cache/numberbatch-fr-19.08.pickle", 'rb'))
+numberbatch_en = load_embeddings("/data/zeste_cache/numberbatch-en-19.08")
+numberbatch_fr = load_embeddings("/data/zeste_cache/numberbatch-fr-19.08")
+
+stores = {language: open_store('/data/zeste_cache/neighborhoods_' + language) for language in ['en', 'fr']}
+
+# label neighborhoods shared by the requests, bounded by their total number of nodes
+label_cache = LabelCache(int(os.getenv('ZESTE_LABEL_CACHE_SIZE', 5000000)))
 
 logging.info('Loading relations descriptions...')
 relations = {}
@@ -24,22 +33,11 @@ if os.path.exists(relations_filepath):
         items = line.strip().split('\t')
         relations[items[0].strip()] = items[1].strip()
 
-def preprocess(doc, language='en'):
-    lemmatizer = WordNetLemmatizer()
-
-    doc = doc.replace("'ll", ' will').replace("s' ", 's').replace("'s", '').replace("-", '_')
-    doc = ''.join(c for c in doc if c not in '!"#$%&\'()*+,./:;<=>?@[\\]^`{|}~')
-    tokens = [w for w in doc.lower().split(' ') if w not in stopwords.words('english' if language == 'en' else 'french')]
-    if language == 'en':
-        tokens = [lemmatizer.lemmatize(w) for w in tokens if w != '']
-    else:
-        tokens = [w for w in tokens if w != '']
-
-    return tokens
-
-
-def get_word_neighborhood(word, depth=2, allowed_rels='all', disallowed_rels=[], language='en'):
-    neighborhood = pickle.load(open('/data/zeste_cache/neighborhoods_'+language+'/'+word+'.pickle', 'rb'))
+def get_word_neighborhood(word, depth=2, allowed_rels='all', disallowed_rels=[], language='en', visited=None):
+    # `visited` collects the words whose 1-hop neighborhood is read
+    if visited is not None:
+        visited.add(word)
+    neighborhood = stores[language].neighborhood(word)
     neighborhood_words = list(neighborhood.keys())
 
     if allowed_rels != 'all':
@@ -51,26 +49,35 @@ def get_word_neighborhood(word, depth=2, allowed_rels='all', disallowed_rels=[],
             for rel in disallowed_rels:
                 if rel in neighborhood[n]['rels']:
                     del neighborhood[n]
+                    break
 
+    # best predecessor of each node on its way to `word` (relation, via node), the direct
+    # neighbors are reached from `word` itself, the other nodes through their most similar neighbor
+    for n in neighborhood:
+        neighborhood[n]['paths'] = {word: (neighborhood[n]['rels'][-1], word)}
 
     to_visit_next = list(neighborhood.keys())
     while depth > 1:
         additions = []
         while len(to_visit_next) > 0:
             w = to_visit_next.pop()
-            nn = get_word_neighborhood(w, depth=1, allowed_rels=allowed_rels, disallowed_rels=disallowed_rels, language=language)
+            nn = get_word_neighborhood(w, depth=1, allowed_rels=allowed_rels, disallowed_rels=disallowed_rels, language=language, visited=visited)
             for ww in nn:
                 if ww in neighborhood:
                     neighborhood[ww]['from'].append(w)
                     neighborhood[ww]['rels'].extend(['<>'] + nn[ww]['rels'])
+                    _, via = neighborhood[ww]['paths'][word]
+                    if via != word and neighborhood[w]['sim'] > neighborhood[via]['sim']:
+                        neighborhood[ww]['paths'][word] = (nn[ww]['rels'][-1], w)
                 else:
                     neighborhood[ww] = {}
                     neighborhood[ww]['from'] = [w]
                     neighborhood[ww]['rels'] = nn[ww]['rels']
+                    neighborhood[ww]['paths'] = {word: (nn[ww]['rels'][-1], w)}
                     if (language == 'en' and word in numberbatch_en and ww in numberbatch_en):
                         neighborhood[ww]['sim'] = numberbatch_en.similarity(word, ww)
-                    elif (language == 'fr' and '/c/fr/'+word in numberbatch_fr and '/c/fr/'+ww in numberbatch_fr):
-                        neighborhood[ww]['sim'] = numberbatch_fr.similarity('/c/fr/'+word, '/c/fr/'+ww)
+                    elif (language == 'fr' and word in numberbatch_fr and ww in numberbatch_fr):
+                        neighborhood[ww]['sim'] = numberbatch_fr.similarity(word, ww)
                     else:
                         neighborhood[ww]['sim'] = 0.0
                     additions.append(ww)
@@ -81,14 +88,14 @@ def get_word_neighborhood(word, depth=2, allowed_rels='all', disallowed_rels=[],
 
 
 
-def get_words_neighborhood(words, depth=2, allowed_rels='all', disallowed_rels=[], language = 'en', keep='top20000'):
+def get_words_neighborhood(words, depth=2, allowed_rels='all', disallowed_rels=[], language = 'en', keep='top20000', visited=None):
     words = words.split('-')
     if len(words) > 50:
         raise Exception('Too many topic labels')
 
     ns = []
     for word in words:
-        ns.append(get_word_neighborhood(word, depth=depth, allowed_rels=allowed_rels, disallowed_rels=disallowed_rels, language=language))
+        ns.append(get_word_neighborhood(word, depth=depth, allowed_rels=allowed_rels, disallowed_rels=disallowed_rels, language=language, visited=visited))
     neighborhood = ns[0].copy()
 
     for w, nn in zip(words[1:], ns[1:]):
@@ -97,82 +104,131 @@ def get_words_neighborhood(words, depth=2, allowed_rels='all', disallowed_rels=[
                 neighborhood[ww]['from'].append(w)
                 neighborhood[ww]['rels'].extend(['<>'] + nn[ww]['rels'])
                 neighborhood[ww]['sim'] = max(neighborhood[ww]['sim'], nn[ww]['sim'])
+                neighborhood[ww]['paths'].update(nn[ww]['paths'])
             else:
                 neighborhood[ww] = {}
                 neighborhood[ww]['from'] = [w]
                 neighborhood[ww]['rels'] = nn[ww]['rels']
                 neighborhood[ww]['sim']  = nn[ww]['sim']
+                neighborhood[ww]['paths'] = nn[ww]['paths']
 
     return neighborhood
 
-def generate_label_neighborhoods(labels_list, language, disallowed_rels):
+# bumped whenever the structure of the cached label neighborhoods changes (2: explanation paths)
+DEMO_CACHE_VERSION = 2
+demo_cache_path = '/data/zeste_cache/demo_cache/v' + str(DEMO_CACHE_VERSION) + '/'
+
+def forget_labels(names):
+    # drops the label neighborhoods, and the label sets including them, whose cache entry was
+    # removed or rewritten since they were loaded
+    names = set(names)
+    def changed(label, language, disallowed_rels):
+        return label_entry_name(label, language, disallowed_rels) in names
+    forgotten = label_cache.discard(lambda key: changed(*key))
+    forgotten_sets = label_set_cache.discard(lambda key: any(changed(label, key[1], key[2]) for label in key[0]))
+    logging.info(f'{len(names)} cached label neighborhoods changed, {forgotten} labels and {forgotten_sets} label sets dropped from memory')
+
+# inverted index of the cached label neighborhoods, brought up to date at startup and whenever the
+# cache changes
+label_index = LabelIndex(demo_cache_path.rstrip('/') + '_index/', demo_cache_path, on_change=forget_labels)
+label_index.update()
+
+def label_entry_name(label, language, disallowed_rels):
     disallowed_rels_string = ""
     if len(disallowed_rels) > 0:
         disallowed_rels_string += "_" + "-".join(sorted(disallowed_rels))
+    return label + disallowed_rels_string + ('' if language == 'en' else '_fr')
+
+def label_path(label, language, disallowed_rels):
+    return demo_cache_path + label_entry_name(label, language, disallowed_rels) + '.pickle'
+
+def build_label_neighborhood(label, language, disallowed_rels):
+    # generates the neighborhood of the label and saves it in the demo cache
+    path = label_path(label, language, disallowed_rels)
+    visited = set()
+    neighborhood = get_words_neighborhood(label, depth=2, allowed_rels='all', disallowed_rels=disallowed_rels, language=language, visited=visited)
+    os.makedirs(demo_cache_path, exist_ok=True)
+    save_dependencies(path, visited)
+    # written under another name first, so that the label index never reads a partial pickle
+    tmp_path = path[:-len('.pickle')] + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(neighborhood, f)
+    os.replace(tmp_path, path)
+    return neighborhood
+
+def load_label_neighborhood(label, language, disallowed_rels):
+    path = label_path(label, language, disallowed_rels)
+    if os.path.exists(path):
+        logging.info('Loading cached neighborhood for the label "'+ label +'"')
+        return pickle.load(open(path, 'rb'))
+    logging.info('Generating neighborhood for the label "'+ label +'"')
+    neighborhood = build_label_neighborhood(label, language, disallowed_rels)
+    label_index.schedule_update()
+    return neighborhood
+
+
+def generate_label_neighborhoods(labels_list, language, disallowed_rels):
     label_neighborhoods = {}
     for label in labels_list:
-        path = '/data/zeste_cache/demo_cache/'+label + disallowed_rels_string + ('.pickle' if  language == 'en' else '_fr.pickle')
-        if os.path.exists(path):
-            logging.info('Loading cached neighborhood for the label "'+ label +'"')
-            label_neighborhoods[label] = pickle.load(open(path, 'rb'))
-        else:
-            logging.info('Generating neighborhood for the label "'+ label +'"')
-            label_neighborhoods[label] = get_words_neighborhood(label, depth=2, allowed_rels='all', disallowed_rels=disallowed_rels, language=language)
-            pickle.dump(label_neighborhoods[label], open(path, 'wb'))
+        key = (label, language, tuple(sorted(disallowed_rels)))
+        label_neighborhoods[label] = label_cache.get(key, lambda: load_label_neighborhood(label, language, disallowed_rels))
     return label_neighborhoods
 
 
 
-def find_best_path(word, label, label_neighborhood, language):
+def find_best_path(word, label, label_neighborhood):
     if word == label:
         return (word, 'is_label')
 
-    if label in label_neighborhood[word]['from']:
-        return (word, label_neighborhood[word]['rels'][-1], label)
-
-    for ww in label_neighborhood[word]['from']:
-        paths = []
-        word_path = '/data/zeste_cache/demo_cache/'+ww+ ('.pickle' if language=='en' else '_fr.pickle')
-        if label in label_neighborhood[ww]['from'] and os.path.exists(word_path):
-            nw = pickle.load(open(word_path, 'rb'))
-            if word in nw:
-                return (word, nw[word]['rels'][-1], ww, label_neighborhood[ww]['rels'][-1], label)
-            else:
-                return  None
-
-
-def get_document_score_and_explain(doc, labels, label_neighborhood, language, show_explanations):
-    tokens = preprocess(doc, language)
-    related_words = []
-    score = 0
-    for token in tokens:
-        if token in label_neighborhood:
-            similarity = label_neighborhood[token]['sim']
-            if similarity > 0:
-                related_words.append((token, similarity))
-                score += similarity
-
+    if label not in label_neighborhood[word]['paths']:
+        return None
+
+    rel, via = label_neighborhood[word]['paths'][label]
+    if via == label:
+        return (word, rel, label)
+    via_rel, _ = label_neighborhood[via]['paths'][label]
+    return (word, rel, via, via_rel, label)
+
+
+# combined indexes of the label sets of the requests, bounded by their total number of entries
+label_set_cache = LabelCache(int(os.getenv('ZESTE_LABEL_SET_CACHE_SIZE', 5000000)))
+
+def get_label_set(labels_list, language, disallowed_rels, show_explanations):
+    # the labels are scored from the label index when they are all in it, their neighborhoods are
+    # then only loaded for the explanations, otherwise from a combined index of their neighborhoods
+    labels = list(dict.fromkeys(labels_list))
+    generation = label_index.current()
+    index = None
+    if generation is not None:
+        index = generation.label_set(labels, [label_entry_name(label, language, disallowed_rels) for label in labels])
+    lns = None
+    if index is None or show_explanations:
+        lns = generate_label_neighborhoods(labels, language, disallowed_rels)
+    if index is None:
+        key = (tuple(lns), language, tuple(sorted(disallowed_rels)))
+        index = label_set_cache.get(key, lambda: LabelSetIndex(lns))
+    return lns, index
+
+
+def explain(related_words, labels, label_neighborhood):
     if '-' not in labels:
         labels = [labels]
     else:
         labels = labels.split('-')
 
     explanation = []
+    for label in labels:
+        for word, similarity in related_words:
+            best_path = find_best_path(word, label, label_neighborhood)
+            if best_path:
+                explanation.append((best_path, similarity))
+        explanation = list(set(explanation))
 
-    if show_explanations:
-        for label in labels:
-            for word, similarity in related_words:
-                best_path = find_best_path(word, label, label_neighborhood, language)
-                if best_path:
-                    explanation.append((best_path, similarity))
-            explanation = list(set(explanation))
-
-    return score, sorted(explanation, key=lambda t: -t[1])
+    return sorted(explanation, key=lambda t: -t[1])
 
 
-def generate_json(explanation, doc, labels_neighborhoods, language, show_highlights=True):
+def generate_json(explanation, highlights=None):
     response = []
-    tokens = preprocess(doc, language)
     for label in explanation:
         d = {'label': label, 'score': float(explanation[label][0]), 'terms':[]}
 
@@ -184,9 +240,8 @@ def generate_json(explanation, doc, labels_neighborhoods, language, show_highlig
             elif len(path) == 5:
                 d['terms'].append({'paths':[[path[0], relations[path[1]], path[2]], [path[2], relations[path[3]], path[4]]], 'score': float(score)})
 
-        if show_highlights:
-            ln = labels_neighborhoods[label]
-            d['highlights'] = [[t,str(-1 if t not in ln else ln[t]['sim'])] for t in tokens]
+        if highlights is not None:
+            d['highlights'] = highlights[label]
 
         response.append(d)
 
@@ -198,13 +253,51 @@ def generate_json(explanation, doc, labels_neighborhoods, language, show_highlig
     return response
 
 
-def predict(doc, labels_list, language, disallowed_rels, show_explanations=False, show_highlights=True):
-    global numberbatch
-    numberbatch = numberbatch_fr if language == 'fr' else numberbatch_en
-    lns = generate_label_neighborhoods(labels_list, language, disallowed_rels)
+def predict_tokens(tokens, lns, index, show_explanations, show_highlights):
+    # the tokens are scored against all the labels at once, the explanations and highlights are
+    # built from the related words found along the way
+    scores, related_words, highlights = index.score(tokens, show_highlights)
     res = {}
-    for label in lns:
-        res[label] = get_document_score_and_explain(doc, label, lns[label], language, show_explanations)
+    for k, label in enumerate(index.labels):
+        res[label] = (scores[k], explain(related_words[k], label, lns[label]) if show_explanations else [])
 
-    explanation_json = generate_json(res, doc, lns, language, show_highlights)
-    return explanation_json
\ No newline at end of file
+    return generate_json(res, dict(zip(index.labels, highlights)) if show_highlights else None)
+
+
+def predict(doc, labels_list, language, disallowed_rels, show_explanations=False, show_highlights=True):
+    lns, index = get_label_set(labels_list, language, disallowed_rels, show_explanations)
+    return predict_tokens(preprocess(doc, language), lns, index, show_explanations, show_highlights)
+
+
+# documents are preprocessed in worker processes when a batch is large enough to amortize the transfers
+preprocess_pool = None
+MIN_PARALLEL_BATCH = 16
+
+def start_preprocess_pool(workers):
+    # forks the preprocessing processes right away: it must be called at startup, before the server
+    # starts other threads (request handlers, fetcher, label index updates), as a process forked
+    # later could inherit a lock held by one of them
+    global preprocess_pool
+    if workers > 1:
+        preprocess_pool = ProcessPoolExecutor(workers, mp_context=mp.get_context('fork'))
+        preprocess_pool.submit(len, '').result()
+
+def preprocess_batch(docs, language, workers):
+    if preprocess_pool is None or workers <= 1 or len(docs) < MIN_PARALLEL_BATCH:
+        return (preprocess(doc, language) for doc in docs)
+    chunksize = max(1, len(docs) // (4 * workers))
+    return preprocess_pool.map(preprocess, docs, [language] * len(docs), chunksize=chunksize)
+
+
+def predict_batch(docs, labels_list, language, disallowed_rels, show_explanations=False, show_highlights=True, workers=1):
+    # the label neighborhoods are loaded once for the whole batch, the results are yielded in the
+    # order of `docs` as soon as each document is scored (None documents are yielded as None)
+    lns, index = get_label_set(labels_list, language, disallowed_rels, show_explanations)
+    texts = [doc for doc in docs if doc is not None]
+    tokens = preprocess_batch(texts, language, workers)
+
+    def results():
+        for doc in docs:
+            yield None if doc is None else predict_tokens(next(tokens), lns, index, show_explanations, show_highlights)
+
+    return results()
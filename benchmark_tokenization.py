@@ -0,0 +1,65 @@
+import time
+import argparse
+import pandas as pd
+import nltk
+from nltk.corpus import stopwords
+from nltk.stem import WordNetLemmatizer
+
+from tokenization import preprocess
+
+###
+#   Micro-benchmark of the documents preprocessing: the former implementation (rebuilding the
+#   stopwords list for every token and stripping punctuation character by character) against
+#   the one of tokenization.py
+###
+
+SAMPLE = ("A NASA spacecraft set a new milestone Monday in cosmic exploration by entering orbit around an asteroid, "
+          "Bennu, the smallest object ever to be circled by a human-made spaceship. The spacecraft, called OSIRIS-REx, "
+          "is the first-ever US mission designed to visit an asteroid and return a sample of its dust back to Earth.. "
+          "It's expected that they'll reach the asteroid's surface in the summer; the scientists' hopes are high! ")
+
+
+lemmatizer = WordNetLemmatizer()
+def preprocess_reference(document):
+    document = document.replace("'ll", ' will').replace("s' ", 's').replace("'s", '').replace("-", '_')
+    document = ''.join(c for c in document if c not in '!"#$%&\'()*+,./:;<=>?@[\\]^`{|}~')
+    document = [w for w in document.lower().split(' ') if w not in stopwords.words('english')]
+    document = [lemmatizer.lemmatize(w) for w in document if w != '']
+    return document
+
+
+def run(function, documents):
+    started = time.perf_counter()
+    tokens = [function(d) for d in documents]
+    elapsed = time.perf_counter() - started
+    return tokens, elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Tokenization micro-benchmark')
+    parser.add_argument('-dp', '--dataset_path', type=str, help="Path to a dataset CSV file with a `text` column (a sample text is used otherwise)", default=None)
+    parser.add_argument('-nd', '--num_documents', type=int, help="Number of documents to preprocess", default=1000)
+    args = parser.parse_args()
+
+    nltk.download('stopwords', quiet=True)
+    nltk.download('wordnet', quiet=True)
+    nltk.download('omw-1.4', quiet=True)
+
+    if args.dataset_path is not None:
+        documents = pd.read_csv(args.dataset_path).text.tolist()[:args.num_documents]
+    else:
+        documents = [SAMPLE * 4] * args.num_documents
+
+    # warm up nltk's lazy corpus loaders so that neither implementation pays for them
+    preprocess_reference(SAMPLE)
+    preprocess(SAMPLE)
+
+    before, before_time = run(preprocess_reference, documents)
+    after, after_time = run(preprocess, documents)
+    assert before == after, 'The two implementations disagree'
+
+    n_tokens = sum(len(t) for t in after)
+    print(f'{len(documents)} documents, {n_tokens} tokens')
+    print(f'before: {before_time:.3f}s ({n_tokens / before_time:,.0f} tokens/s)')
+    print(f'after:  {after_time:.3f}s ({n_tokens / after_time:,.0f} tokens/s)')
+    print(f'speedup: x{before_time / after_time:.1f}')
@@ -0,0 +1,116 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+import pandas as pd
+import multiprocessing as mp
+from functools import partial
+
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from store import StringTable, save_string_table, save_meta
+from tokenization import PREPROCESSING_VERSION, get_stopwords, preprocess
+
+###
+#   Persistent cache of the preprocessed datasets
+#
+#   A dataset is preprocessed once and stored in a folder named after the dataset and a hash of
+#   everything its preprocessing depends on (content of the dataset file, preprocessing version,
+#   language, stopwords, n-grams extraction):
+#     vocabulary.bin, vocabulary_offsets.npy    sorted string table of the tokens
+#     token_ids.npy                             token ids of all the documents, concatenated
+#     indptr.npy                                document i spans token_ids[indptr[i]:indptr[i + 1]]
+#     ngrams.bin, ngrams_offsets.npy            multiword n-grams of the corpus (space-separated)
+#     meta.json                                 the inputs behind the hash, written last
+#   The folder is written under a temporary name and renamed once complete.
+###
+
+CORPUS_VERSION = 1
+NGRAM_RANGE = (1, 3)
+NGRAM_MIN_DF = 2
+
+
+def preprocess_corpus(raw_corpus, language='en', workers=mp.cpu_count()):
+    with mp.Pool(processes=workers) as pool:
+        return pool.map(partial(preprocess, language=language), raw_corpus)
+
+
+def extract_ngrams(documents):
+    # multiword n-grams of up to 3 words appearing in at least 2 documents
+    ngram_counter = TfidfVectorizer(ngram_range=NGRAM_RANGE, min_df=NGRAM_MIN_DF)
+    ngram_counter.fit([' '.join(d) for d in documents])
+    print('ngrams count:', len(ngram_counter.vocabulary_.keys()))
+    return [w for w in ngram_counter.vocabulary_.keys() if ' ' in w]
+
+
+def file_hash(path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def corpus_config(dataset_path, language):
+    return {'format': CORPUS_VERSION, 'preprocessing': PREPROCESSING_VERSION, 'dataset': file_hash(dataset_path),
+            'language': language, 'ngram_range': list(NGRAM_RANGE), 'ngram_min_df': NGRAM_MIN_DF,
+            'stopwords': hashlib.sha1('\n'.join(sorted(get_stopwords(language))).encode('utf-8')).hexdigest()}
+
+
+class PreprocessedCorpus:
+    # Sequence of the token lists of the documents, read from the cache
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.vocabulary = list(StringTable(path, 'vocabulary'))
+        self.token_ids = np.load(os.path.join(path, 'token_ids.npy'), mmap_mode='r')
+        self.indptr = np.load(os.path.join(path, 'indptr.npy'))
+        self.ngrams = list(StringTable(path, 'ngrams'))
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def __getitem__(self, i):
+        return [self.vocabulary[t] for t in self.token_ids[self.indptr[i]:self.indptr[i + 1]]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def save_corpus(path, documents, ngrams, config):
+    vocabulary = sorted({t for d in documents for t in d})
+    ids = {w: i for i, w in enumerate(vocabulary)}
+    indptr = np.zeros(len(documents) + 1, dtype=np.int64)
+    np.cumsum([len(d) for d in documents], out=indptr[1:])
+    token_ids = np.fromiter((ids[t] for d in documents for t in d), dtype=np.int32, count=int(indptr[-1]))
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = tempfile.mkdtemp(prefix='.tmp-', dir=os.path.dirname(path) or '.')
+    try:
+        save_string_table(tmp_path, 'vocabulary', vocabulary)
+        save_string_table(tmp_path, 'ngrams', sorted(ngrams))
+        np.save(os.path.join(tmp_path, 'token_ids.npy'), token_ids)
+        np.save(os.path.join(tmp_path, 'indptr.npy'), indptr)
+        save_meta(tmp_path, dict(config, documents=len(documents), tokens=int(indptr[-1]), vocabulary=len(vocabulary), ngrams=len(ngrams)))
+        os.rename(tmp_path, path)
+    except OSError:
+        # the same corpus was saved concurrently by another run
+        shutil.rmtree(tmp_path)
+        if not os.path.exists(os.path.join(path, 'meta.json')):
+            raise
+
+
+def load_corpus(dataset_path, cache_path, language='en', workers=mp.cpu_count()):
+    # preprocessed `text` column of the dataset, from the cache when it has already been preprocessed
+    config = corpus_config(dataset_path, language)
+    key = hashlib.sha1(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+    path = os.path.join(cache_path, f'{os.path.basename(dataset_path)}-{key}')
+    if not os.path.exists(os.path.join(path, 'meta.json')):
+        documents = preprocess_corpus(pd.read_csv(dataset_path).text.tolist(), language, workers)
+        save_corpus(path, documents, extract_ngrams(documents), config)
+    return PreprocessedCorpus(path)
@@ -0,0 +1,134 @@
+import os
+import json
+import pickle
+import hashlib
+import argparse
+import numpy as np
+from tqdm import tqdm
+
+from store import StringTable, save_string_table
+
+###
+#   Memory-mapped Numberbatch
+#
+#   An embeddings directory holds:
+#     vocab.bin / vocab_offsets.npy     sorted vocabulary (row i of the matrix is the i-th word)
+#     vectors.npy                       float16 or float32 matrix of L2-normalized rows
+#     meta.json                         format version, shape, dtype and vocabulary fingerprint
+#
+#   The matrix is memory-mapped read-only, so loading is near-instant and every process that
+#   loads the same files shares the same physical pages.
+###
+
+EMBEDDINGS_VERSION = 1
+
+
+def normalize_rows(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.
+    return (vectors / norms).astype(np.float32)
+
+
+def sort_vocabulary(words, vectors):
+    order = sorted(range(len(words)), key=words.__getitem__)
+    return [words[i] for i in order], normalize_rows(np.asarray(vectors)[order])
+
+
+def keyed_vectors_words(keyed_vectors):
+    # gensim >= 4 renamed index2word to index_to_key
+    if hasattr(keyed_vectors, 'index_to_key'):
+        return list(keyed_vectors.index_to_key)
+    return list(keyed_vectors.index2word)
+
+
+def read_word2vec(path, prefix=None):
+    # Reads a word2vec text file, optionally keeping only (and stripping) the words starting with `prefix`
+    with open(path, 'r', encoding='utf-8') as f:
+        n, dim = map(int, f.readline().split())
+        words = []
+        vectors = np.zeros((n, dim), dtype=np.float32)
+        for line in tqdm(f, total=n):
+            word, values = line.rstrip().split(' ', 1)
+            if prefix is not None:
+                if not word.startswith(prefix):
+                    continue
+                word = word[len(prefix):]
+            vectors[len(words)] = np.array(values.split(' '), dtype=np.float32)
+            words.append(word)
+    return words, vectors[:len(words)]
+
+
+def save_embeddings(path, words, vectors, dtype=np.float32):
+    # `words` must be sorted and `vectors` normalized (see sort_vocabulary)
+    os.makedirs(path, exist_ok=True)
+    save_string_table(path, 'vocab', words)
+    np.save(os.path.join(path, 'vectors.npy'), np.asarray(vectors, dtype=dtype))
+    with open(os.path.join(path, 'vocab.bin'), 'rb') as f:
+        fingerprint = hashlib.sha1(f.read()).hexdigest()
+    meta = {'version': EMBEDDINGS_VERSION, 'words': len(words), 'dim': int(np.shape(vectors)[1]),
+            'dtype': np.dtype(dtype).name, 'fingerprint': fingerprint}
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2, sort_keys=True)
+    return meta
+
+
+class Embeddings:
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta.get('version') != EMBEDDINGS_VERSION:
+            raise ValueError(f'Unsupported embeddings version in {path}: {self.meta.get("version")}')
+        self.fingerprint = self.meta['fingerprint']
+        self.vocab = StringTable(path, 'vocab')
+        self.vectors = np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.vocab)
+
+    def __contains__(self, word):
+        return self.vocab.index(word) >= 0
+
+    def index(self, word):
+        i = self.vocab.index(word)
+        if i < 0:
+            raise KeyError(f"Key '{word}' not present")
+        return i
+
+    def vector(self, word):
+        return np.asarray(self.vectors[self.index(word)], dtype=np.float32)
+
+    def similarity(self, w1, w2):
+        return np.float32(np.dot(self.vector(w1), self.vector(w2)))
+
+
+_embeddings = {}
+def load_embeddings(path):
+    path = os.path.abspath(path)
+    if path not in _embeddings:
+        _embeddings[path] = Embeddings(path)
+    return _embeddings[path]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert Numberbatch into memory-mapped embeddings')
+    parser.add_argument('-i', '--numberbatch_path', type=str, help="Path to the W2V text file or to the pickled Gensim Numberbatch", required=True)
+    parser.add_argument('-o', '--embeddings_path', type=str, help="Path to the folder where the embeddings will be saved", required=True)
+    parser.add_argument('-p', '--prefix', type=str, help="Only keep the words starting with this prefix, and strip it (e.g. `/c/fr/`)", default=None)
+    parser.add_argument('-t', '--dtype', type=str, choices=['float16', 'float32'], default='float32')
+    args = parser.parse_args()
+
+    print('Loading Numberbatch..')
+    if args.numberbatch_path.endswith('.pickle'):
+        numberbatch = pickle.load(open(args.numberbatch_path, 'rb'))
+        words, vectors = keyed_vectors_words(numberbatch), numberbatch.vectors
+        if args.prefix is not None:
+            kept = [i for i, w in enumerate(words) if w.startswith(args.prefix)]
+            words, vectors = [words[i][len(args.prefix):] for i in kept], vectors[kept]
+    else:
+        words, vectors = read_word2vec(args.numberbatch_path, args.prefix)
+
+    words, vectors = sort_vocabulary(words, vectors)
+    save_embeddings(args.embeddings_path, words, vectors, args.dtype)
+    print('Embeddings saved at', args.embeddings_path)
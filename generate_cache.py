@@ -1,71 +1,24 @@
 import os
+import time
+import zlib
+import uuid
 import pickle
+import shutil
 import argparse
-import hashlib
-import pandas as pd
+import tempfile
+import numpy as np
+import multiprocessing as mp
 from tqdm import tqdm
-from pprint import pprint
-import gensim.downloader as api
 from gensim.models import KeyedVectors
 
-###
-#   Parsing Arguments
-###
-
-parser = argparse.ArgumentParser(description='Zero-Shot Topic Extraction')
-
-parser.add_argument("-cnp", "--conceptnet_assertions_path", type=str, help="Path to CSV file containing ConceptNet assertions dump", default='conceptnet-assertions-5.7.0.csv')
-parser.add_argument("-nbp", "--conceptnet_numberbatch_path", type=str, help="Path to W2V file for ConceptNet Numberbatch",  default='numberbatch-en-19.08.txt')
-parser.add_argument("-zcp", "--zeste_cache_path", type=str, help="Path to the repository where the generated files will be saved", default='zeste_cache/')
-
-args = parser.parse_args()
-
-
-###
-#   Loading & Preprocessing Data
-###
+from store import STORE_VERSION, create_array, save_string_table, save_relations, save_meta, hash_names
+from embeddings import keyed_vectors_words, sort_vocabulary, save_embeddings
 
 # wget https://s3.amazonaws.com/conceptnet/downloads/2019/edges/conceptnet-assertions-5.7.0.csv.gz
 # gzip -d conceptnet-assertions-5.7.0.csv.gz
 # wc -l conceptnet-assertions-5.7.0.csv
 # wget https://conceptnet.s3.amazonaws.com/downloads/2019/numberbatch/numberbatch-19.08.txt.gz
 
-
-if not os.path.exists(args.zeste_cache_path):
-    print('Caching folder (', args.zeste_cache_path,') not found.. creating it now.')
-    os.makedirs(args.zeste_cache_path, exist_ok=True)
-
-
-data = []
-print('Reading ConceptNet assertions..')
-with open(args.conceptnet_assertions_path, 'r') as f:
-    for line in f:
-        triplet, rel, sub, obj, info = line.split('\t')
-        data.append((sub, rel, obj))
-        # if len(data) == 30000: break
-
-cn = pd.DataFrame(data=data, columns=['subject', 'relation', 'object'])
-# cn.to_csv('conceptnet_5.7.0.csv')
-
-print('Loading ConceptNet assertions..')
-data_en = []
-for i, triplet in tqdm(cn.iterrows(), total=len(cn)):
-    lang = triplet.subject.split('/')[2]
-    if lang == 'en':
-        sub = triplet.subject.split('/')[3]
-        obj = triplet.object.split('/')[3]
-        rel = '/'.join([w.lower() for w in triplet.relation.split('/')[2:]])
-        data_en.append((sub, rel, obj))
-
-# cn_en = pd.DataFrame(data=data_en, columns=['subject', 'relation', 'object'])
-
-print('Loading Numberbatch embeddings (may take some time)..')
-numberbatch = KeyedVectors.load_word2vec_format(args.conceptnet_numberbatch_path)
-
-numberbatch_cache_path = os.path.join(args.zeste_cache_path, args.conceptnet_numberbatch_path.split('/')[-1].replace('.txt', '') +'.pickle')
-pickle.dump(numberbatch, open(numberbatch_cache_path, 'wb'))
-print('Saving the pickled Numberbatch into', numberbatch_cache_path)
-
 reverse_rels = { 'antonym': 'antonym',
                  'atlocation': 'locatedat',
                  'capableof': 'doableby',
@@ -114,38 +67,304 @@ reverse_rels = { 'antonym': 'antonym',
                  'dbpedia/occupation': 'dbpedia/occupation',
                  'dbpedia/product': 'dbpedia/product'}
 
-data_rev = set()
+relations = sorted(set(reverse_rels) | set(reverse_rels.values()) | {'sameas'})
+relation_ids = {r: i for i, r in enumerate(relations)}
 
-print('Adding reverse relations to the graph if absent..')
-for s, r, o in tqdm(data_en):
+
+###
+#   Streaming ingest
+#
+#   1. the assertions file is split into byte ranges that are parsed by a pool of workers, which keep
+#      the triples of the target language, add their reverse and hash-partition them by subject
+#   2. each partition is deduplicated and grouped by subject, which gives the node table
+#   3. each partition is turned into a shard of edges (node ids, relations, similarities)
+#   4. the shards are written in parallel at their place in the memory-mapped store arrays
+###
+
+def split_file(path, chunk_size):
+    # byte ranges of about `chunk_size` bytes, aligned on line boundaries
+    size = os.path.getsize(path)
+    ranges = []
+    with open(path, 'rb') as f:
+        start = 0
+        while start < size:
+            f.seek(min(start + chunk_size, size))
+            f.readline()
+            end = min(f.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def partition_path(tmp_path, p):
+    return os.path.join(tmp_path, f'part-{p:04d}')
+
+
+def parse_assertion(line, prefix):
+    # (subject, relation, object) of an assertion line whose subject has the `prefix` language, or None
+    _, rel, sub, obj, _ = line.split('\t')
+    if not sub.startswith(prefix):
+        return None
+    r = '/'.join([w.lower() for w in rel.split('/')[2:]])
     if r == 'externalurl':
-        continue
-    data_rev.add((s, r, o))
-    data_rev.add((o, reverse_rels[r], s))
-
-cn_en_all = pd.DataFrame(data=sorted(data_rev, key=lambda x: x[0]), columns=['subject', 'relation', 'object'])
-current = '0'
-neighbors = {current: {'rels':['sameas'], 'sim': 1., 'from': [current]}}
-
-for i, e in tqdm(cn_en_all.iterrows(), total=len(cn_en_all)):
-    s, r, o = e['subject'], e['relation'], e['object']
-    assert(type(s) == str and type(s) == str)
-    if s != current:
-        try:
-            filename = current + '.pickle'
-            filepath = os.path.join(args.zeste_cache_path, hashlib.md5(filename.encode('utf-8')).hexdigest()[:2])
-            os.makedirs(filepath, exist_ok=True)
-            pickle.dump(neighbors, open(os.path.join(filepath, filename), 'wb'))
-        except Exception as e:
-            print(f'Exception at word "{current}":', str(e))
-        # print(current, "'s neighborhood:")
-        # pprint(neighbors)
-        current = s
-        neighbors = {current: {'rels':['sameas'], 'sim': 1., 'from': [current]}}
-
-    if o not in neighbors: # adding a new neighbor to the neighborhood
-        neighbors[o] = {'rels':[r], 'sim': 0., 'from': [s]}
-        if s in numberbatch and o in numberbatch:
-            neighbors[o]['sim'] = numberbatch.similarity(s, o)
-    else: # already encountered this neighnor from a previous relation
-        neighbors[o]['rels'].append(r)
\ No newline at end of file
+        return None
+    return sub.split('/')[3], r, obj.split('/')[3]
+
+
+def parse_chunk(task):
+    path, chunk_id, start, end, language, tmp_path, n_partitions = task
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start).decode('utf-8')
+
+    prefix = '/c/' + language + '/'
+    partitions = [[] for _ in range(n_partitions)]
+    n_lines = n_triples = 0
+    # split on '\n' only, like split_file: splitlines() would also split on characters found in the
+    # JSON metadata of some assertions (e.g. '\x85', '\u2028')
+    for line in data.split('\n'):
+        if not line:
+            continue
+        n_lines += 1
+        triple = parse_assertion(line, prefix)
+        if triple is None:
+            continue
+        s, r, o = triple
+        partitions[zlib.crc32(s.encode('utf-8')) % n_partitions].append(f'{s}\t{r}\t{o}\n')
+        partitions[zlib.crc32(o.encode('utf-8')) % n_partitions].append(f'{o}\t{reverse_rels[r]}\t{s}\n')
+        n_triples += 1
+
+    for p, lines in enumerate(partitions):
+        if lines:
+            with open(os.path.join(partition_path(tmp_path, p), f'chunk-{chunk_id:06d}.tsv'), 'w') as f:
+                f.writelines(lines)
+    return end - start, n_lines, n_triples
+
+
+def group_partition(task):
+    tmp_path, p = task
+    triples = set()
+    for filename in os.listdir(partition_path(tmp_path, p)):
+        with open(os.path.join(partition_path(tmp_path, p), filename)) as f:
+            for line in f:
+                triples.add(tuple(line.rstrip('\n').split('\t')))
+    shutil.rmtree(partition_path(tmp_path, p))
+
+    neighborhoods = {}
+    for s, r, o in sorted(triples):
+        neighborhoods.setdefault(s, {}).setdefault(o, []).append(r)
+    with open(partition_path(tmp_path, p) + '.pickle', 'wb') as f:
+        pickle.dump(neighborhoods, f)
+    return sorted(neighborhoods)
+
+
+def lookup_ids(names, tmp_path):
+    hashes = np.load(os.path.join(tmp_path, 'node_hashes.npy'), mmap_mode='r')
+    ids = np.load(os.path.join(tmp_path, 'node_hash_ids.npy'), mmap_mode='r')
+    return ids[np.searchsorted(hashes, hash_names(names))]
+
+
+def pack_partition(task):
+    tmp_path, p = task
+    with open(partition_path(tmp_path, p) + '.pickle', 'rb') as f:
+        neighborhoods = pickle.load(f)
+    os.remove(partition_path(tmp_path, p) + '.pickle')
+
+    subjects = sorted(neighborhoods)
+    edge_subjects, objects, rels = [], [], []
+    for i, s in enumerate(subjects):
+        neighbors = neighborhoods[s]
+        neighbors = {s: ['sameas'] + neighbors.pop(s, []), **neighbors}
+        for o, o_rels in neighbors.items():
+            edge_subjects.append(i)
+            objects.append(o)
+            rels.append(o_rels)
+
+    subject_ids = lookup_ids(subjects, tmp_path)[edge_subjects]
+    object_ids = lookup_ids(objects, tmp_path)
+    order = np.lexsort((object_ids, subject_ids))
+    rel_counts = np.array([len(r) for r in rels], dtype=np.int64)[order]
+    rel_ids = np.array([relation_ids[r] for e in order for r in rels[e]], dtype=np.uint8)
+    np.savez(partition_path(tmp_path, p) + '.npz', subjects=subject_ids[order], objects=object_ids[order],
+             rel_counts=rel_counts, rel_ids=rel_ids)
+
+    nodes, starts, degrees = np.unique(subject_ids[order], return_index=True, return_counts=True)
+    return nodes, degrees, np.add.reduceat(rel_counts, starts)
+
+
+def write_partition(task):
+    tmp_path, p, store_path = task
+    shard = np.load(partition_path(tmp_path, p) + '.npz')
+    subjects, rel_counts = shard['subjects'], shard['rel_counts']
+    indptr = np.load(os.path.join(store_path, 'indptr.npy'), mmap_mode='r')
+    rels_indptr = np.load(os.path.join(tmp_path, 'rels_indptr.npy'), mmap_mode='r')
+
+    # edges are sorted by subject, so each subject's edges (and relations) are a contiguous run
+    _, starts, degrees = np.unique(subjects, return_index=True, return_counts=True)
+    within = np.arange(len(subjects)) - np.repeat(starts, degrees)
+    edges = indptr[subjects] + within
+    rel_offsets = np.cumsum(rel_counts) - rel_counts
+    edge_rel_starts = rels_indptr[subjects] + rel_offsets - np.repeat(rel_offsets[starts], degrees)
+    rel_positions = np.repeat(edge_rel_starts, rel_counts) + np.arange(len(shard['rel_ids'])) - np.repeat(rel_offsets, rel_counts)
+
+    for name, positions, values in [('indices', edges, shard['objects']), ('rel_indptr', edges, edge_rel_starts),
+                                    ('rel_ids', rel_positions, shard['rel_ids'])]:
+        array = np.load(os.path.join(store_path, name + '.npy'), mmap_mode='r+')
+        array[positions] = values
+        array.flush()
+    os.remove(partition_path(tmp_path, p) + '.npz')
+    return len(subjects)
+
+
+###
+#   Batched similarities
+#
+#   Every node is resolved to its row in the normalized Numberbatch matrix once, after which the
+#   similarity of each edge is a row-wise dot product computed over large batches of edges.
+###
+
+def init_similarity_worker(matrix):
+    # the matrix is an argument of the workers rather than a global of the main script, which the
+    # workers would not have if they were spawned or the module imported
+    global worker_vectors
+    worker_vectors = matrix
+
+
+def similarity_batch(task):
+    store_path, tmp_path, start, stop = task
+    indptr = np.load(os.path.join(store_path, 'indptr.npy'), mmap_mode='r')
+    indices = np.load(os.path.join(store_path, 'indices.npy'), mmap_mode='r')
+    rows = np.load(os.path.join(store_path, 'embedding_rows.npy'), mmap_mode='r')
+
+    subjects = np.searchsorted(indptr, np.arange(start, stop), side='right') - 1
+    objects = indices[start:stop]
+    subject_rows, object_rows = rows[subjects], rows[objects]
+    found = (subject_rows >= 0) & (object_rows >= 0)
+    sims = np.zeros(stop - start, dtype=np.float32)
+    sims[found] = np.einsum('ij,ij->i', worker_vectors[subject_rows[found]], worker_vectors[object_rows[found]])
+    sims[subjects == objects] = 1.
+
+    out = np.load(os.path.join(store_path, 'sims.npy'), mmap_mode='r+')
+    out[start:stop] = sims
+    out.flush()
+    return stop - start
+
+
+if __name__ == "__main__":
+    ###
+    #   Parsing Arguments
+    ###
+
+    parser = argparse.ArgumentParser(description='Zero-Shot Topic Extraction')
+
+    parser.add_argument("-cnp", "--conceptnet_assertions_path", type=str, help="Path to CSV file containing ConceptNet assertions dump", default='conceptnet-assertions-5.7.0.csv')
+    parser.add_argument("-nbp", "--conceptnet_numberbatch_path", type=str, help="Path to W2V file for ConceptNet Numberbatch",  default='numberbatch-en-19.08.txt')
+    parser.add_argument("-zcp", "--zeste_cache_path", type=str, help="Path to the repository where the generated files will be saved", default='zeste_cache/')
+    parser.add_argument("-l", "--language", type=str, help="Language of the ConceptNet nodes to keep", default='en')
+    parser.add_argument("-w", "--workers", type=int, help="Number of worker processes", default=mp.cpu_count())
+    parser.add_argument("-np", "--partitions", type=int, help="Number of subject partitions (more partitions means less memory per worker)", default=64)
+    parser.add_argument("-cs", "--chunk_size", type=int, help="Size in MB of the chunks of the assertions file parsed by each worker", default=64)
+    parser.add_argument("-t", "--dtype", type=str, choices=['float16', 'float32'], help="Precision of the exported Numberbatch matrix", default='float32')
+    parser.add_argument("-sb", "--similarity_batch", type=int, help="Number of edges per batch of similarity computations", default=1000000)
+
+    args = parser.parse_args()
+
+    if not os.path.exists(args.zeste_cache_path):
+        print('Caching folder (', args.zeste_cache_path,') not found.. creating it now.')
+        os.makedirs(args.zeste_cache_path, exist_ok=True)
+
+    print('Loading Numberbatch embeddings (may take some time)..')
+    numberbatch = KeyedVectors.load_word2vec_format(args.conceptnet_numberbatch_path)
+
+    numberbatch_cache_path = os.path.join(args.zeste_cache_path, args.conceptnet_numberbatch_path.split('/')[-1].replace('.txt', '') +'.pickle')
+    pickle.dump(numberbatch, open(numberbatch_cache_path, 'wb'))
+    print('Saving the pickled Numberbatch into', numberbatch_cache_path)
+
+    words, vectors = keyed_vectors_words(numberbatch), numberbatch.vectors
+    prefix = '/c/' + args.language + '/'
+    if words[0].startswith('/c/'): # multilingual Numberbatch
+        kept = [i for i, w in enumerate(words) if w.startswith(prefix)]
+        words, vectors = [words[i][len(prefix):] for i in kept], vectors[kept]
+    words, vectors = sort_vocabulary(words, vectors)
+
+    embeddings_path = numberbatch_cache_path.replace('.pickle', '')
+    embeddings_fingerprint = save_embeddings(embeddings_path, words, vectors, args.dtype)['fingerprint']
+    print('Saving the memory-mapped Numberbatch into', embeddings_path)
+
+    tmp_path = tempfile.mkdtemp(prefix='ingest-', dir=args.zeste_cache_path)
+    for p in range(args.partitions):
+        os.makedirs(partition_path(tmp_path, p))
+    partitions = [(tmp_path, p) for p in range(args.partitions)]
+
+    # the workers are forked so that they share the normalized Numberbatch matrix
+    with mp.get_context('fork').Pool(processes=args.workers, initializer=init_similarity_worker, initargs=(vectors,)) as pool:
+        print('Reading ConceptNet assertions and adding reverse relations..')
+        ranges = split_file(args.conceptnet_assertions_path, args.chunk_size * 2**20)
+        tasks = [(args.conceptnet_assertions_path, i, start, end, args.language, tmp_path, args.partitions) for i, (start, end) in enumerate(ranges)]
+        n_lines = n_triples = 0
+        started = time.time()
+        with tqdm(total=ranges[-1][1] if ranges else 0, unit='B', unit_scale=True) as progress:
+            for n_bytes, chunk_lines, chunk_triples in pool.imap_unordered(parse_chunk, tasks):
+                n_lines += chunk_lines
+                n_triples += chunk_triples
+                progress.update(n_bytes)
+                progress.set_postfix(lines=n_lines, kept=n_triples)
+        elapsed = time.time() - started
+        print(f'Parsed {n_lines:,} assertions in {elapsed:.1f}s ({n_lines / max(elapsed, 1e-9):,.0f} lines/s), kept {n_triples:,} {args.language} triples')
+
+        print('Grouping triples by subject..')
+        subjects = list(tqdm(pool.imap_unordered(group_partition, partitions), total=len(partitions)))
+        nodes = sorted(s for part in subjects for s in part)
+        del subjects
+
+        node_hashes = hash_names(nodes)
+        order = np.argsort(node_hashes)
+        if len(np.unique(node_hashes)) != len(nodes):
+            raise ValueError('Hash collision in the node table')
+        np.save(os.path.join(tmp_path, 'node_hashes.npy'), node_hashes[order])
+        np.save(os.path.join(tmp_path, 'node_hash_ids.npy'), order.astype(np.int32))
+
+        print('Packing the 1-hop neighborhoods..')
+        store_path = os.path.join(args.zeste_cache_path, 'neighborhoods_' + args.language)
+        os.makedirs(store_path, exist_ok=True)
+        vocabulary_index = {w: i for i, w in enumerate(words)}
+        np.save(os.path.join(store_path, 'embedding_rows.npy'), np.array([vocabulary_index.get(n, -1) for n in nodes], dtype=np.int64))
+        del vocabulary_index
+        degrees = np.zeros(len(nodes), dtype=np.int64)
+        rel_degrees = np.zeros(len(nodes), dtype=np.int64)
+        for shard_nodes, shard_degrees, shard_rel_degrees in tqdm(pool.imap_unordered(pack_partition, partitions), total=len(partitions)):
+            degrees[shard_nodes] = shard_degrees
+            rel_degrees[shard_nodes] = shard_rel_degrees
+
+        indptr = np.zeros(len(nodes) + 1, dtype=np.int64)
+        np.cumsum(degrees, out=indptr[1:])
+        rels_indptr = np.zeros(len(nodes) + 1, dtype=np.int64)
+        np.cumsum(rel_degrees, out=rels_indptr[1:])
+        n_edges, n_rels = int(indptr[-1]), int(rels_indptr[-1])
+        np.save(os.path.join(store_path, 'indptr.npy'), indptr)
+        np.save(os.path.join(tmp_path, 'rels_indptr.npy'), rels_indptr)
+        for name, dtype, length in [('indices', np.int32, n_edges), ('sims', np.float32, n_edges),
+                                    ('rel_indptr', np.int64, n_edges + 1), ('rel_ids', np.uint8, n_rels)]:
+            create_array(store_path, name, dtype, length).flush()
+        rel_indptr = np.load(os.path.join(store_path, 'rel_indptr.npy'), mmap_mode='r+')
+        rel_indptr[-1] = n_rels
+        rel_indptr.flush()
+
+        print('Writing the neighborhood store..')
+        list(tqdm(pool.imap_unordered(write_partition, [(tmp_path, p, store_path) for p in range(args.partitions)]), total=len(partitions)))
+
+        print('Computing the similarities of the edges..')
+        batches = [(store_path, tmp_path, start, min(start + args.similarity_batch, n_edges)) for start in range(0, n_edges, args.similarity_batch)]
+        started = time.time()
+        with tqdm(total=n_edges, unit='edges', unit_scale=True) as progress:
+            for n in pool.imap_unordered(similarity_batch, batches):
+                progress.update(n)
+        elapsed = time.time() - started
+        print(f'Computed {n_edges:,} similarities in {elapsed:.1f}s ({n_edges / max(elapsed, 1e-9):,.0f} edges/s)')
+
+    save_string_table(store_path, 'nodes', nodes)
+    save_relations(store_path, relations)
+    save_meta(store_path, {'version': STORE_VERSION, 'id': uuid.uuid4().hex, 'nodes': len(nodes), 'edges': n_edges, 'relations': len(relations),
+                           'language': args.language, 'embeddings': embeddings_fingerprint})
+    shutil.rmtree(tmp_path)
+    print(f'Saved {len(nodes):,} neighborhoods ({n_edges:,} edges) into the neighborhood store', store_path)
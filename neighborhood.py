@@ -0,0 +1,348 @@
+import os
+import numpy as np
+
+from store import open_store
+
+###
+#   Vectorized neighborhood expansion
+#
+#   Instead of recursing node by node, each hop gathers the 1-hop edges of the whole frontier from
+#   the store at once, computes the label-word similarities as a matrix product over the normalized
+#   embeddings, and takes the per-word maxima with scatter-max operations.
+###
+
+# bumped whenever a change of the expansion changes its results (cached neighborhoods are keyed by it)
+EXPANSION_VERSION = 1
+
+SIMILARITIES = ['simple', 'compound', 'depth', 'harmonized']
+SIMPLE, COMPOUND, DEPTH, HARMONIZED = range(len(SIMILARITIES))
+
+
+def gather_edges(store, node_ids):
+    # edge indices of all the 1-hop edges of `node_ids`, and the node each edge comes from
+    starts = np.asarray(store.indptr[node_ids], dtype=np.int64)
+    counts = np.asarray(store.indptr[node_ids + 1], dtype=np.int64) - starts
+    offsets = np.cumsum(counts) - counts
+    edges = np.repeat(starts - offsets, counts) + np.arange(counts.sum())
+    return edges, np.repeat(node_ids, counts)
+
+
+def scatter_max(target, index, values):
+    # target[index] = max(target[index], values), reducing duplicated indices
+    if len(index) == 0:
+        return
+    order = np.argsort(index, kind='stable')
+    index, values = index[order], values[order]
+    starts = np.flatnonzero(np.r_[True, index[1:] != index[:-1]])
+    target[index[starts]] = np.maximum(target[index[starts]], np.maximum.reduceat(values, starts, axis=0))
+
+
+def label_similarities(embeddings, rows, label_vector, batch_size=100000):
+    sims = np.empty(len(rows), dtype=np.float32)
+    for start in range(0, len(rows), batch_size):
+        batch = np.asarray(embeddings.vectors[rows[start:start + batch_size]], dtype=np.float32)
+        sims[start:start + batch_size] = batch @ label_vector
+    return sims
+
+
+def expand_neighborhood(label, depth, embeddings, store, stopwords=(), with_dependencies=False):
+    # with `with_dependencies`, also returns the names of the nodes whose 1-hop neighborhood was read
+    label_id = store.node_id(label)
+    rows = store.embedding_rows(embeddings)
+    label_vector = embeddings.vector(label)
+
+    stopword_mask = np.zeros(len(store), dtype=bool)
+    stopword_ids = store.nodes.indices(stopwords)
+    stopword_mask[stopword_ids[stopword_ids >= 0]] = True
+
+    # position of every node of the neighborhood in `node_ids` / `sims`
+    positions = np.full(len(store), -1, dtype=np.int64)
+
+    # Get immediate label neighborhood
+    edges, _ = gather_edges(store, np.array([label_id]))
+    node_ids = np.asarray(store.indices[edges], dtype=np.int64)
+    positions[node_ids] = np.arange(len(node_ids))
+    sims = np.repeat(np.asarray(store.sims[edges], dtype=np.float32)[:, None], len(SIMILARITIES), axis=1)
+    provenance = [(np.arange(len(node_ids)), np.full(len(node_ids), label_id), edges)]
+    expanded = [np.array([label_id])]
+
+    # Connect to n-hops labels
+    hops = 1
+    frontier = node_ids
+    while hops < depth and len(frontier) > 0:
+        frontier = frontier[~stopword_mask[frontier] & (sims[positions[frontier], SIMPLE] > 0) & (rows[frontier] >= 0)]
+        expanded.append(frontier)
+        edges, sources = gather_edges(store, frontier)
+        words = np.asarray(store.indices[edges], dtype=np.int64)
+        next_frontier = np.unique(words)
+
+        new_words = np.unique(words[positions[words] < 0])
+        positions[new_words] = len(node_ids) + np.arange(len(new_words))
+        node_ids = np.concatenate([node_ids, new_words])
+        sims = np.concatenate([sims, np.zeros((len(new_words), len(SIMILARITIES)), dtype=np.float32)])
+        provenance.append((positions[words], sources, edges))
+
+        # the similarity between a node and its 1-hop neighbor is the one stored with the edge
+        found = rows[words] >= 0
+        words, sources, sim_cn_word = words[found], sources[found], np.asarray(store.sims[edges[found]], dtype=np.float32)
+        unique_words, inverse = np.unique(words, return_inverse=True)
+        sim_label_word = label_similarities(embeddings, rows[unique_words], label_vector)[inverse]
+        unique_sources, inverse = np.unique(sources, return_inverse=True)
+        sim_label_cn = label_similarities(embeddings, rows[unique_sources], label_vector)[inverse]
+
+        compound = sim_label_cn * sim_cn_word
+        harmonized = np.full(len(compound), -np.inf, dtype=np.float32)
+        np.divide(2 * compound, sim_label_cn + sim_cn_word, out=harmonized, where=(sim_label_cn + sim_cn_word) != 0)
+        values = np.stack([sim_label_word, compound, sim_label_word / (hops + 1), harmonized], axis=1)
+        scatter_max(sims, positions[words], values)
+
+        hops += 1
+        frontier = next_frontier
+
+    positions, sources, edges = (np.concatenate(a) for a in zip(*provenance))
+    neighborhood = LabelNeighborhood.from_provenance(store, [label], node_ids, sims, positions, sources, edges,
+                                                     np.zeros(len(positions), dtype=np.int32))
+    if with_dependencies:
+        return neighborhood, [store.node(i) for i in np.unique(np.concatenate(expanded))]
+    return neighborhood
+
+
+class LabelNeighborhood:
+    # Neighborhood of a label as parallel arrays over its nodes:
+    #   node_ids                       ids of the nodes in the store
+    #   sims                           similarities of the nodes, one column per SIMILARITIES entry
+    #   prov_indptr                    CSR offsets, node -> range of provenance entries
+    #   prov_sources / prov_edges      node the entry comes from, and the store edge it comes through
+    #   prov_words                     index in `words` of the label word the entry was expanded from
+    # It reads like the former {word: {'from': [...], 'rels': [...], 'sim': {...}}} dictionaries.
+
+    def __init__(self, store, words, node_ids, sims, prov_indptr, prov_sources, prov_edges, prov_words):
+        self.store = store
+        self.words = list(words)
+        self.node_ids = node_ids
+        self.sims = sims
+        self.prov_indptr = prov_indptr
+        self.prov_sources = prov_sources
+        self.prov_edges = prov_edges
+        self.prov_words = prov_words
+        self._positions = None
+        self._names = None
+        self._relation_bits = None
+        self._first_hops = None
+        self._relation_masks = {}
+        self._views = {}
+
+    @classmethod
+    def from_provenance(cls, store, words, node_ids, sims, positions, sources, edges, word_indices):
+        # provenance entries are given in any node order, the entries of a node keep their order
+        order = np.lexsort((word_indices, positions))
+        prov_indptr = np.searchsorted(positions[order], np.arange(len(node_ids) + 1)).astype(np.int64)
+        return cls(store, words, node_ids, sims, prov_indptr, sources[order], edges[order], word_indices[order])
+
+    @classmethod
+    def empty(cls, store, word):
+        return cls(store, [word], np.zeros(0, dtype=np.int64), np.zeros((0, len(SIMILARITIES)), dtype=np.float32),
+                   np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32))
+
+    @classmethod
+    def merge(cls, words, neighborhoods):
+        # `neighborhoods` are those of the single `words`, the nodes keep the order in which they appear in `neighborhoods`, with the maximum of their
+        # similarities, and the provenance entries of each neighborhood tagged with its label word
+        if len(neighborhoods) == 1:
+            return neighborhoods[0]
+        all_ids = np.concatenate([n.node_ids for n in neighborhoods])
+        _, first = np.unique(all_ids, return_index=True)
+        node_ids = all_ids[np.sort(first)]
+        sorter = np.argsort(node_ids)
+
+        sims = np.full((len(node_ids), len(SIMILARITIES)), -np.inf, dtype=np.float32)
+        provenance = []
+        for j, n in enumerate(neighborhoods):
+            positions = sorter[np.searchsorted(node_ids, n.node_ids, sorter=sorter)]
+            sims[positions] = np.maximum(sims[positions], n.sims)
+            provenance.append((np.repeat(positions, np.diff(n.prov_indptr)), n.prov_sources, n.prov_edges,
+                               np.full(len(n.prov_sources), j, dtype=np.int32)))
+        positions, sources, edges, word_indices = (np.concatenate(a) for a in zip(*provenance))
+        return cls.from_provenance(neighborhoods[0].store, words, node_ids, sims, positions, sources, edges, word_indices)
+
+    def take(self, positions):
+        # neighborhood restricted to the nodes at `positions` (in that order)
+        starts, stops = self.prov_indptr[positions], self.prov_indptr[positions + 1]
+        counts = stops - starts
+        prov_indptr = np.zeros(len(positions) + 1, dtype=np.int64)
+        np.cumsum(counts, out=prov_indptr[1:])
+        entries = np.repeat(starts - prov_indptr[:-1], counts) + np.arange(prov_indptr[-1])
+        return LabelNeighborhood(self.store, self.words, self.node_ids[positions], self.sims[positions], prov_indptr,
+                                 self.prov_sources[entries], self.prov_edges[entries], self.prov_words[entries])
+
+    def first_hops(self):
+        # provenance entries of the edges coming straight from their label word, which are the first
+        # entry of their node among the entries from that word (the label word is also one of its own
+        # neighbors through 'sameas', so the later entries from it come from its own expansion)
+        entry_nodes = np.repeat(np.arange(len(self)), np.diff(self.prov_indptr))
+        new_group = np.r_[True, (entry_nodes[1:] != entry_nodes[:-1]) | (self.prov_words[1:] != self.prov_words[:-1])]
+        word_ids = self.store.nodes.indices(self.words)
+        return entry_nodes, new_group & (self.prov_sources == word_ids[self.prov_words])
+
+    def relation_bits(self):
+        # computed once per neighborhood: the node of every provenance entry, the first relation of
+        # the entries tested by substring, and the entries tested by membership with the relations
+        # of their edge as a bitset (a bit per store relation)
+        if self._relation_bits is None:
+            entry_nodes, first_hop = self.first_hops()
+            starts = np.asarray(self.store.rel_indptr[self.prov_edges], dtype=np.int64)
+            counts = np.asarray(self.store.rel_indptr[self.prov_edges + 1], dtype=np.int64) - starts
+            first_rels = np.full(len(starts), len(self.store.relations), dtype=np.int64)
+            substring = (self.prov_words == 0) & first_hop & (counts > 0)
+            first_rels[substring] = self.store.rel_ids[starts[substring]]
+
+            members = np.flatnonzero(np.where(self.prov_words == 0, ~first_hop, first_hop))
+            starts, counts = starts[members], counts[members]
+            offsets = np.cumsum(counts) - counts
+            rel_ids = np.asarray(self.store.rel_ids[np.repeat(starts - offsets, counts) + np.arange(counts.sum())], dtype=np.uint64)
+            bits = np.zeros((len(members), (len(self.store.relations) + 63) // 64), dtype=np.uint64)
+            np.bitwise_or.at(bits, (np.repeat(np.arange(len(members)), counts), (rel_ids // 64).astype(np.int64)), np.uint64(1) << (rel_ids % 64))
+            self._relation_bits = (entry_nodes, first_rels, members, bits)
+        return self._relation_bits
+
+    def relation_mask(self, relations):
+        # nodes with a provenance entry that matches one of `relations` the way the former filter
+        # tested `rel in rels[0]` on the entries of the dictionaries (see __getitem__): the edges
+        # from the first label word match if their first relation contains it, the other edges
+        # reached from it if they have it, and the other label words if the first entry of their
+        # node is an edge from that word that has it
+        entry_nodes, first_rels, members, bits = self.relation_bits()
+        relations = list(relations)
+        contains = np.array([any(r in name for r in relations) for name in self.store.relations] + [False])
+        allowed = np.zeros(bits.shape[1], dtype=np.uint64)
+        for i, name in enumerate(self.store.relations):
+            if name in relations:
+                allowed[i // 64] |= np.uint64(1) << np.uint64(i % 64)
+
+        matches = contains[first_rels]
+        matches[members[(bits & allowed).any(axis=1)]] = True
+        return np.bincount(entry_nodes[matches], minlength=len(self)) > 0
+
+    def filter(self, allowed_rels='all', sim='simple', keep='all'):
+        # nodes having one of `allowed_rels` (see relation_mask) and a `sim` similarity above the cutoff
+        # given by `keep` ('top[N]', 'top[P]%', 'thresh[T]' or 'all'). The filtered views and the
+        # relation masks are cached, so sweeping filters does not recompute them.
+        if allowed_rels == 'all' and keep == 'all':
+            return self
+        rels_key = allowed_rels if isinstance(allowed_rels, str) else tuple(allowed_rels)
+        if (rels_key, sim, keep) in self._views:
+            return self._views[(rels_key, sim, keep)]
+
+        kept = np.arange(len(self))
+        if allowed_rels != 'all':
+            if rels_key not in self._relation_masks:
+                self._relation_masks[rels_key] = self.relation_mask(allowed_rels)
+            kept = kept[self._relation_masks[rels_key]]
+
+        if keep != 'all' and len(kept) > 0:
+            scores = self.sims[kept, SIMILARITIES.index(sim)]
+            if keep.startswith('thresh'):
+                cutoff_score = float(keep[6:])
+            else:
+                # rank of the cutoff score in decreasing order, as the former sorted list was indexed
+                if keep.endswith('%'):
+                    rank = (int(int(keep[3:-1]) / 100. * len(scores)) - 1) % len(scores)
+                else:
+                    rank = min(len(scores) - 1, int(keep[3:]))
+                cutoff_score = np.partition(scores, len(scores) - 1 - rank)[len(scores) - 1 - rank]
+            kept = kept[scores > cutoff_score]
+
+        self._views[(rels_key, sim, keep)] = self.take(kept)
+        return self._views[(rels_key, sim, keep)]
+
+    def __getstate__(self):
+        # the nodes are pickled by name and the edges by their rank in the row of their source, which
+        # stay valid when an incremental update of the store shifts the node ids and edge offsets
+        # (the neighborhoods that read a changed row are invalidated by update_cache.py)
+        state = {k: v for k, v in self.__dict__.items() if not k.startswith('_') and k not in ('node_ids', 'prov_sources', 'prov_edges')}
+        state['store'] = os.path.abspath(self.store.path)
+        state['nodes'] = self.names
+        source_ids, prov_sources = np.unique(self.prov_sources, return_inverse=True)
+        state['sources'] = [self.store.node(i) for i in source_ids]
+        state['prov_sources'] = prov_sources.astype(np.int64)
+        state['prov_ranks'] = self.prov_edges - np.asarray(self.store.indptr[self.prov_sources], dtype=np.int64)
+        return state
+
+    def __setstate__(self, state):
+        state = dict(state)
+        store = open_store(state.pop('store'))
+        names, sources, ranks = state.pop('nodes'), state.pop('sources'), state.pop('prov_ranks')
+        node_ids = store.nodes.indices(names)
+        prov_sources = store.nodes.indices(sources)[state.pop('prov_sources')]
+        entry_nodes = np.repeat(node_ids, np.diff(state['prov_indptr']))
+        prov_edges = np.asarray(store.indptr[prov_sources], dtype=np.int64) + ranks
+        if (node_ids < 0).any() or (prov_sources < 0).any() or (prov_edges >= np.asarray(store.indptr[prov_sources + 1])).any() \
+                or (np.asarray(store.indices[prov_edges]) != entry_nodes).any():
+            raise ValueError(f'The neighborhood of {state["words"]} does not match the store {store.path}')
+        self.__dict__.update(state)
+        self.store = store
+        self.node_ids = node_ids
+        self.prov_sources = prov_sources
+        self.prov_edges = prov_edges
+        self._positions = None
+        self._names = list(names)
+        self._relation_bits = None
+        self._first_hops = None
+        self._relation_masks = {}
+        self._views = {}
+
+    # dictionary view
+
+    @property
+    def names(self):
+        if self._names is None:
+            self._names = [self.store.node(i) for i in self.node_ids]
+        return self._names
+
+    def position(self, word):
+        if self._positions is None:
+            self._positions = {name: i for i, name in enumerate(self.names)}
+        return self._positions.get(word, -1)
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def keys(self):
+        return self.names
+
+    def __contains__(self, word):
+        return self.position(word) >= 0
+
+    def __getitem__(self, word):
+        i = self.position(word)
+        if i < 0:
+            raise KeyError(word)
+        entries = range(self.prov_indptr[i], self.prov_indptr[i + 1])
+        if self._first_hops is None:
+            self._first_hops = self.first_hops()[1]
+        origin, rels = [], []
+        group = 0
+        for p in entries:
+            w, edge_rels = self.prov_words[p], self.store.edge_rels(self.prov_edges[p])
+            # the relations of an edge reached after the first hop were wrapped in a tuple
+            entry = edge_rels if self._first_hops[p] else (edge_rels,)
+            if w == 0:
+                origin.append(self.store.node(self.prov_sources[p]))
+                rels.append(entry)
+            elif w != group:
+                # the entries of the other label words are collapsed as in the former label merges
+                origin.append(self.words[w])
+                rels.append((entry,))
+                group = w
+            else:
+                rels[-1] += (entry,)
+        return {'from': origin, 'rels': rels, 'sim': {sim: float(self.sims[i, k]) for k, sim in enumerate(SIMILARITIES)}}
+
+    def items(self):
+        return ((word, self[word]) for word in self.names)
+
+    def to_dict(self):
+        return dict(self.items())
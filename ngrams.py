@@ -0,0 +1,58 @@
+from collections import deque
+
+###
+#   Token-level Aho-Corasick automaton over the n-gram vocabulary
+#
+#   Built once from the space-separated n-grams, it finds all of them in a single linear pass over
+#   a document's tokens, matching on token boundaries only. Matched n-grams are returned in their
+#   ConceptNet form (tokens joined by underscores), once per document.
+###
+
+
+class NgramMatcher:
+
+    def __init__(self, ngrams):
+        self.ngrams = []
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+
+        for ngram in ngrams:
+            state = 0
+            for token in ngram.split():
+                if token not in self.goto[state]:
+                    self.goto[state][token] = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                state = self.goto[state][token]
+            if not self.output[state]:
+                self.output[state].append(len(self.ngrams))
+                self.ngrams.append('_'.join(ngram.split()))
+
+        # failure links, in breadth-first order so that the links of shorter prefixes are known
+        # (the children of the root fail to the root)
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for token, child in self.goto[state].items():
+                queue.append(child)
+                fallback = self.fail[state]
+                while fallback and token not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(token, 0)
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+
+    def __len__(self):
+        return len(self.ngrams)
+
+    def match(self, tokens):
+        found = {}
+        state = 0
+        for token in tokens:
+            while state and token not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(token, 0)
+            for ngram in self.output[state]:
+                found.setdefault(ngram)
+        return [self.ngrams[ngram] for ngram in found]
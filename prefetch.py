@@ -0,0 +1,208 @@
+import os
+import json
+import time
+import pickle
+import shutil
+import hashlib
+import argparse
+import tempfile
+import numpy as np
+from functools import lru_cache
+
+from store import STORE_VERSION, hash_names
+from neighborhood import EXPANSION_VERSION
+
+###
+#   Prefetch cache of the n-hop label neighborhoods
+#
+#   Entries are grouped in a folder per configuration, named after a hash of every input of the
+#   expansion (depth, Numberbatch fingerprint, store generation, stopwords, expansion version), so
+#   that changing any of them never serves stale neighborhoods:
+#     <prefetch_path>/<key>/config.json                 the inputs behind the key
+#     <prefetch_path>/<key>/<md5[:2]>/<label>.pickle    checksum header + pickled neighborhood
+#     <prefetch_path>/<key>/<md5[:2]>/<label>.deps.npy  nodes it depends on (see update_cache.py)
+#
+#   Files are written to a temporary file and renamed, so concurrent runs never read partial
+#   entries, and every entry is checked against its checksum when read. The modification time of
+#   an entry is refreshed when it is read, which is the order in which `gc` evicts them.
+###
+
+# 2: neighborhoods pickled as LabelNeighborhood arrays
+# 3: nodes pickled by name, edges by their rank in the row of their source
+PREFETCH_VERSION = 3
+CHECKSUM_SIZE = 16
+
+
+def store_generation(store):
+    # stays the same through incremental updates, which invalidate the affected entries themselves
+    if 'id' in store.meta:
+        return store.meta['id']
+    return hashlib.sha1(json.dumps(store.meta, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def prefetch_config(depth, embeddings, store, stopwords):
+    return {'format': PREFETCH_VERSION, 'expansion': EXPANSION_VERSION, 'depth': depth,
+            'embeddings': embeddings.fingerprint, 'store': store_generation(store), 'store_version': STORE_VERSION,
+            'language': store.meta.get('language'),
+            'stopwords': hashlib.sha1('\n'.join(sorted(stopwords)).encode('utf-8')).hexdigest()}
+
+
+def config_key(config):
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def checksum(payload):
+    return hashlib.blake2b(payload, digest_size=CHECKSUM_SIZE).digest()
+
+
+def atomic_write(path, data):
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', dir=folder or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+class PrefetchCache:
+
+    def __init__(self, path, config):
+        self.config = config
+        self.key = config_key(config)
+        self.path = os.path.join(path, self.key)
+        if not os.path.exists(os.path.join(self.path, 'config.json')):
+            atomic_write(os.path.join(self.path, 'config.json'), json.dumps(config, indent=2, sort_keys=True).encode('utf-8'))
+
+    def entry_path(self, label):
+        pickle_name = label + '.pickle'
+        md5name = hashlib.md5(pickle_name.encode('utf-8')).hexdigest()[:2]
+        return os.path.join(self.path, md5name, pickle_name)
+
+    def get(self, label):
+        path = self.entry_path(label)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        payload = data[CHECKSUM_SIZE:]
+        if checksum(payload) != data[:CHECKSUM_SIZE]:
+            print('Removing corrupted prefetch entry:', path)
+            os.remove(path)
+            return None
+        try:
+            neighborhood = pickle.loads(payload)
+        except ValueError:
+            # written before an update of the store that the invalidation missed
+            print('Removing stale prefetch entry:', path)
+            remove_entry(path)
+            return None
+        except (OSError, EOFError, pickle.UnpicklingError) as e:
+            # the store it refers to was moved or removed, or the entry is truncated: it is a miss,
+            # and the recomputed neighborhood replaces it
+            print(f'Removing unreadable prefetch entry: {path} ({e!r})')
+            remove_entry(path)
+            return None
+        os.utime(path)
+        return neighborhood
+
+    def put(self, label, neighborhood, dependencies):
+        path = self.entry_path(label)
+        payload = pickle.dumps(neighborhood, protocol=pickle.HIGHEST_PROTOCOL)
+        # the dependencies are written first, so that an entry is never without them
+        with tempfile.TemporaryFile() as f:
+            np.save(f, np.unique(hash_names(dependencies)))
+            f.seek(0)
+            atomic_write(path[:-len('.pickle')] + '.deps.npy', f.read())
+        atomic_write(path, checksum(payload) + payload)
+
+
+@lru_cache(maxsize=None)
+def open_prefetch(path, depth, embeddings, store, stopwords):
+    return PrefetchCache(path, prefetch_config(depth, embeddings, store, stopwords))
+
+
+def collect_garbage(path, budget, reachable=None, verify=False):
+    # Removes the configurations that are not `reachable` (when given) and the folders of former
+    # layouts, the leftovers of interrupted writes, and then the least recently used entries until
+    # the cache fits in `budget` bytes
+    removed_configs = removed_entries = 0
+    entries = []
+    for name in sorted(os.listdir(path)):
+        config_path = os.path.join(path, name)
+        if not os.path.isdir(config_path):
+            continue
+        if not os.path.exists(os.path.join(config_path, 'config.json')) or (reachable is not None and name not in reachable):
+            shutil.rmtree(config_path)
+            removed_configs += 1
+            continue
+        for root, _, files in os.walk(config_path):
+            for f in files:
+                file_path = os.path.join(root, f)
+                if f.startswith('.tmp-') or (f.endswith('.deps.npy') and not os.path.exists(file_path[:-len('.deps.npy')] + '.pickle')):
+                    os.remove(file_path)
+                elif f.endswith('.pickle'):
+                    if verify:
+                        with open(file_path, 'rb') as entry:
+                            data = entry.read()
+                        if checksum(data[CHECKSUM_SIZE:]) != data[:CHECKSUM_SIZE]:
+                            remove_entry(file_path)
+                            removed_entries += 1
+                            continue
+                    deps_path = file_path[:-len('.pickle')] + '.deps.npy'
+                    size = os.path.getsize(file_path) + (os.path.getsize(deps_path) if os.path.exists(deps_path) else 0)
+                    entries.append((os.path.getmtime(file_path), size, file_path))
+
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    for _, size, file_path in entries:
+        if total <= budget:
+            break
+        remove_entry(file_path)
+        removed_entries += 1
+        total -= size
+    return removed_configs, removed_entries, total
+
+
+def remove_entry(pickle_path):
+    os.remove(pickle_path)
+    deps_path = pickle_path[:-len('.pickle')] + '.deps.npy'
+    if os.path.exists(deps_path):
+        os.remove(deps_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Manage the cache of prefetched label neighborhoods')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    gc_parser = subparsers.add_parser('gc', help='Prune the cache down to a disk budget')
+    gc_parser.add_argument('-pp', '--prefetch_path', type=str, help="Path to where the precomputed n-hop neighborhoods are cached", default='prefetch_cache')
+    gc_parser.add_argument('-b', '--budget', type=float, help="Disk budget of the cache, in MB", required=True)
+    gc_parser.add_argument('-cp', '--cache_path', type=str, help="Path to the current neighborhood store (the configurations of other stores are removed)", default=None)
+    gc_parser.add_argument('-nb', '--numberbatch_path', type=str, help="Path to the current memory-mapped Numberbatch (the configurations of other embeddings are removed)", default=None)
+    gc_parser.add_argument('--verify', action='store_true', help="Check the checksum of every entry and remove the corrupted ones")
+    args = parser.parse_args()
+
+    if args.command == 'gc':
+        reachable = None
+        if args.cache_path is not None or args.numberbatch_path is not None:
+            from store import NeighborhoodStore
+            from embeddings import Embeddings
+            store = NeighborhoodStore(args.cache_path) if args.cache_path is not None else None
+            fingerprint = Embeddings(args.numberbatch_path).fingerprint if args.numberbatch_path is not None else None
+            reachable = set()
+            for name in os.listdir(args.prefetch_path):
+                config_file = os.path.join(args.prefetch_path, name, 'config.json')
+                if os.path.exists(config_file):
+                    with open(config_file) as f:
+                        config = json.load(f)
+                    if (store is None or config.get('store') == store_generation(store)) and (fingerprint is None or config.get('embeddings') == fingerprint):
+                        reachable.add(name)
+
+        started = time.time()
+        removed_configs, removed_entries, size = collect_garbage(args.prefetch_path, args.budget * 2**20, reachable, args.verify)
+        print(f'Removed {removed_configs} configurations and {removed_entries} entries in {time.time() - started:.1f}s, the cache now holds {size / 2**20:,.1f} MB')
@@ -0,0 +1,89 @@
+import hashlib
+import numpy as np
+import scipy.sparse as sp
+
+from neighborhood import SIMILARITIES
+from corpus import PreprocessedCorpus
+
+###
+#   Sparse scoring engine
+#
+#   The filtered label neighborhoods are compiled once into a vocabulary x label weight matrix per
+#   similarity mode (plus a membership matrix for the `inter_len` normalization and the per-label
+#   sums for `max_score`), and the preprocessed corpus into a document x vocabulary count matrix,
+#   so that scoring a whole dataset is a sparse matrix product. The documents of a cached corpus
+#   (see corpus.py) are mapped from their token ids without materializing their tokens.
+#   As in score(), the similarities are summed and normalized in float32 (in another order, so the
+#   scores may differ by a float32 rounding error before they are rounded to 6 decimals).
+###
+
+
+class ScoringEngine:
+
+    def __init__(self, sorted_labels, labels_neighborhoods, similarities=SIMILARITIES):
+        self.labels = list(sorted_labels)
+        neighborhoods = [labels_neighborhoods[label] for label in self.labels]
+        node_ids = np.concatenate([n.node_ids for n in neighborhoods])
+        cols = np.repeat(np.arange(len(self.labels)), [len(n) for n in neighborhoods])
+        vocabulary_ids, rows = np.unique(node_ids, return_inverse=True)
+        store = neighborhoods[0].store
+        self.vocabulary = {store.node(i): k for k, i in enumerate(vocabulary_ids)}
+
+        shape = (len(self.vocabulary), len(self.labels))
+        self.membership = sp.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, cols)), shape=shape)
+        sims = np.concatenate([n.sims for n in neighborhoods]).astype(np.float32)
+        self.weights = {sim: sp.csr_matrix((sims[:, SIMILARITIES.index(sim)], (rows, cols)), shape=shape) for sim in similarities}
+        self.normalizers = {sim: np.asarray(w.sum(axis=0), dtype=np.float32).ravel() for sim, w in self.weights.items()}
+        # score() raises on the labels without a neighborhood, they score 0
+        self.empty = np.array([len(n) == 0 for n in neighborhoods])
+
+    def fingerprint(self):
+        # hash of the labels, vocabulary and weights, which identifies the filtered neighborhoods
+        # the engine was compiled from
+        h = hashlib.sha1('\n'.join(self.labels).encode('utf-8'))
+        h.update('\n'.join(self.vocabulary).encode('utf-8'))
+        for sim in sorted(self.weights):
+            w = self.weights[sim]
+            for array in (w.indptr, w.indices, w.data):
+                h.update(np.ascontiguousarray(array).tobytes())
+        return h.hexdigest()
+
+    def document_matrix(self, docs, ngrams=None):
+        # document x vocabulary token counts (tokens that are in no neighborhood are dropped),
+        # `ngrams` is an NgramMatcher whose matches are added once to each document
+        if isinstance(docs, PreprocessedCorpus):
+            counts = self.corpus_matrix(docs)
+            if ngrams:
+                counts = counts + self.tokens_matrix([ngrams.match(tokens) for tokens in docs])
+            return counts
+        return self.tokens_matrix([tokens + ngrams.match(tokens) for tokens in docs] if ngrams else docs)
+
+    def tokens_matrix(self, docs):
+        indptr, indices = [0], []
+        for tokens in docs:
+            indices.extend(self.vocabulary[t] for t in tokens if t in self.vocabulary)
+            indptr.append(len(indices))
+        counts = sp.csr_matrix((np.ones(len(indices), dtype=np.float32), indices, indptr), shape=(len(docs), len(self.vocabulary)))
+        counts.sum_duplicates()
+        return counts
+
+    def corpus_matrix(self, corpus):
+        # the token ids of a cached corpus are mapped to the vocabulary all at once
+        lookup = np.array([self.vocabulary.get(w, -1) for w in corpus.vocabulary], dtype=np.int64)
+        columns = lookup[corpus.token_ids]
+        kept = columns >= 0
+        rows = np.repeat(np.arange(len(corpus)), np.diff(corpus.indptr))
+        return sp.csr_matrix((np.ones(kept.sum(), dtype=np.float32), (rows[kept], columns[kept])), shape=(len(corpus), len(self.vocabulary)))
+
+    def score(self, counts, sim, normalize):
+        scores = (counts @ self.weights[sim]).toarray()
+        if normalize == 'inter_len':
+            scores /= np.maximum((counts @ self.membership).toarray(), 1)
+        elif normalize == 'max_score':
+            # a neighborhood whose similarities sum to 0 gives inf or nan scores, as in score()
+            with np.errstate(divide='ignore', invalid='ignore'):
+                np.divide(scores, self.normalizers[sim], out=scores, where=~self.empty)
+        return np.round(scores, 6).astype(np.float64)
+
+    def predict(self, docs, sim, ngrams, normalize):
+        return self.score(self.document_matrix(docs, ngrams), sim, normalize)
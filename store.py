@@ -0,0 +1,319 @@
+import os
+import json
+import mmap
+import pickle
+import uuid
+import hashlib
+import argparse
+import numpy as np
+from tqdm import tqdm
+
+###
+#   Packed 1-hop neighborhood store
+#
+#   A store is a directory holding:
+#     nodes.bin / nodes_offsets.npy     sorted, utf-8 encoded node names (the interned node table)
+#     relations.txt                     relation names, one per line (id = line number)
+#     indptr.npy                        CSR offsets, node id -> range of edges
+#     indices.npy                       neighbor node id of every edge
+#     sims.npy                          numberbatch similarity of every edge
+#     rel_indptr.npy / rel_ids.npy      CSR offsets, edge -> range of relation ids
+#     embedding_rows.npy                (optional) row of every node in the Numberbatch matrix
+#     meta.json                         format version, counts and generation id (kept by incremental updates)
+#
+#   Cached multi-hop neighborhoods built from a store (`<name>.pickle`) may come with a
+#   `<name>.deps.npy` sidecar holding the hashes of the nodes whose 1-hop neighborhood was read to
+#   build them, so that they can be invalidated when these neighborhoods are updated.
+#
+#   Every array is memory-mapped read-only, so looking up a neighborhood is a binary search in
+#   the node table followed by array slicing.
+###
+
+STORE_VERSION = 1
+
+
+class StringTable:
+    # Sorted table of strings packed into a single memory-mapped utf-8 blob
+
+    def __init__(self, path, name):
+        self.offsets = np.load(os.path.join(path, name + '_offsets.npy'), mmap_mode='r')
+        with open(os.path.join(path, name + '.bin'), 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            self.blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size > 0 else b''
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.blob[self.offsets[i]:self.offsets[i + 1]].decode('utf-8')
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __contains__(self, word):
+        return self.index(word) >= 0
+
+    def _bisect(self, key):
+        offsets, blob = self.offsets, self.blob
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if blob[offsets[mid]:offsets[mid + 1]] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def position(self, word):
+        # index of `word` in the table, or at which it would be inserted
+        return self._bisect(word.encode('utf-8'))
+
+    def prefix_range(self, prefix):
+        # positions [lo, hi) of the strings starting with `prefix` (no utf-8 encoded string holds the byte 0xff)
+        key = prefix.encode('utf-8')
+        return self._bisect(key), self._bisect(key + b'\xff')
+
+    def index(self, word):
+        key = word.encode('utf-8')
+        i = self._bisect(key)
+        if i < len(self) and self.blob[self.offsets[i]:self.offsets[i + 1]] == key:
+            return i
+        return -1
+
+    def indices(self, words):
+        return np.array([self.index(w) for w in words], dtype=np.int64)
+
+
+def save_string_table(path, name, strings):
+    # `strings` must already be sorted (python's str ordering matches the utf-8 byte ordering)
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(e) for e in encoded], out=offsets[1:])
+    with open(os.path.join(path, name + '.bin'), 'wb') as f:
+        f.write(b''.join(encoded))
+    np.save(os.path.join(path, name + '_offsets.npy'), offsets)
+
+
+def create_array(path, name, dtype, length):
+    return np.lib.format.open_memmap(os.path.join(path, name + '.npy'), mode='w+', dtype=dtype, shape=(length,))
+
+
+def save_meta(path, meta):
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2, sort_keys=True)
+
+
+def save_relations(path, relations):
+    with open(os.path.join(path, 'relations.txt'), 'w') as f:
+        f.write(''.join(r + '\n' for r in relations))
+
+
+def save_store(path, nodes, relations, indptr, indices, sims, rel_indptr, rel_ids, **meta):
+    os.makedirs(path, exist_ok=True)
+    save_string_table(path, 'nodes', nodes)
+    save_relations(path, relations)
+    np.save(os.path.join(path, 'indptr.npy'), np.asarray(indptr, dtype=np.int64))
+    np.save(os.path.join(path, 'indices.npy'), np.asarray(indices, dtype=np.int32))
+    np.save(os.path.join(path, 'sims.npy'), np.asarray(sims, dtype=np.float32))
+    np.save(os.path.join(path, 'rel_indptr.npy'), np.asarray(rel_indptr, dtype=np.int64))
+    np.save(os.path.join(path, 'rel_ids.npy'), np.asarray(rel_ids, dtype=np.uint8))
+    meta.update({'version': STORE_VERSION, 'id': uuid.uuid4().hex, 'nodes': len(nodes), 'edges': len(indices), 'relations': len(relations)})
+    save_meta(path, meta)
+
+
+class NeighborhoodStore:
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta.get('version') != STORE_VERSION:
+            raise ValueError(f'Unsupported neighborhood store version in {path}: {self.meta.get("version")}')
+        self.nodes = StringTable(path, 'nodes')
+        with open(os.path.join(path, 'relations.txt')) as f:
+            self.relations = [line.rstrip('\n') for line in f]
+        self.indptr = np.load(os.path.join(path, 'indptr.npy'), mmap_mode='r')
+        self.indices = np.load(os.path.join(path, 'indices.npy'), mmap_mode='r')
+        self.sims = np.load(os.path.join(path, 'sims.npy'), mmap_mode='r')
+        self.rel_indptr = np.load(os.path.join(path, 'rel_indptr.npy'), mmap_mode='r')
+        self.rel_ids = np.load(os.path.join(path, 'rel_ids.npy'), mmap_mode='r')
+        self._embedding_rows = {}
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, word):
+        return self.nodes.index(word) >= 0
+
+    def node_id(self, word):
+        return self.nodes.index(word)
+
+    def node(self, node_id):
+        return self.nodes[node_id]
+
+    def edges(self, node_id):
+        return slice(int(self.indptr[node_id]), int(self.indptr[node_id + 1]))
+
+    def neighbors(self, node_id):
+        edges = self.edges(node_id)
+        return self.indices[edges], self.sims[edges]
+
+    def edge_rels(self, edge):
+        rel_ids = self.rel_ids[self.rel_indptr[edge]:self.rel_indptr[edge + 1]]
+        return tuple(self.relations[r] for r in rel_ids)
+
+    def embedding_rows(self, embeddings):
+        # row of every node in the embeddings matrix (-1 for nodes without an embedding)
+        if embeddings.fingerprint not in self._embedding_rows:
+            rows_path = os.path.join(self.path, 'embedding_rows.npy')
+            if self.meta.get('embeddings') == embeddings.fingerprint and os.path.exists(rows_path):
+                rows = np.load(rows_path, mmap_mode='r')
+            else:
+                rows = compute_embedding_rows(self.nodes, embeddings.vocab)
+            self._embedding_rows[embeddings.fingerprint] = rows
+        return self._embedding_rows[embeddings.fingerprint]
+
+    def neighborhood(self, word):
+        # 1-hop neighborhood of `word` in the format of the former per-word pickles
+        node_id = self.nodes.index(word)
+        if node_id < 0:
+            raise KeyError(word)
+        edges = self.edges(node_id)
+        neighborhood = {}
+        for e, o, sim in zip(range(edges.start, edges.stop), self.indices[edges], self.sims[edges]):
+            neighborhood[self.nodes[o]] = {'rels': list(self.edge_rels(e)), 'sim': sim, 'from': [word]}
+        return neighborhood
+
+
+def compute_embedding_rows(nodes, vocab):
+    index = {w: i for i, w in enumerate(vocab)}
+    return np.array([index.get(n, -1) for n in nodes], dtype=np.int64)
+
+
+def link_embeddings(path, embeddings):
+    # saves the node -> embedding row mapping so that it is not recomputed every time the store is opened
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    np.save(os.path.join(path, 'embedding_rows.npy'), compute_embedding_rows(StringTable(path, 'nodes'), embeddings.vocab))
+    meta['embeddings'] = embeddings.fingerprint
+    save_meta(path, meta)
+
+
+def hash_names(names):
+    digests = b''.join(hashlib.blake2b(n.encode('utf-8'), digest_size=8).digest() for n in names)
+    return np.frombuffer(digests, dtype=np.uint64)
+
+
+def save_dependencies(pickle_path, names):
+    np.save(pickle_path[:-len('.pickle')] + '.deps.npy', np.unique(hash_names(names)))
+
+
+def invalidate_dependents(cache_path, names):
+    # removes the cached neighborhoods under `cache_path` that depend on the 1-hop neighborhood of
+    # any of `names` (and those saved without dependencies, which cannot be checked)
+    changed = np.unique(hash_names(names))
+    removed = kept = 0
+    for root, _, files in os.walk(cache_path):
+        for f in files:
+            if not f.endswith('.pickle'):
+                continue
+            pickle_path = os.path.join(root, f)
+            deps_path = pickle_path[:-len('.pickle')] + '.deps.npy'
+            if os.path.exists(deps_path) and not np.isin(np.load(deps_path), changed, assume_unique=True).any():
+                kept += 1
+                continue
+            os.remove(pickle_path)
+            if os.path.exists(deps_path):
+                os.remove(deps_path)
+            removed += 1
+    return removed, kept
+
+
+_stores = {}
+def open_store(path):
+    # stores are read-only, so every caller in the process can share the same mappings
+    path = os.path.abspath(path)
+    if path not in _stores:
+        _stores[path] = NeighborhoodStore(path)
+    return _stores[path]
+
+
+def convert_pickle_cache(pickle_dir, store_path):
+    # Packs an existing cache of per-word pickles (either md5-prefixed folders as written by former
+    # versions of generate_cache.py, or a flat folder) into a neighborhood store
+    files = [os.path.join(root, f) for root, _, fs in os.walk(pickle_dir) for f in fs
+             if f.endswith('.pickle') and not f.startswith('numberbatch')]
+
+    print('Collecting nodes and relations..')
+    degrees = {}
+    names, relations = set(), set()
+    n_edges = n_rels = 0
+    for filepath in tqdm(files):
+        word = os.path.basename(filepath)[:-len('.pickle')]
+        neighborhood = pickle.load(open(filepath, 'rb'))
+        word_rels = sum(len(node['rels']) for node in neighborhood.values())
+        degrees[word] = (len(neighborhood), word_rels)
+        names.add(word)
+        names.update(neighborhood)
+        for node in neighborhood.values():
+            relations.update(node['rels'])
+        n_edges += len(neighborhood)
+        n_rels += word_rels
+
+    nodes = sorted(names)
+    node_ids = {n: i for i, n in enumerate(nodes)}
+    relations = sorted(relations)
+    assert len(relations) <= 256, 'relation ids are stored as uint8'
+    relation_ids = {r: i for i, r in enumerate(relations)}
+
+    os.makedirs(store_path, exist_ok=True)
+    indptr = np.zeros(len(nodes) + 1, dtype=np.int64)
+    rels_indptr = np.zeros(len(nodes) + 1, dtype=np.int64)
+    for word, (degree, word_rels) in degrees.items():
+        indptr[node_ids[word] + 1] = degree
+        rels_indptr[node_ids[word] + 1] = word_rels
+    np.cumsum(indptr, out=indptr)
+    np.cumsum(rels_indptr, out=rels_indptr)
+    indices = create_array(store_path, 'indices', np.int32, n_edges)
+    sims = create_array(store_path, 'sims', np.float32, n_edges)
+    rel_ids = create_array(store_path, 'rel_ids', np.uint8, n_rels)
+    rel_counts = np.zeros(n_edges, dtype=np.int64)
+
+    print('Packing neighborhoods..')
+    for filepath in tqdm(files):
+        word = os.path.basename(filepath)[:-len('.pickle')]
+        neighborhood = pickle.load(open(filepath, 'rb'))
+        e, r = indptr[node_ids[word]], rels_indptr[node_ids[word]]
+        for o in sorted(neighborhood, key=node_ids.get):
+            rels = [relation_ids[rel] for rel in neighborhood[o]['rels']]
+            indices[e] = node_ids[o]
+            sims[e] = neighborhood[o]['sim']
+            rel_counts[e] = len(rels)
+            rel_ids[r:r + len(rels)] = rels
+            e, r = e + 1, r + len(rels)
+
+    # nodes are laid out in id order for both edges and relations, so the per-edge offsets follow
+    rel_indptr = np.zeros(n_edges + 1, dtype=np.int64)
+    np.cumsum(rel_counts, out=rel_indptr[1:])
+
+    indices.flush(), sims.flush(), rel_ids.flush()
+    save_string_table(store_path, 'nodes', nodes)
+    save_relations(store_path, relations)
+    np.save(os.path.join(store_path, 'indptr.npy'), indptr)
+    np.save(os.path.join(store_path, 'rel_indptr.npy'), rel_indptr)
+    save_meta(store_path, {'version': STORE_VERSION, 'id': uuid.uuid4().hex, 'nodes': len(nodes), 'edges': n_edges, 'relations': len(relations)})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Pack a cache of per-word neighborhood pickles into a neighborhood store')
+    parser.add_argument('-i', '--pickle_cache_path', type=str, help="Path to the folder of per-word pickles", required=True)
+    parser.add_argument('-o', '--store_path', type=str, help="Path to the folder where the store will be saved", required=True)
+    parser.add_argument('-nb', '--embeddings_path', type=str, help="Path to the Numberbatch embeddings to link the store to", default=None)
+    args = parser.parse_args()
+
+    convert_pickle_cache(args.pickle_cache_path, args.store_path)
+    if args.embeddings_path is not None:
+        from embeddings import load_embeddings
+        link_embeddings(args.store_path, load_embeddings(args.embeddings_path))
+    print('Neighborhood store saved at', args.store_path)
@@ -0,0 +1,102 @@
+import os
+import json
+import itertools
+from collections import Counter
+import numpy as np
+import pandas as pd
+import multiprocessing as mp
+from tqdm import tqdm
+
+from prefetch import atomic_write
+from tokenization import preprocess
+
+###
+#   Streaming classification of the datasets that do not fit in memory
+#
+#   The dataset is read in chunks of documents, which are preprocessed and scored by forked workers
+#   (a window of one chunk per worker at a time), and the results are appended in order to:
+#     <output>-probabilities.f32    float32 document x label scores (see read_probabilities)
+#     <output>-predictions.txt      predicted label of each document, one per line
+#     <output>-checkpoint.json      configuration, documents written so far and the sizes of both files
+#   The checkpoint is replaced once the outputs of a window are flushed to disk. A run that stopped
+#   resumes after its last checkpoint, truncating whatever was written after it, provided that its
+#   configuration (including a fingerprint of the scoring engine) is the same.
+###
+
+STREAM_VERSION = 1
+
+# set before forking the workers of stream_predictions, which inherit the scoring engine
+_stream_state = None
+
+
+def score_chunk(texts):
+    engine, sim, ngrams, normalize, language = _stream_state
+    return engine.predict([preprocess(text, language) for text in texts], sim, ngrams, normalize)
+
+
+def output_paths(output_path):
+    return output_path + '-probabilities.f32', output_path + '-predictions.txt', output_path + '-checkpoint.json'
+
+
+def stream_predictions(dataset_path, output_path, engine, sim, ngrams, normalize, chunk_size, workers=mp.cpu_count(), language='en', parameters=None):
+    # scores the `text` column of the dataset chunk by chunk, resuming from the checkpoint of
+    # `output_path` if there is one, and returns the number of documents scored overall;
+    # `parameters` (e.g. depth, filter, relations) are recorded in the checkpoint along with the engine
+    global _stream_state
+    probs_path, preds_path, checkpoint_path = output_paths(output_path)
+    config = {'format': STREAM_VERSION, 'dataset': os.path.abspath(dataset_path), 'labels': engine.labels, 'similarity': sim,
+              'ngrams': ngrams is not None, 'normalize': normalize, 'language': language, 'engine': engine.fingerprint(),
+              'parameters': parameters or {}}
+    state = {'config': config, 'documents': 0, 'probabilities_size': 0, 'predictions_size': 0}
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as f:
+            state = json.load(f)
+        if state['config'] != config:
+            raise ValueError(f'{checkpoint_path} was written by a run with another configuration, remove it to start over')
+        print(f"Resuming after {state['documents']:,} documents")
+
+    # the outputs may hold the results of a window that was written after the last checkpoint
+    for path, size in ((probs_path, state['probabilities_size']), (preds_path, state['predictions_size'])):
+        with open(path, 'ab') as f:
+            f.truncate(size)
+
+    # skipped with a callable, as pandas turns a range of rows into a set
+    done = state['documents']
+    reader = pd.read_csv(dataset_path, usecols=['text'], chunksize=chunk_size, skiprows=lambda i: 0 < i <= done)
+    _stream_state = (engine, sim, ngrams, normalize, language)
+    with mp.get_context('fork').Pool(processes=workers) as pool, open(probs_path, 'ab') as probs_file, \
+            open(preds_path, 'ab') as preds_file, tqdm(initial=state['documents'], unit=' docs') as progress:
+        for window in iter(lambda: list(itertools.islice(reader, workers)), []):
+            for scores in pool.map(score_chunk, [chunk.text.fillna('').tolist() for chunk in window]):
+                probs_file.write(scores.astype(np.float32).tobytes())
+                preds_file.write(''.join(engine.labels[p] + '\n' for p in np.argmax(scores, axis=1)).encode('utf-8'))
+                state['documents'] += len(scores)
+                progress.update(len(scores))
+            for f in (probs_file, preds_file):
+                f.flush()
+                os.fsync(f.fileno())
+            state['probabilities_size'], state['predictions_size'] = probs_file.tell(), preds_file.tell()
+            atomic_write(checkpoint_path, json.dumps(state).encode('utf-8'))
+    _stream_state = None
+    return state['documents']
+
+
+def read_probabilities(output_path, n_labels):
+    # memory-mapped document x label scores written by stream_predictions
+    return np.memmap(output_paths(output_path)[0], dtype=np.float32, mode='r').reshape(-1, n_labels)
+
+
+def read_predictions(output_path):
+    with open(output_paths(output_path)[1], encoding='utf-8') as f:
+        return [line.rstrip('\n') for line in f]
+
+
+def count_predictions(output_path, dataset_path, chunk_size):
+    # number of documents of each (predicted label, `label` column) pair, with the dataset read in
+    # chunks alongside the predictions so that neither is held in memory
+    counts = Counter()
+    with open(output_paths(output_path)[1], encoding='utf-8') as preds_file:
+        predictions = (line.rstrip('\n') for line in preds_file)
+        for chunk in pd.read_csv(dataset_path, usecols=['label'], chunksize=chunk_size):
+            counts.update(zip(itertools.islice(predictions, len(chunk)), chunk.label))
+    return counts
@@ -0,0 +1,147 @@
+import argparse
+import itertools
+import multiprocessing as mp
+import nltk
+
+from utils import *
+
+###
+#   Sweep over experiment configurations
+#
+#   Every stage is computed once for the parameters it depends on, and reused by all the
+#   configurations sharing them:
+#     preprocessed documents, n-grams         once
+#     label neighborhoods                     per depth (and prefetched across runs)
+#     filtered neighborhoods                  per depth, allowed_rels, filter, similarity
+#     scoring engine                          per filtered neighborhoods
+#     document matrix                         per scoring engine and use of n-grams
+#     scores                                  per normalization
+#   The configurations sharing filtered neighborhoods form a group, and the groups are scored in
+#   parallel by forked processes.
+###
+
+SWEEP_PARAMETERS = ['depth', 'allowed_rels', 'filter', 'similarity', 'ngrams', 'normalize']
+METRICS = ['accuracy', 'precision', 'recall', 'f1']
+
+# set before forking the workers of run_group, which inherit the corpus and the filtered
+# neighborhoods instead of receiving a pickled copy
+_sweep_state = None
+
+
+def parse_bool(value):
+    return value.lower() in ('true', 'yes', '1')
+
+
+def run_group(group):
+    # scores and evaluates the configurations sharing the filtered neighborhoods of the group
+    (depth, allowed_rels, keep, sim), configs = group
+    corpus_preprocessed, sorted_labels, filtered_neighborhoods, ngrams_matcher, gt_labels, labels_mapping = _sweep_state
+    engine = ScoringEngine(sorted_labels, filtered_neighborhoods[(depth, allowed_rels, keep, sim)], [sim])
+
+    counts = {}
+    results = []
+    for config in configs:
+        if config['ngrams'] not in counts:
+            counts[config['ngrams']] = engine.document_matrix(corpus_preprocessed, ngrams_matcher if config['ngrams'] else None)
+        predicted_probs = engine.score(counts[config['ngrams']], sim, config['normalize'])
+        predicted_labels = [sorted_labels[p] for p in np.argmax(predicted_probs, axis=1)]
+        # evaluate() resolves the multi-label ground truth in place
+        acc, pre, rec, f1, _, _ = evaluate(predicted_labels, list(gt_labels), labels_mapping)
+        results.append(dict(config, accuracy=acc, precision=pre, recall=rec, f1=f1))
+    return results
+
+
+if __name__ == "__main__":
+    ###
+    #   Parsing Arguments
+    ###
+
+    parser = argparse.ArgumentParser(description='Zero-Shot Topic Extraction: sweep over a grid of configurations')
+
+    parser.add_argument("-cp", "--cache_path", type=str, help="Path to the neighborhood store where the 1-hop word neighborhoods are cached",
+                        default='zeste_cache/neighborhoods_en')
+    parser.add_argument('-pp', '--prefetch_path', type=str, help="Path to where the precomputed n-hop neighborhoods are cached",
+                        default='prefetch_cache')
+    parser.add_argument('-nb', '--numberbatch_path', type=str, help="Path to the memory-mapped Numberbatch",
+                        default='zeste_cache/numberbatch-en-19.08')
+    parser.add_argument('-dp', '--dataset_path', type=str, help="Path to the dataset to process",
+                        default='data/bbc_dataset.csv')
+    parser.add_argument('-cc', '--corpus_cache_path', type=str, help="Path to where the preprocessed datasets are cached",
+                        default='corpus_cache')
+    parser.add_argument('-lm', '--labels_mapping', type=str, help="Path to the mapping between the dataset labels and ZeSTE labels (multiword labels are comma-separated)",
+                        default='labels_mapping/bbc_labels_mapping.txt')
+    parser.add_argument('-rp', '--results_path', type=str, help="Path to the directory where to store the results table",
+                        required=True)
+    parser.add_argument('-d', '--depth', type=int, nargs='+', help="How many hops to generate the neighborhoods", default=[2])
+    parser.add_argument('-f', '--filter', type=str, nargs='+', help="Filtering methods: 'top[N]', 'top[P]%'', 'thresh[T]', 'all'", default=['all'])
+    parser.add_argument('-s', '--similarity', type=str, nargs='+', choices=SIMILARITIES, default=SIMILARITIES)
+    parser.add_argument('-n', '--use_ngrams', type=parse_bool, nargs='+', help="Whether or not to use n-grams (true, false)", default=[True, False])
+    parser.add_argument('-nm', '--normalize', type=str, nargs='+', choices=['inter_len', 'max_score', 'none'], default=['inter_len', 'max_score', 'none'])
+    parser.add_argument('-ar', '--allowed_rels', type=str, nargs='+', help="Which relationships to use (comma-separated, 'related' or 'all')", default=['all'])
+    parser.add_argument('-w', '--workers', type=int, help="Number of processes computing the label neighborhoods and scoring the configurations", default=mp.cpu_count())
+
+    args = parser.parse_args()
+
+    configs = [dict(zip(SWEEP_PARAMETERS, values)) for values in itertools.product(
+        args.depth, args.allowed_rels, args.filter, args.similarity, args.use_ngrams, args.normalize)]
+    groups = {}
+    for config in configs:
+        groups.setdefault((config['depth'], config['allowed_rels'], config['filter'], config['similarity']), []).append(config)
+    print(f'{len(configs)} configurations in {len(groups)} groups of filtered neighborhoods')
+
+    print('Loading nltk..')
+    nltk.download('stopwords')
+    nltk.download('wordnet')
+    nltk.download('omw-1.4')
+
+    ###
+    #   Loading & Preprocessing Data
+    ###
+
+    print('Loading numberbatch..')
+    numberbatch = load_embeddings(args.numberbatch_path)
+    store = open_store(args.cache_path)
+
+    df_dataset = pd.read_csv(args.dataset_path)
+    gt_labels = df_dataset.label.tolist()
+
+    print('Preprocessing all documents..')
+    corpus_preprocessed = load_corpus(args.dataset_path, args.corpus_cache_path)
+    ngrams_matcher = get_ngrams_matcher(corpus_preprocessed, numberbatch) if any(args.use_ngrams) else None
+
+    labels_mapping = dict(l.strip().split('\t') for l in open(args.labels_mapping))
+    sorted_labels = sorted(set(labels_mapping.values()))
+
+    ###
+    #   Generate and filter Label Neighborhoods
+    ###
+
+    labels_neighborhoods = {}
+    for depth in sorted(set(args.depth)):
+        print(f'Computing neighborhoods of depth {depth}..')
+        labels_neighborhoods[depth] = get_labels_neighborhoods(sorted_labels, depth, numberbatch, store, args.prefetch_path, args.workers)
+
+    filtered_neighborhoods = {}
+    for depth, allowed_rels, keep, sim in groups:
+        filtered_neighborhoods[(depth, allowed_rels, keep, sim)] = {
+            label: filter_neighborhoood(labels_neighborhoods[depth][label], allowed_rels, sim, keep) for label in sorted_labels}
+
+    ###
+    #   Score and evaluate every configuration
+    ###
+
+    print('Scoring the configurations..')
+    _sweep_state = (corpus_preprocessed, sorted_labels, filtered_neighborhoods, ngrams_matcher, gt_labels, labels_mapping)
+    if args.workers > 1 and len(groups) > 1:
+        with mp.get_context('fork').Pool(processes=min(args.workers, len(groups))) as pool:
+            results = list(itertools.chain.from_iterable(tqdm(pool.imap_unordered(run_group, groups.items()), total=len(groups))))
+    else:
+        results = list(itertools.chain.from_iterable(run_group(group) for group in tqdm(groups.items())))
+
+    df_results = pd.DataFrame(results, columns=SWEEP_PARAMETERS + METRICS).sort_values('f1', ascending=False)
+    os.makedirs(args.results_path, exist_ok=True)
+    results_file_path = os.path.join(args.results_path, f"{args.dataset_path.split('/')[-1]}-sweep.csv")
+    df_results.to_csv(results_file_path, index=False)
+
+    print(df_results.head(10).to_string(index=False))
+    print('Results of all the configurations saved at', results_file_path)
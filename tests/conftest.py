@@ -0,0 +1,69 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from store import save_store, link_embeddings, open_store
+from embeddings import save_embeddings, load_embeddings, normalize_rows
+
+###
+#   A small ConceptNet-like graph around three labels, with the embeddings of its words
+###
+
+TRIPLES = [
+    ('sport', 'relatedto', 'football'), ('sport', 'relatedto', 'game'), ('sport', 'isa', 'activity'),
+    ('football', 'relatedto', 'team'), ('football', 'isa', 'game'), ('game', 'relatedto', 'player'),
+    ('team', 'relatedto', 'player'), ('team', 'partof', 'league'), ('player', 'antonym', 'spectator'),
+    ('politics', 'relatedto', 'election'), ('politics', 'relatedto', 'government'), ('politics', 'isa', 'activity'),
+    ('election', 'relatedto', 'vote'), ('election', 'relatedto', 'campaign'), ('government', 'relatedto', 'law'),
+    ('vote', 'synonym', 'ballot'), ('campaign', 'relatedto', 'team'), ('law', 'antonym', 'chaos'),
+    ('space', 'relatedto', 'rocket'), ('space', 'relatedto', 'planet'), ('space', 'relatedto', 'star'),
+    ('rocket', 'relatedto', 'launch'), ('planet', 'relatedto', 'orbit'), ('star', 'relatedto', 'sun'),
+    ('star', 'relatedto', 'player'), ('orbit', 'synonym', 'trajectory'), ('launch', 'relatedto', 'campaign'),
+    ('new_york', 'relatedto', 'city'), ('city', 'relatedto', 'government'), ('and', 'relatedto', 'game'),
+]
+
+LABELS = ['politics', 'space', 'sport']
+
+
+def graph_rows(triples):
+    # {subject: {object: relations}} with the reverse of every triple and the 'sameas' self edges
+    rows = {}
+    for s, r, o in triples:
+        rows.setdefault(s, {}).setdefault(o, set()).add(r)
+        rows.setdefault(o, {}).setdefault(s, set()).add(r)
+    for s, row in rows.items():
+        row[s] = row.get(s, set()) | {'sameas'}
+    return rows
+
+
+def save_graph(store_path, rows, embeddings):
+    # packs `rows` into a neighborhood store, with the similarities of the embeddings
+    nodes = sorted(rows)
+    ids = {n: i for i, n in enumerate(nodes)}
+    relations = sorted({r for row in rows.values() for rels in row.values() for r in rels})
+    indptr, indices, sims, rel_indptr, rel_ids = [0], [], [], [0], []
+    for s in nodes:
+        for o in sorted(rows[s], key=ids.get):
+            indices.append(ids[o])
+            sims.append(1. if s == o else embeddings.similarity(s, o))
+            rels = ['sameas'] + sorted(rows[s][o] - {'sameas'}) if s == o else sorted(rows[s][o])
+            rel_ids.extend(relations.index(r) for r in rels)
+            rel_indptr.append(len(rel_ids))
+        indptr.append(len(indices))
+    save_store(store_path, nodes, relations, indptr, indices, sims, rel_indptr, rel_ids)
+    link_embeddings(store_path, embeddings)
+
+
+@pytest.fixture
+def graph(tmp_path):
+    # (embeddings, store) of TRIPLES, the vectors being positive so that every similarity is
+    rows = graph_rows(TRIPLES)
+    words = sorted(rows)
+    vectors = normalize_rows(np.random.default_rng(0).random((len(words), 16)))
+    save_embeddings(str(tmp_path / 'embeddings'), words, vectors)
+    embeddings = load_embeddings(str(tmp_path / 'embeddings'))
+    save_graph(str(tmp_path / 'store'), rows, embeddings)
+    return embeddings, open_store(str(tmp_path / 'store'))
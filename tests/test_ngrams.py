@@ -0,0 +1,40 @@
+import numpy as np
+
+from corpus import extract_ngrams
+from ngrams import NgramMatcher
+
+CORPUS = [
+    'new york city is a big city', 'the new york times', 'york city council', 'ice cream in new york',
+    'a new yorker eats ice cream', 'big city new york city', 'the times of new york city',
+]
+
+
+def baseline_ngrams(tokens, ngrams):
+    # the detection of the former score(): a substring test of every n-gram in the joined tokens,
+    # restricted to token boundaries
+    doc = ' ' + ' '.join(tokens) + ' '
+    return {ngram.replace(' ', '_') for ngram in ngrams if ' ' + ngram + ' ' in doc}
+
+
+def test_matches_baseline():
+    docs = [d.split() for d in CORPUS]
+    ngrams = extract_ngrams(docs)
+    assert 'new york city' in ngrams and 'ice cream' in ngrams
+    matcher = NgramMatcher(ngrams)
+
+    vocabulary = sorted({t for d in docs for t in d})
+    rng = np.random.default_rng(0)
+    for tokens in docs + [list(rng.choice(vocabulary, 12)) for _ in range(200)] + [[]]:
+        found = matcher.match(tokens)
+        assert len(found) == len(set(found))
+        assert set(found) == baseline_ngrams(tokens, ngrams)
+
+
+def test_token_boundaries():
+    matcher = NgramMatcher(['new york', 'york city', 'new york city', 'ice cream'])
+    assert matcher.match('i love new york city'.split()) == ['new_york', 'new_york_city', 'york_city']
+    assert matcher.match('new york new york'.split()) == ['new_york']
+    # unlike the substring test of the former score(), which also found 'new york' here
+    assert matcher.match('a new yorker'.split()) == []
+    assert matcher.match(['new', 'york_city']) == []
+    assert len(matcher) == 4
@@ -0,0 +1,57 @@
+import os
+import numpy as np
+import pytest
+
+import store as store_module
+from neighborhood import expand_neighborhood
+from prefetch import CHECKSUM_SIZE, atomic_write, checksum, open_prefetch
+
+
+@pytest.fixture
+def prefetch(graph, tmp_path):
+    embeddings, store = graph
+    cache = open_prefetch(str(tmp_path / 'prefetch'), 2, embeddings, store, ())
+    neighborhood, dependencies = expand_neighborhood('sport', 2, embeddings, store, with_dependencies=True)
+    cache.put('sport', neighborhood, dependencies)
+    return cache, neighborhood
+
+
+def test_round_trip(prefetch):
+    cache, neighborhood = prefetch
+    cached = cache.get('sport')
+    assert cached.names == neighborhood.names
+    np.testing.assert_array_equal(cached.sims, neighborhood.sims)
+    assert cached.to_dict() == neighborhood.to_dict()
+    assert cache.get('space') is None
+
+
+def test_corrupted_entry(prefetch):
+    cache, _ = prefetch
+    path = cache.entry_path('sport')
+    with open(path, 'r+b') as f:
+        f.seek(CHECKSUM_SIZE + 10)
+        byte = f.read(1)[0]
+        f.seek(CHECKSUM_SIZE + 10)
+        f.write(bytes([byte ^ 0xff]))
+    assert cache.get('sport') is None
+    assert not os.path.exists(path)
+
+
+def test_truncated_entry(prefetch):
+    # a payload cut short, with a checksum that matches it
+    cache, _ = prefetch
+    path = cache.entry_path('sport')
+    with open(path, 'rb') as f:
+        payload = f.read()[CHECKSUM_SIZE:]
+    atomic_write(path, checksum(payload[:-20]) + payload[:-20])
+    assert cache.get('sport') is None
+    assert not os.path.exists(path)
+
+
+def test_moved_store(prefetch, graph, monkeypatch):
+    cache, _ = prefetch
+    _, store = graph
+    os.rename(store.path, store.path + '-moved')
+    monkeypatch.setattr(store_module, '_stores', {})
+    assert cache.get('sport') is None
+    assert not os.path.exists(cache.entry_path('sport'))
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+from conftest import LABELS
+from neighborhood import SIMILARITIES, LabelNeighborhood, expand_neighborhood
+from ngrams import NgramMatcher
+from scoring import ScoringEngine
+from utils import score
+
+DOCS = [
+    ['football', 'team', 'player', 'game'], ['vote', 'election', 'law', 'city'], ['rocket', 'orbit', 'sun', 'star'],
+    ['player', 'star', 'campaign', 'launch'], ['new', 'york', 'city', 'government', 'new', 'york'], ['and', 'the', 'of'],
+    ['team', 'team', 'player', 'ballot', 'trajectory', 'chaos'], [], ['spectator', 'league', 'activity', 'activity'],
+]
+
+
+def with_sims(neighborhood, sims):
+    copy = neighborhood.take(np.arange(len(neighborhood)))
+    copy.sims = sims
+    return copy
+
+
+@pytest.fixture
+def neighborhoods(graph):
+    embeddings, store = graph
+    neighborhoods = {label: expand_neighborhood(label, 2, embeddings, store) for label in LABELS}
+    # labels whose similarities sum to 0, without and with matches of a nonzero similarity
+    politics, space = neighborhoods['politics'], neighborhoods['space']
+    neighborhoods['zero'] = with_sims(politics, np.zeros_like(politics.sims))
+    balanced = np.zeros_like(space.sims)
+    balanced[:len(space) // 2 * 2] = np.tile([[.5], [-.5]], (len(space) // 2, len(SIMILARITIES)))
+    neighborhoods['balanced'] = with_sims(space, balanced)
+    return neighborhoods
+
+
+def reference_scores(docs, neighborhoods, labels, sim, ngrams, normalize):
+    # score() on the dictionaries of the former neighborhoods, whose similarities were float32
+    dictionaries = {label: {word: {'sim': {s: np.float32(v) for s, v in node['sim'].items()}} for word, node in neighborhoods[label].items()}
+                    for label in labels}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.array([[score(doc, dictionaries[label], sim, ngrams, normalize) for label in labels] for doc in docs], dtype=np.float64)
+
+
+@pytest.mark.parametrize('normalize', ['inter_len', 'max_score', 'none'])
+@pytest.mark.parametrize('sim', SIMILARITIES)
+@pytest.mark.parametrize('use_ngrams', [False, True])
+def test_engine_matches_score(neighborhoods, sim, normalize, use_ngrams):
+    labels = sorted(neighborhoods)
+    ngrams = NgramMatcher(['new york', 'york city']) if use_ngrams else None
+    scores = ScoringEngine(labels, neighborhoods).predict(DOCS, sim, ngrams, normalize)
+    expected = reference_scores(DOCS, neighborhoods, labels, sim, ngrams, normalize)
+
+    np.testing.assert_allclose(scores, expected, rtol=0, atol=1e-6)
+    if normalize == 'max_score':
+        assert np.isnan(scores[:, labels.index('zero')]).any() and np.isinf(scores[:, labels.index('balanced')]).any()
+    # the predictions are the same, but for scores that the rounding error may have tied or untied
+    finite = np.where(np.isfinite(expected), expected, 0)
+    top2 = np.sort(finite, axis=1)[:, -2:] if len(labels) > 1 else finite
+    clear = top2[:, 1] - top2[:, 0] > 2e-6
+    assert (np.argmax(scores, axis=1) == np.argmax(expected, axis=1))[clear].all()
+
+
+def test_empty_neighborhood(graph, neighborhoods):
+    _, store = graph
+    neighborhoods['unknown'] = LabelNeighborhood.empty(store, 'unknown')
+    labels = sorted(neighborhoods)
+    scores = ScoringEngine(labels, neighborhoods).predict(DOCS, 'simple', None, 'max_score')
+    assert (scores[:, labels.index('unknown')] == 0).all()
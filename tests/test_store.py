@@ -0,0 +1,61 @@
+import os
+import hashlib
+import pickle
+import numpy as np
+
+from conftest import TRIPLES, graph_rows
+from store import convert_pickle_cache, open_store, save_string_table, StringTable
+
+
+def expected_neighborhood(rows, embeddings, word):
+    return {o: {'rels': ['sameas'] + sorted(rels - {'sameas'}) if o == word else sorted(rels),
+                'sim': np.float32(1. if o == word else embeddings.similarity(word, o)), 'from': [word]}
+            for o, rels in rows[word].items()}
+
+
+def test_round_trip(graph):
+    embeddings, store = graph
+    rows = graph_rows(TRIPLES)
+    assert len(store) == len(rows)
+    assert list(store.nodes) == sorted(rows)
+    assert store.meta['embeddings'] == embeddings.fingerprint
+    for word in rows:
+        assert word in store
+        assert store.node(store.node_id(word)) == word
+        assert store.neighborhood(word) == expected_neighborhood(rows, embeddings, word)
+        np.testing.assert_array_equal(store.nodes.indices([word]), [store.node_id(word)])
+    assert 'unknown' not in store and store.node_id('unknown') == -1
+    rows_of = store.embedding_rows(embeddings)
+    assert [embeddings.vocab[r] for r in rows_of] == list(store.nodes)
+
+
+def test_string_table(tmp_path):
+    words = sorted(['été', 'space', 'spacecraft', 'spaceship', 'sport', 'a', 'zèbre'])
+    save_string_table(str(tmp_path), 'words', words)
+    table = StringTable(str(tmp_path), 'words')
+    assert list(table) == words
+    assert [table.index(w) for w in words] == list(range(len(words)))
+    assert table.index('spac') == -1 and table.position('spac') == words.index('space')
+    lo, hi = table.prefix_range('space')
+    assert words[lo:hi] == ['space', 'spacecraft', 'spaceship']
+    assert table.prefix_range('x') == (words.index('zèbre'), words.index('zèbre'))
+
+
+def test_convert_pickle_cache(graph, tmp_path):
+    # the former cache: one pickle per word, in md5-prefixed folders
+    embeddings, store = graph
+    rows = graph_rows(TRIPLES)
+    for word in rows:
+        folder = tmp_path / 'pickles' / hashlib.md5(word.encode('utf-8')).hexdigest()[:2]
+        os.makedirs(folder, exist_ok=True)
+        with open(folder / (word + '.pickle'), 'wb') as f:
+            pickle.dump(expected_neighborhood(rows, embeddings, word), f)
+
+    convert_pickle_cache(str(tmp_path / 'pickles'), str(tmp_path / 'converted'))
+    converted = open_store(str(tmp_path / 'converted'))
+    assert list(converted.nodes) == list(store.nodes)
+    assert converted.relations == store.relations
+    for word in rows:
+        assert converted.neighborhood(word) == store.neighborhood(word)
+    for name in ['indptr', 'indices', 'sims', 'rel_indptr', 'rel_ids']:
+        np.testing.assert_array_equal(getattr(converted, name), getattr(store, name))
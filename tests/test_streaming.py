@@ -0,0 +1,64 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import streaming
+from conftest import LABELS
+from neighborhood import expand_neighborhood
+from scoring import ScoringEngine
+from streaming import stream_predictions, read_probabilities, read_predictions, output_paths
+
+WORDS = ['football', 'team', 'player', 'vote', 'election', 'law', 'rocket', 'orbit', 'sun', 'the', 'and', 'city']
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    rng = np.random.default_rng(0)
+    texts = [' '.join(rng.choice(WORDS, 6)) for _ in range(53)]
+    path = tmp_path / 'dataset.csv'
+    pd.DataFrame({'text': texts, 'label': rng.choice(LABELS, len(texts))}).to_csv(path, index=False)
+    return str(path)
+
+
+def engine(graph, allowed_rels='all'):
+    embeddings, store = graph
+    neighborhoods = {label: expand_neighborhood(label, 2, embeddings, store).filter(allowed_rels, 'simple', 'all') for label in LABELS}
+    return ScoringEngine(LABELS, neighborhoods, ['simple'])
+
+
+def outputs(output_path):
+    return [open(path, 'rb').read() for path in output_paths(output_path)[:2]]
+
+
+def test_resume_after_interruption(graph, dataset, tmp_path, monkeypatch):
+    scoring_engine = engine(graph)
+    n = stream_predictions(dataset, str(tmp_path / 'whole'), scoring_engine, 'simple', None, 'max_score', 5, workers=2)
+    assert n == 53
+    assert read_probabilities(str(tmp_path / 'whole'), len(LABELS)).shape == (53, len(LABELS))
+    assert len(read_predictions(str(tmp_path / 'whole'))) == 53
+
+    # the run is interrupted while checkpointing its third window, after its outputs were written
+    atomic_write = streaming.atomic_write
+    checkpoints = []
+    def interrupted(path, data):
+        checkpoints.append(path)
+        if len(checkpoints) == 3:
+            raise KeyboardInterrupt
+        atomic_write(path, data)
+    monkeypatch.setattr(streaming, 'atomic_write', interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        stream_predictions(dataset, str(tmp_path / 'resumed'), scoring_engine, 'simple', None, 'max_score', 5, workers=2)
+    monkeypatch.setattr(streaming, 'atomic_write', atomic_write)
+
+    # resumed with another chunk size, after the 20 documents of the first two windows
+    assert stream_predictions(dataset, str(tmp_path / 'resumed'), scoring_engine, 'simple', None, 'max_score', 7, workers=2) == 53
+    assert outputs(str(tmp_path / 'resumed')) == outputs(str(tmp_path / 'whole'))
+
+
+def test_resume_with_another_configuration(graph, dataset, tmp_path):
+    output_path = str(tmp_path / 'out')
+    stream_predictions(dataset, output_path, engine(graph), 'simple', None, 'max_score', 10, workers=1, parameters={'depth': 2})
+    with pytest.raises(ValueError):
+        stream_predictions(dataset, output_path, engine(graph, ['isa']), 'simple', None, 'max_score', 10, workers=1, parameters={'depth': 2})
+    with pytest.raises(ValueError):
+        stream_predictions(dataset, output_path, engine(graph), 'simple', None, 'max_score', 10, workers=1, parameters={'depth': 3})
@@ -0,0 +1,92 @@
+import os
+import numpy as np
+import pytest
+
+pytest.importorskip('gensim')
+
+from conftest import TRIPLES, save_graph
+from embeddings import load_embeddings, normalize_rows, save_embeddings
+from generate_cache import reverse_rels
+from store import NeighborhoodStore, invalidate_dependents, save_dependencies
+from update_cache import read_delta, update_store
+
+# new nodes before, between and after the nodes of the store, a new relation, and a node left without edges
+DELTA = [
+    ('+', 'sport', 'relatedto', 'aardvark'), ('+', 'space', 'relatedto', 'telescope'), ('+', 'telescope', 'usedfor', 'star'),
+    ('+', 'zoo', 'relatedto', 'game'), ('+', 'vote', 'relatedto', 'law'), ('-', 'law', 'antonym', 'chaos'),
+    ('-', 'sport', 'relatedto', 'game'), ('-', 'team', 'relatedto', 'nothing'),
+]
+
+
+def graph_rows(triples):
+    # as generate_cache.py builds them: the reverse relation of every triple, and the 'sameas' self edges
+    rows = {}
+    for s, r, o in triples:
+        rows.setdefault(s, {}).setdefault(o, set()).add(r)
+        rows.setdefault(o, {}).setdefault(s, set()).add(reverse_rels[r])
+    for s, row in rows.items():
+        row[s] = row.get(s, set()) | {'sameas'}
+    return rows
+
+
+def assertion(s, r, o):
+    return '\t'.join(['/a/[...]', '/r/' + r, '/c/en/' + s, '/c/en/' + o, '{}'])
+
+
+@pytest.fixture
+def updated(tmp_path):
+    removed = {(s, r, o) for op, s, r, o in DELTA if op == '-'}
+    triples = [t for t in TRIPLES if t not in removed] + [(s, r, o) for op, s, r, o in DELTA if op == '+']
+    words = sorted(set(graph_rows(TRIPLES)) | set(graph_rows(triples)))
+    save_embeddings(str(tmp_path / 'embeddings'), words, normalize_rows(np.random.default_rng(0).random((len(words), 16))))
+    embeddings = load_embeddings(str(tmp_path / 'embeddings'))
+    save_graph(str(tmp_path / 'store'), graph_rows(TRIPLES), embeddings)
+    save_graph(str(tmp_path / 'expected'), graph_rows(triples), embeddings)
+
+    with open(tmp_path / 'delta.txt', 'w') as f:
+        f.write(''.join(op + '\t' + assertion(s, r, o) + '\n' for op, s, r, o in DELTA))
+    added, removed = read_delta(str(tmp_path / 'delta.txt'), 'en')
+    changed = update_store(str(tmp_path / 'store'), added, removed, embeddings)
+    return changed, embeddings, NeighborhoodStore(str(tmp_path / 'store')), NeighborhoodStore(str(tmp_path / 'expected'))
+
+
+def test_read_delta(tmp_path):
+    with open(tmp_path / 'delta.txt', 'w') as f:
+        f.write('+\t' + assertion('space', 'isa', 'place') + '\n-\t' + assertion('law', 'antonym', 'chaos') + '\n')
+        f.write('+\t' + '\t'.join(['/a/[...]', '/r/IsA', '/c/fr/espace', '/c/fr/lieu', '{}']) + '\n\n')
+    added, removed = read_delta(str(tmp_path / 'delta.txt'), 'en')
+    assert added == {('space', 'isa', 'place'), ('place', reverse_rels['isa'], 'space')}
+    assert removed == {('law', 'antonym', 'chaos'), ('chaos', 'antonym', 'law')}
+
+    with open(tmp_path / 'delta.txt', 'w') as f:
+        f.write('*\t' + assertion('space', 'isa', 'place') + '\n')
+    with pytest.raises(ValueError):
+        read_delta(str(tmp_path / 'delta.txt'), 'en')
+
+
+def test_update_store(updated):
+    changed, embeddings, store, expected = updated
+    assert changed == ['aardvark', 'chaos', 'game', 'law', 'space', 'sport', 'star', 'telescope', 'vote', 'zoo']
+    # 'chaos' lost its only edge, but stays in the node table
+    assert list(store.nodes) == sorted(list(expected.nodes) + ['chaos'])
+    assert store.neighborhood('chaos') == {}
+    for word in expected.nodes:
+        assert store.neighborhood(word) == expected.neighborhood(word), word
+    assert set(store.relations) == set(expected.relations)
+    assert store.meta['nodes'] == len(store) and store.meta['edges'] == len(store.indices)
+    np.testing.assert_array_equal(store.embedding_rows(embeddings), [embeddings.vocab.index(n) for n in store.nodes])
+
+
+def test_update_store_without_changes(updated):
+    _, embeddings, store, _ = updated
+    assert update_store(store.path, {('sport', 'relatedto', 'aardvark')}, {('team', 'relatedto', 'nothing')}, embeddings) == []
+
+
+def test_invalidate_dependents(tmp_path):
+    for name, dependencies in [('sport', ['sport', 'game', 'player']), ('space', ['space', 'star']), ('politics', None)]:
+        open(tmp_path / (name + '.pickle'), 'wb').close()
+        if dependencies is not None:
+            save_dependencies(str(tmp_path / (name + '.pickle')), dependencies)
+    # entries without dependencies cannot be checked, so they are removed as well
+    assert invalidate_dependents(str(tmp_path), ['game', 'law']) == (2, 1)
+    assert sorted(os.listdir(tmp_path)) == ['space.deps.npy', 'space.pickle']
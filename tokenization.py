@@ -0,0 +1,37 @@
+from functools import lru_cache
+from nltk.corpus import stopwords
+from nltk.stem import WordNetLemmatizer
+
+###
+#   Tokenization shared by the documents preprocessing and the neighborhoods expansion
+###
+
+# to be incremented whenever preprocess() changes, as it invalidates the preprocessed datasets cached by corpus.py
+PREPROCESSING_VERSION = 1
+
+LANGUAGES = {'en': 'english', 'fr': 'french'}
+PUNCTUATION = '!"#$%&\'()*+,./:;<=>?@[\\]^`{|}~'
+PUNCTUATION_TABLE = str.maketrans('', '', PUNCTUATION)
+
+
+@lru_cache(maxsize=None)
+def get_stopwords(language='en'):
+    # nltk re-reads the stopwords file on every call, so each language is only loaded once; the
+    # languages other than English use the French stopwords, as before
+    return frozenset(stopwords.words(LANGUAGES.get(language, 'french')))
+
+
+lemmatizer = WordNetLemmatizer()
+@lru_cache(maxsize=2**18)
+def lemmatize(word):
+    return lemmatizer.lemmatize(word)
+
+
+def preprocess(document, language='en'):
+    document = document.replace("'ll", ' will').replace("s' ", 's').replace("'s", '').replace("-", '_')
+    document = document.translate(PUNCTUATION_TABLE)
+    language_stopwords = get_stopwords(language)
+    tokens = [w for w in document.lower().split(' ') if w not in language_stopwords]
+    if language == 'en':
+        return [lemmatize(w) for w in tokens if w != '']
+    return [w for w in tokens if w != '']
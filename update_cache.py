@@ -0,0 +1,218 @@
+import os
+import time
+import heapq
+import shutil
+import argparse
+import numpy as np
+
+from store import NeighborhoodStore, create_array, save_string_table, save_relations, save_meta, invalidate_dependents
+from embeddings import load_embeddings
+from generate_cache import reverse_rels, parse_assertion
+
+###
+#   Incremental update of a neighborhood store
+#
+#   A delta file lists assertions in the format of the ConceptNet dump, each one prefixed by `+`
+#   (added) or `-` (removed) and a tab. Only the 1-hop neighborhoods of the subjects of the changed
+#   triples (and of their reverse) are rebuilt, the other ones are copied over in bulk with their
+#   node ids shifted by the inserted nodes. The cached multi-hop neighborhoods that read any of the
+#   rebuilt neighborhoods are then removed.
+###
+
+COPY_BLOCK = 2**24
+
+
+def read_delta(path, language):
+    prefix = '/c/' + language + '/'
+    added, removed = set(), set()
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if not line:
+                continue
+            op, assertion = line.split('\t', 1)
+            if op not in ('+', '-'):
+                raise ValueError(f'Unknown operation {op!r} in the delta (expected + or -)')
+            triple = parse_assertion(assertion, prefix)
+            if triple is None:
+                continue
+            s, r, o = triple
+            if r not in reverse_rels:
+                raise ValueError(f'Unknown relation {r!r}, its reverse must be added to generate_cache.reverse_rels')
+            (added if op == '+' else removed).update([(s, r, o), (o, reverse_rels[r], s)])
+    # the store does not count the assertions behind a triple, so removing an assertion removes its
+    # triples even when another assertion (e.g. of a symmetric relation) also produced them
+    return added, removed - added
+
+
+def read_row(store, word):
+    # {object: [relations, similarity]} of the 1-hop neighborhood of `word`
+    node_id = store.node_id(word)
+    if node_id < 0:
+        return {}
+    edges = store.edges(node_id)
+    return {store.node(o): [set(store.edge_rels(e)), float(sim)]
+            for e, o, sim in zip(range(edges.start, edges.stop), store.indices[edges], store.sims[edges])}
+
+
+def update_rows(store, added, removed):
+    # updated 1-hop neighborhoods of the subjects whose neighborhood changes
+    subjects = {s for s, _, _ in added | removed}
+    rows = {s: read_row(store, s) for s in subjects}
+    before = {s: {o: frozenset(rels) for o, (rels, _) in row.items()} for s, row in rows.items()}
+    for s, r, o in removed:
+        if o in rows[s]:
+            rows[s][o][0].discard(r)
+    for s, r, o in added:
+        rows[s].setdefault(o, [set(), None])[0].add(r)
+
+    for s, row in rows.items():
+        # as in generate_cache.py, every subject is its own neighbor through 'sameas'
+        self_rels = row.pop(s, [set(), 1.])[0] - {'sameas'}
+        for o in [o for o, (rels, _) in row.items() if not rels]:
+            del row[o]
+        if row or self_rels:
+            row[s] = [self_rels | {'sameas'}, 1.]
+    return {s: row for s, row in rows.items() if {o: frozenset(rels) for o, (rels, _) in row.items()} != before[s]}
+
+
+def edge_relations(s, o, rels):
+    if s == o:
+        return ['sameas'] + sorted(rels - {'sameas'})
+    return sorted(rels)
+
+
+def update_store(store_path, added, removed, embeddings):
+    store = NeighborhoodStore(store_path)
+    rows = update_rows(store, added, removed)
+    if not rows:
+        return []
+
+    relations = list(store.relations)
+    relations += sorted({r for row in rows.values() for rels, _ in row.values() for r in rels} - set(relations))
+    assert len(relations) <= 256, 'relation ids are stored as uint8'
+    relation_ids = {r: i for i, r in enumerate(relations)}
+
+    # new nodes are inserted in the sorted node table, shifting the ids of the nodes after them
+    names = set(rows) | {o for row in rows.values() for o in row}
+    new_names = sorted(n for n in names if n not in store)
+    insertions = np.array([store.nodes.position(n) for n in new_names], dtype=np.int64)
+    n_old, n_nodes = len(store), len(store) + len(new_names)
+    old_to_new = np.arange(n_old) + np.searchsorted(insertions, np.arange(n_old), side='right')
+    insertion_points = dict(zip(new_names, insertions.tolist()))
+    new_ids = {n: p + k for k, (n, p) in enumerate(insertion_points.items())}
+    def node_id(word):
+        return new_ids[word] if word in new_ids else int(old_to_new[store.node_id(word)])
+
+    embedding_rows = np.full(n_nodes, -1, dtype=np.int64)
+    embedding_rows[old_to_new] = store.embedding_rows(embeddings)
+    for n in new_names:
+        embedding_rows[new_ids[n]] = embeddings.vocab.index(n)
+
+    old_indptr = np.asarray(store.indptr)
+    degrees = np.zeros(n_nodes, dtype=np.int64)
+    degrees[old_to_new] = np.diff(old_indptr)
+    rel_degrees = np.zeros(n_nodes, dtype=np.int64)
+    rel_degrees[old_to_new] = np.diff(np.asarray(store.rel_indptr[old_indptr]))
+
+    packed = {}
+    for s, row in rows.items():
+        objects = sorted(row, key=node_id)
+        rels = [[relation_ids[r] for r in edge_relations(s, o, row[o][0])] for o in objects]
+        sims = []
+        for o in objects:
+            sim = row[o][1]
+            if sim is None:
+                found = s in embeddings and o in embeddings
+                sim = float(embeddings.vector(s) @ embeddings.vector(o)) if found else 0.
+            sims.append(sim)
+        packed[node_id(s)] = (np.array([node_id(o) for o in objects], dtype=np.int32), np.array(sims, dtype=np.float32), rels)
+        degrees[node_id(s)] = len(objects)
+        rel_degrees[node_id(s)] = sum(len(r) for r in rels)
+
+    indptr = np.zeros(n_nodes + 1, dtype=np.int64)
+    np.cumsum(degrees, out=indptr[1:])
+    rels_indptr = np.zeros(n_nodes + 1, dtype=np.int64)
+    np.cumsum(rel_degrees, out=rels_indptr[1:])
+    n_edges, n_rels = int(indptr[-1]), int(rels_indptr[-1])
+
+    out_path = store_path.rstrip('/') + '.update'
+    if os.path.exists(out_path):
+        shutil.rmtree(out_path)
+    os.makedirs(out_path)
+    indices = create_array(out_path, 'indices', np.int32, n_edges)
+    sims = create_array(out_path, 'sims', np.float32, n_edges)
+    rel_indptr = create_array(out_path, 'rel_indptr', np.int64, n_edges + 1)
+    rel_ids = create_array(out_path, 'rel_ids', np.uint8, n_rels)
+    rel_indptr[-1] = n_rels
+
+    def copy_nodes(a, b):
+        # the old nodes [a, b) are contiguous in the new store as well, and so are their edges
+        if a >= b:
+            return
+        e0, e1 = int(old_indptr[a]), int(old_indptr[b])
+        r0, r1 = int(store.rel_indptr[e0]), int(store.rel_indptr[e1])
+        edge_shift, rel_shift = int(indptr[old_to_new[a]]) - e0, int(rels_indptr[old_to_new[a]]) - r0
+        for start in range(e0, e1, COPY_BLOCK):
+            stop = min(start + COPY_BLOCK, e1)
+            indices[start + edge_shift:stop + edge_shift] = old_to_new[store.indices[start:stop]]
+            sims[start + edge_shift:stop + edge_shift] = store.sims[start:stop]
+            rel_indptr[start + edge_shift:stop + edge_shift] = store.rel_indptr[start:stop] + rel_shift
+        for start in range(r0, r1, COPY_BLOCK):
+            stop = min(start + COPY_BLOCK, r1)
+            rel_ids[start + rel_shift:stop + rel_shift] = store.rel_ids[start:stop]
+
+    cursor = 0
+    for word in sorted(set(rows) | set(new_names), key=node_id):
+        old_id = store.node_id(word)
+        boundary = old_id if old_id >= 0 else insertion_points[word]
+        copy_nodes(cursor, boundary)
+        cursor = old_id + 1 if old_id >= 0 else boundary
+        j = node_id(word)
+        if j in packed:
+            objects, edge_sims, rels = packed[j]
+            e, r = int(indptr[j]), int(rels_indptr[j])
+            indices[e:e + len(objects)] = objects
+            sims[e:e + len(objects)] = edge_sims
+            for k, edge_rels in enumerate(rels):
+                rel_indptr[e + k] = r
+                rel_ids[r:r + len(edge_rels)] = edge_rels
+                r += len(edge_rels)
+    copy_nodes(cursor, n_old)
+
+    for array in (indices, sims, rel_indptr, rel_ids):
+        array.flush()
+    save_string_table(out_path, 'nodes', list(heapq.merge(store.nodes, new_names)))
+    save_relations(out_path, relations)
+    np.save(os.path.join(out_path, 'indptr.npy'), indptr)
+    np.save(os.path.join(out_path, 'embedding_rows.npy'), embedding_rows)
+    meta = dict(store.meta, nodes=n_nodes, edges=n_edges, relations=len(relations), embeddings=embeddings.fingerprint)
+    save_meta(out_path, meta)
+    del store
+
+    old_path = store_path.rstrip('/') + '.old'
+    os.rename(store_path, old_path)
+    os.rename(out_path, store_path)
+    shutil.rmtree(old_path)
+    return sorted(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Update a neighborhood store from a delta of ConceptNet assertions')
+    parser.add_argument('-s', '--store_path', type=str, help="Path to the neighborhood store to update", default='zeste_cache/neighborhoods_en')
+    parser.add_argument('-d', '--delta_path', type=str, help="Path to the delta file (`+` or `-`, a tab, and an assertion line of the ConceptNet dump)", required=True)
+    parser.add_argument('-nb', '--embeddings_path', type=str, help="Path to the memory-mapped Numberbatch embeddings of the store", default='zeste_cache/numberbatch-en-19.08')
+    parser.add_argument('-c', '--cache_paths', type=str, nargs='*', help="Folders of cached multi-hop neighborhoods to invalidate (prefetch folder, server demo cache)", default=[])
+    args = parser.parse_args()
+
+    language = NeighborhoodStore(args.store_path).meta.get('language', 'en')
+    added, removed = read_delta(args.delta_path, language)
+    print(f'Read {len(added):,} added and {len(removed):,} removed triples (reverse relations included)')
+
+    started = time.time()
+    changed = update_store(args.store_path, added, removed, load_embeddings(args.embeddings_path))
+    print(f'Rebuilt {len(changed):,} 1-hop neighborhoods in {time.time() - started:.1f}s')
+
+    for cache_path in args.cache_paths:
+        removed_entries, kept_entries = invalidate_dependents(cache_path, changed)
+        print(f'{cache_path}: removed {removed_entries:,} stale neighborhoods, kept {kept_entries:,}')
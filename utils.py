@@ -1,176 +1,102 @@
 import os
 import time
-import copy
-import hashlib
-import pickle
 import itertools
 import numpy as np
 import pandas as pd
+from tqdm import tqdm
 
 import multiprocessing as mp
 import matplotlib.pyplot as plt
 
-from nltk.corpus import stopwords
-from nltk.stem import WordNetLemmatizer
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.metrics import classification_report, confusion_matrix
 from sklearn.metrics import accuracy_score, precision_score, recall_score, f1_score
 
-def get_word_neighborhood(label, depth, numberbatch, cache_path, prefetch_path, save_to_prefetch = True):
+from store import open_store
+from embeddings import load_embeddings
+from neighborhood import SIMILARITIES, LabelNeighborhood, expand_neighborhood
+from tokenization import get_stopwords, preprocess
+from scoring import ScoringEngine
+from ngrams import NgramMatcher
+from corpus import load_corpus
+from streaming import stream_predictions, read_predictions, count_predictions
+from prefetch import open_prefetch
+
+def get_word_neighborhood(label, depth, numberbatch, store, prefetch_path, save_to_prefetch = True):
     # In case the requested label does not appear in the cache
+    if depth == 0 or label not in store or label not in numberbatch:
+        return LabelNeighborhood.empty(store, label)
 
-    pickle_name = label + '.pickle'
-    md5name = hashlib.md5(pickle_name.encode('utf-8')).hexdigest()[:2]
-    pickle_path = os.path.join(cache_path, md5name, pickle_name)
-    if depth == 0 or not os.path.exists(pickle_path) or label not in numberbatch:
-        return {}
+    stopwords = get_stopwords('en')
 
-    # if already computed
+    # if already computed (with the same configuration)
     if depth > 1:
-        prefetch_folder = os.path.join(prefetch_path, str(depth))
-        if not os.path.exists(prefetch_folder):
-            print('Creating folder:', prefetch_folder)
-            os.makedirs(prefetch_folder, exist_ok=True)
-        prefetch_pickle_path = os.path.join(prefetch_folder, md5name, pickle_name)
-        if os.path.exists(prefetch_pickle_path):
-            return pickle.load(open(prefetch_pickle_path, 'rb'))
-
-    # Get immediate label neighborhood
-    similarities = ['simple', 'compound', 'depth', 'harmonized']
-    neighborhood = pickle.load(open(pickle_path, 'rb'))
-    for node in neighborhood:
-        # we add the possiblity of defining multiple similarity methods for nodes that are not directly connected
-        # to the Label node
-        neighborhood[node]['rels'] = [tuple(neighborhood[node]['rels'])]
-        neighborhood[node]['sim'] = {sim:neighborhood[node]['sim'] for sim in similarities}
-
-    # Connect to n-hops labels
-    hops = 1
-    to_visit_next = list(neighborhood.keys())
-    while hops < depth:
-        next_hop = []
-        while len(to_visit_next) > 0:
-            current_node = to_visit_next.pop()
-            if current_node in stopwords.words('english'):
-                continue
-            if neighborhood[current_node]['sim']['simple'] <= 0:
-                continue
-            cnn = get_word_neighborhood(current_node, 1, numberbatch, cache_path, prefetch_path)
-            for word in cnn:
-                if word not in neighborhood:
-                    neighborhood[word] = {'from':[], 'rels': [], 'sim':{}}
-                    sim_dict = {sim: 0.0 for sim in similarities}
-                else:
-                    sim_dict = neighborhood[word]['sim']
-
-                neighborhood[word]['from'].append(current_node)
-                neighborhood[word]['rels'].append(tuple(cnn[word]['rels']))
-                if word in numberbatch:
-                    sim_label_word = numberbatch.similarity(label, word)
-                    sim_dict['simple'] = max(sim_dict['simple'], sim_label_word)
-                    sim_dict['depth']  = max(sim_dict['depth'], sim_label_word / (hops + 1))
-                    if current_node in numberbatch:
-                        sim_cn_word = numberbatch.similarity(current_node, word)
-                        sim_label_cn = numberbatch.similarity(label, current_node)
-                        compound = sim_label_cn * sim_cn_word
-                        harmonized = 2*compound / (sim_label_cn + sim_cn_word)
-                        sim_dict['compound'] = max(sim_dict['compound'], compound)
-                        sim_dict['harmonized'] = max(sim_dict['harmonized'], harmonized)
-                    else:
-                        sim_dict['compound'] = max(sim_dict['compound'], sim_label_word)
-                        sim_dict['harmonized'] = max(sim_dict['harmonized'], sim_label_word)
-
-                # print('From label' + label + '- current node:' + current_node + ', word:' + word)
-                neighborhood[word]['sim'] = sim_dict
-                next_hop.append(word)
-
-        hops += 1
-        to_visit_next = next_hop
-
-    # save
+        prefetch = open_prefetch(prefetch_path, depth, numberbatch, store, stopwords)
+        neighborhood = prefetch.get(label)
+        if neighborhood is not None:
+            return neighborhood
+
+    neighborhood, dependencies = expand_neighborhood(label, depth, numberbatch, store, stopwords, with_dependencies=True)
+
+    # save (with the nodes it depends on, for update_cache.py to invalidate it)
     if depth > 1 and save_to_prefetch:
-        os.makedirs(os.path.join(prefetch_folder, md5name), exist_ok=True)
-        pickle.dump(neighborhood, open(prefetch_pickle_path, 'wb'))
+        prefetch.put(label, neighborhood, dependencies)
 
     return neighborhood
 
-def get_label_neighborhood(label_words, depth, numberbatch, cache_path, prefetch_path):
-
-    ns = []
+def get_label_neighborhood(label_words, depth, numberbatch, store, prefetch_path):
     words = label_words.split(';')
-    for word in words:
-        ns.append(get_word_neighborhood(word, depth, numberbatch, cache_path, prefetch_path))
-    neighborhood = ns[0].copy()
-
-    for current_node, cnn in zip(words[1:], ns[1:]):
-        for word in cnn:
-            if word in neighborhood:
-                neighborhood[word]['from'].append(current_node)
-                neighborhood[word]['rels'].append(tuple(cnn[word]['rels']))
-                neighborhood[word]['sim'] = {s:max(neighborhood[word]['sim'][s], cnn[word]['sim'][s]) for s in cnn[word]['sim']}
-            else:
-                neighborhood[word] = {}
-                neighborhood[word]['from'] = [current_node]
-                neighborhood[word]['rels'] = [tuple(cnn[word]['rels'])]
-                neighborhood[word]['sim']  = cnn[word]['sim'].copy()
+    return LabelNeighborhood.merge(words, [get_word_neighborhood(word, depth, numberbatch, store, prefetch_path) for word in words])
 
-    return neighborhood
 
+# set before forking the workers of get_labels_neighborhoods, which inherit the memory-mapped
+# embeddings and store instead of receiving a pickled copy
+_expansion_state = None
+
+def _expand_word(word):
+    depth, numberbatch, store, prefetch_path = _expansion_state
+    return word, get_word_neighborhood(word, depth, numberbatch, store, prefetch_path)
 
-def filter_neighborhoood(neighborhood_original, allowed_rels, sim, keep):
-    if allowed_rels == 'all' and sim == 'simple' and keep == 'all':
-        return neighborhood_original
 
-    neighborhood = copy.deepcopy(neighborhood_original)
+def get_labels_neighborhoods(labels, depth, numberbatch, store, prefetch_path, workers=1):
+    # Every distinct word of the (semicolon-separated) labels is expanded once, across `workers`
+    # processes, and the neighborhoods of the words of each label are then merged
+    global _expansion_state
+    words = sorted({word for label in labels for word in label.split(';')})
+    if workers > 1 and len(words) > 1:
+        _expansion_state = (depth, numberbatch, store, prefetch_path)
+        with mp.get_context('fork').Pool(processes=min(workers, len(words))) as pool:
+            words_neighborhoods = dict(tqdm(pool.imap_unordered(_expand_word, words), total=len(words)))
+        _expansion_state = None
+    else:
+        words_neighborhoods = {word: get_word_neighborhood(word, depth, numberbatch, store, prefetch_path) for word in tqdm(words)}
+
+    return {label: LabelNeighborhood.merge(label.split(';'), [words_neighborhoods[word] for word in label.split(';')]) for label in labels}
 
+
+def get_ngrams_matcher(corpus, numberbatch):
+    # the multiword n-grams of the preprocessed corpus that are in Numberbatch, or every multiword
+    # term of Numberbatch for the streamed datasets, whose n-grams cannot be counted beforehand
+    if corpus is None:
+        return NgramMatcher([w.replace('_', ' ') for w in numberbatch.vocab if '_' in w])
+    ngrams = [w for w in corpus.ngrams if w.replace(' ', '_') in numberbatch]
+    return NgramMatcher(ngrams)
+
+
+def filter_neighborhoood(neighborhood, allowed_rels, sim, keep):
+    # the filtered views are cached by the neighborhood, which is left untouched
     if allowed_rels == 'related':
         allowed_rels = ['DefinedAs', 'DerivedFrom', 'HasA', 'InstanceOf', 'IsA', 'PartOf', 'RelatedTo', 'SimilarTo', 'Synonym', 'Antonym']
 
     if ',' in allowed_rels:
         allowed_rels = allowed_rels.split(',')
 
-    if allowed_rels != 'all':
-        nodes = list(neighborhood.keys())
-        for node in nodes:
-            if not any(rel in rels[0] for rel in allowed_rels for rels in neighborhood[node]['rels']):
-                del neighborhood[node]
-                continue
-
-    if keep != 'all':
-        all_scores = sorted([neighborhood[node]['sim'][sim] for node in neighborhood], reverse=True)
-        if keep.startswith('top') and keep.endswith('%'):
-            keep = int(keep[3:-1]) / 100.
-            cutoff_score = all_scores[int(keep*(len(all_scores)))-1]
-        elif keep.startswith('top'):
-            keep = int(keep[3:])
-            cutoff_score = all_scores[min(len(all_scores)-1,keep)]
-        elif keep.startswith('thresh'):
-            cutoff_score = float(keep[6:])
-        nodes = list(neighborhood.keys())
-        for node in nodes:
-            node_sim = neighborhood[node]['sim'][sim]
-            if node_sim <= cutoff_score:
-                del neighborhood[node]
-                continue
-
-    return neighborhood
-
-
-lemmatizer = WordNetLemmatizer()
-def preprocess(document):
-    document = document.replace("'ll", ' will').replace("s' ", 's').replace("'s", '').replace("-", '_')
-    document = ''.join(c for c in document if c not in '!"#$%&\'()*+,./:;<=>?@[\\]^`{|}~')
-    document = [w for w in document.lower().split(' ') if w not in stopwords.words('english')]
-    document = [lemmatizer.lemmatize(w) for w in document if w != '']
-    return document
+    return neighborhood.filter(allowed_rels, sim, keep)
 
 
 def score(tokens, label_neighborhood, sim, ngrams, normalize):
     if ngrams:
-        doc = ' '.join(tokens)
-        for ngram in ngrams:
-            if ngram in doc:
-                tokens.append(ngram)
+        tokens = tokens + ngrams.match(tokens)
     score = 0
     inter = 0
     for token in tokens:
@@ -187,14 +113,11 @@ def score(tokens, label_neighborhood, sim, ngrams, normalize):
 
 
 def predict_dataset(docs, sorted_labels, labels_neighborhoods, sim, ngrams, normalize='max_score'):
-    scores = np.zeros((len(docs), len(sorted_labels)))
-    for i, doc in enumerate(docs):
-        for j, label in enumerate(sorted_labels):
-            scores[i][j] = score(doc, labels_neighborhoods[label], sim, ngrams, normalize)
-    return scores
+    engine = ScoringEngine(sorted_labels, labels_neighborhoods, [sim])
+    return engine.predict(docs, sim, ngrams, normalize)
 
 
-def evaluate(predicted_labels, gt_labels, labels_mapping):
+def evaluate(predicted_labels, gt_labels, labels_mapping, sample_weight=None):
     if type(gt_labels[0]) == list:
         for i, p in enumerate(predicted_labels):
             corrert_labels = [labels_mapping[l] for l in gt_labels[i]]
@@ -206,11 +129,11 @@ def evaluate(predicted_labels, gt_labels, labels_mapping):
         gt_labels = [labels_mapping[l] for l in gt_labels]
 
 
-    acc = accuracy_score(predicted_labels, gt_labels)
-    pre = precision_score(predicted_labels, gt_labels, average='weighted')
-    rec = recall_score(predicted_labels, gt_labels, average='weighted')
-    f1  = f1_score(predicted_labels, gt_labels, average='weighted')
-    cm  = confusion_matrix(predicted_labels, gt_labels)
+    acc = accuracy_score(predicted_labels, gt_labels, sample_weight=sample_weight)
+    pre = precision_score(predicted_labels, gt_labels, sample_weight=sample_weight, average='weighted')
+    rec = recall_score(predicted_labels, gt_labels, sample_weight=sample_weight, average='weighted')
+    f1  = f1_score(predicted_labels, gt_labels, sample_weight=sample_weight, average='weighted')
+    cm  = confusion_matrix(predicted_labels, gt_labels, sample_weight=sample_weight)
 
-    cr  = classification_report(predicted_labels, gt_labels)
+    cr  = classification_report(predicted_labels, gt_labels, sample_weight=sample_weight)
     return acc, pre, rec, f1, cm, cr
\ No newline at end of file
@@ -12,14 +12,16 @@ if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description='Zero-Shot Topic Extraction')
 
-    parser.add_argument("-cp", "--cache_path", type=str, help="Path to where the 1-hop word neighborhoods are cached",
-                        default='zeste_cache')
+    parser.add_argument("-cp", "--cache_path", type=str, help="Path to the neighborhood store where the 1-hop word neighborhoods are cached",
+                        default='zeste_cache/neighborhoods_en')
     parser.add_argument('-pp', '--prefetch_path', type=str, help="Path to where the precomputed n-hop neighborhoods are cached",
                         default='prefetch_cache')
-    parser.add_argument('-nb', '--numberbatch_path', type=str, help="Path to the pickled Numberbatch",
-                        default='zeste_cache/numberbatch-en-19.08.pickle')
+    parser.add_argument('-nb', '--numberbatch_path', type=str, help="Path to the memory-mapped Numberbatch",
+                        default='zeste_cache/numberbatch-en-19.08')
     parser.add_argument('-dp', '--dataset_path', type=str, help="Path to the dataset to process",
                         default='data/bbc_dataset.csv')
+    parser.add_argument('-cc', '--corpus_cache_path', type=str, help="Path to where the preprocessed datasets are cached",
+                        default='corpus_cache')
     parser.add_argument('-lm', '--labels_mapping', type=str, help="Path to the mapping between the dataset labels and ZeSTE labels (multiword labels are comma-separated)",
                         default='labels_mapping/bbc_labels_mapping.txt')
     parser.add_argument('-rp', '--results_path', type=str, help="Path to the directory where to store the results",
@@ -29,6 +31,8 @@ if __name__ == "__main__":
     parser.add_argument('-s', '--similarity', type=str, choices=['simple', 'compound', 'depth', 'harmonized'], default='simple')
     parser.add_argument('-n', '--use_ngrams', type=bool, default=False, help='Whether or not to use n-grams (vs only simple wprds)')
     parser.add_argument('-ar', '--allowed_rels', type=str, help="Which relationships to use (comma-separated or 'all')", default='all')
+    parser.add_argument('-cs', '--chunk_size', type=int, help="Stream the dataset in chunks of this many documents instead of loading it in memory (for very large datasets)", default=None)
+    parser.add_argument('-w', '--workers', type=int, help="Number of processes computing the label neighborhoods", default=mp.cpu_count())
 
     args = parser.parse_args()
 
@@ -42,72 +46,65 @@ if __name__ == "__main__":
     ###
 
     print('Loading numberbatch..')
-    numberbatch = pickle.load(open(args.numberbatch_path, 'rb'))
-
-    df_dataset = pd.read_csv(args.dataset_path)
-    raw_corpus = df_dataset.text.tolist()
-    gt_labels = df_dataset.label.tolist()
-    unique_labels = sorted(set(gt_labels))
-
-    print('Preprocessing all documents..')
-    with mp.Pool(processes=mp.cpu_count()) as pool:
-        corpus_preprocessed = pool.map(preprocess, raw_corpus)
-
-    ngram_counter = TfidfVectorizer(ngram_range=(1,3), min_df=2)
-    ngram_counter.fit([' '.join(d) for d in corpus_preprocessed])
-    print('ngrams count:', len(ngram_counter.vocabulary_.keys()))
-    ngrams = [w for w in ngram_counter.vocabulary_.keys() if ' ' in w and w.replace(' ', '_') in numberbatch]
+    numberbatch = load_embeddings(args.numberbatch_path)
+    store = open_store(args.cache_path)
 
     labels_mapping = dict(l.strip().split('\t') for l in open(args.labels_mapping))
     sorted_labels = sorted(set(labels_mapping.values()))
 
+    if args.chunk_size is None:
+        df_dataset = pd.read_csv(args.dataset_path)
+        gt_labels = df_dataset.label.tolist()
+        unique_labels = sorted(set(gt_labels))
+
+        print('Preprocessing all documents..')
+        corpus_preprocessed = load_corpus(args.dataset_path, args.corpus_cache_path)
+        ngrams_matcher = get_ngrams_matcher(corpus_preprocessed, numberbatch) if args.use_ngrams else None
+    else:
+        ngrams_matcher = get_ngrams_matcher(None, numberbatch) if args.use_ngrams else None
+
     ###
     #   Generate and filter Label Neighborhoods
     ###
     print('Computing neighborhoods..')
-    labels_neighborhoods = {}
-    for label in tqdm(sorted_labels):
-        labels_neighborhoods[label] = get_label_neighborhood(label, args.depth, numberbatch, args.cache_path, args.prefetch_path)
+    labels_neighborhoods = get_labels_neighborhoods(sorted_labels, args.depth, numberbatch, store, args.prefetch_path, args.workers)
 
     filtered_labels_neighborhoods = {}
     for label in sorted_labels:
         filtered_labels_neighborhoods[label] = filter_neighborhoood(labels_neighborhoods[label], args.allowed_rels, args.similarity, args.filter)
 
-    predicted_probs = predict_dataset(corpus_preprocessed, sorted_labels, filtered_labels_neighborhoods, args.similarity, args.use_ngrams, 'max_score')
-    predicted_labels = [sorted_labels[p] for p in np.argmax(predicted_probs, axis=1)]
-
-    filename = f"{args.dataset_path.split('/')[-1]}-{args.filter}-{args.similarity}-{args.depth}-{args.use_ngrams}"
-    predictions_file_path = os.path.join(args.results_path, filename+'-predictions.npy')
-    probs_file_path = os.path.join(args.results_path, filename+'-probabilities.npy')
+    filename = f"{args.dataset_path.split('/')[-1]}-{args.filter}-{args.similarity}-{args.depth}-{args.use_ngrams}-{args.allowed_rels}"
     report_file_path = os.path.join(args.results_path, filename+'-report.txt')
-
     os.makedirs(args.results_path, exist_ok=True)
-    np.save(open(predictions_file_path, 'wb'), predicted_labels)
-    np.save(open(probs_file_path, 'wb'), predicted_probs)
-
-    print('Predictions for the dataset saved at', args.results_path)
 
-    acc, pre, rec, f1, cm, cr = evaluate(predicted_labels, gt_labels, labels_mapping)
-    with open(report_file_path, 'w') as f:
-        f.write(cr)
+    if args.chunk_size is None:
+        predicted_probs = predict_dataset(corpus_preprocessed, sorted_labels, filtered_labels_neighborhoods, args.similarity, ngrams_matcher, 'max_score')
+        predicted_labels = [sorted_labels[p] for p in np.argmax(predicted_probs, axis=1)]
+
+        predictions_file_path = os.path.join(args.results_path, filename+'-predictions.npy')
+        probs_file_path = os.path.join(args.results_path, filename+'-probabilities.npy')
+        np.save(open(predictions_file_path, 'wb'), predicted_labels)
+        np.save(open(probs_file_path, 'wb'), predicted_probs)
+        sample_weight = None
+    else:
+        print('Streaming the dataset..')
+        engine = ScoringEngine(sorted_labels, filtered_labels_neighborhoods, [args.similarity])
+        output_path = os.path.join(args.results_path, filename)
+        stream_predictions(args.dataset_path, output_path, engine, args.similarity, ngrams_matcher, 'max_score', args.chunk_size, args.workers,
+                           parameters={'depth': args.depth, 'filter': args.filter, 'allowed_rels': args.allowed_rels})
+        # archives to classify may come without labels
+        gt_labels = None
+        if 'label' in pd.read_csv(args.dataset_path, nrows=0).columns:
+            # evaluated on the counts of the (predicted, true) label pairs rather than on one label per document
+            pair_counts = count_predictions(output_path, args.dataset_path, args.chunk_size)
+            predicted_labels, gt_labels = (list(labels) for labels in zip(*pair_counts))
+            sample_weight = list(pair_counts.values())
 
-    print('Results report saved at', report_file_path)
+    print('Predictions for the dataset saved at', args.results_path)
 
-    ###
-    #   Compute the metrics on the dataset for different configurations
-    ###
+    if gt_labels is not None:
+        acc, pre, rec, f1, cm, cr = evaluate(predicted_labels, gt_labels, labels_mapping, sample_weight)
+        with open(report_file_path, 'w') as f:
+            f.write(cr)
 
-    # for sim in ['simple', 'depth', 'compound', 'harmonized']:
-    #     for ng in [True, False]:
-    #         for normalize in ['inter_len', 'max_score', 'none']:
-    #             filename = f"{args.dataset_path.split('/')[-1]}-{args.filter}-{args.similarity}-{args.depth}-{sim}-{ng}-{normalize}"
-    #             print(filename)
-    #             predicted_probs = predict_dataset(corpus_preprocessed, sorted_labels, filtered_labels_neighborhoods, sim, ngrams if ng else None, normalize)
-    #             np.save(open(os.path.join(args.results_path, filename+'-results.npy'), 'wb'), predicted_probs)
-    #             predicted_labels = [sorted_labels[p] for p in np.argmax(predicted_probs, axis=1)]
-    #             acc, pre, rec, f1, cm, cr = evaluate(predicted_labels, gt_labels, labels_mapping)
-    #             with open(os.path.join(args.results_path, filename+'-report.txt'), 'w') as f:
-    #                 f.write(cr)
-    #             np.save(open(os.path.join(args.results_path, filename+'-cm.npy'), 'wb'), cm)
-    #             with open(os.path.join(args.results_path, 'all-experiments'), 'a') as f:
-    #                 f.write(f"{filename}: {acc} {pre} {rec} {f1}")
+        print('Results report saved at', report_file_path)